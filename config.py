@@ -1,10 +1,45 @@
-import os
-
-DEBUG = True
-
-basedir = os.path.abspath(os.path.dirname(__file__))
-DATABASE = '<db_name>'
-SQLALCHEMY_DATABASE_URI = 'postgres://<user>:<password>@localhost/' + DATABASE
-COMMIT_AFTER = 10000 # max rows
-BIND_HOST = '0.0.0.0' # careful now
-BIND_PORT = 5555
+import os
+
+DEBUG = False # (Flask's debugger and reloader; run.py turns it on)
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+DATABASE = '<db_name>'
+SQLALCHEMY_DATABASE_URI = 'postgres://<user>:<password>@localhost/' + DATABASE
+# DB connections are pooled per process: mind max_connections in postgresql.conf
+# (SERVER_WORKERS x (pool size + overflow), plus importers)
+SQLALCHEMY_POOL_SIZE = 3
+SQLALCHEMY_MAX_OVERFLOW = 2
+SQLALCHEMY_POOL_TIMEOUT = 10 # seconds to wait for a connection when all are busy
+SQLALCHEMY_POOL_RECYCLE = 3600 # seconds; reconnect after that long
+SQLALCHEMY_POOL_PRE_PING = True # check connections as they are checked out
+COMMIT_AFTER = 10000 # max rows
+BULK_IMPORT = True # COPY status entries in one go per consensus document
+IMPORT_WORKERS = 4 # consensus parse worker processes (0: no pipelining)
+IMPORT_WINDOW = 16 # max parsed consensus files waiting to be written
+UPDATE_PRESENCE = True # maintain the presence interval table on import
+UPDATE_ADDRESS_HISTORY = True # ditto, for the address history table
+RESOLVE_DESCRIPTORS = True # link status entries to their server descriptors
+INGEST_POLL_INTERVAL = 10 # seconds; ingest daemon rescans (without inotify)
+INGEST_SETTLE = 2 # seconds; files modified more recently are left for later
+INGEST_KEEPALIVE = 60 # seconds; the daemon pings the DB when idle this long
+CONSENSUS_CACHE_TTL = 300 # seconds; fallback for when NOTIFYs are missed
+CONSENSUS_NOTIFY_CHANNEL = 'torsearch_consensus'
+RESULT_CACHE_SIZE = 1000 # /summary and /details result sets kept per process
+RUNNING_SNAPSHOT = True # serve running=true searches from memory (snapshot.py)
+BLOOM_FILTER = True # skip the DB for lookups of unknown fingerprints (bloom.py)
+BLOOM_FILE = 'fingerprints.bloom' # the filter, saved for quick worker startup
+BLOOM_CAPACITY = 2000000 # fingerprints; the filter grows past this if need be
+BLOOM_ERROR_RATE = 0.001 # false positives (lookups which go to the DB anyway)
+STREAM_RESPONSES = True # write JSON rows out as they come from the DB cursor
+STATUSES_UPPER_LIMIT = 10000 # max /statuses entries when streaming
+BINARY_FINGERPRINTS = False # see tools/migrate_binary_fingerprints.py
+SLOW_QUERY_THRESHOLD = 1.0 # seconds; slower API queries get logged + EXPLAINed
+SLOW_QUERY_SAMPLE = 1000 # also log 1 in N API queries (0: none)
+SLOW_QUERY_MAX_PER_MINUTE = 6 # at most (EXPLAIN ANALYZE reruns the query)
+SLOW_QUERY_LOG = 'slow_queries.log' # JSON lines, rotated
+PROFILE_TOKEN = None # profile requests with this in X-Torsearch-Profile / ?profile=
+PROFILE_SAMPLE = 0 # also profile 1 in N API requests (0: none)
+PROFILE_DIR = 'profiles' # pstats files, see tools/merge_profiles.py
+BIND_HOST = '0.0.0.0' # careful now
+BIND_PORT = 5555
+SERVER_WORKERS = 0 # gunicorn worker processes (0: 2 per CPU core + 1)
@@ -3,10 +3,32 @@ SET client_encoding = 'LATIN1';
 SET standard_conforming_strings = on;
 SET check_function_bodies = false;
 SET client_min_messages = warning;
+
+--
+-- Name: pg_trgm; Type: EXTENSION; Schema: -; Owner: 
+--
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public;
+
+
 SET search_path = public, pg_catalog;
 SET default_tablespace = '';
 SET default_with_oids = false;
 
+--
+-- Name: address_history; Type: TABLE; Schema: public; Owner: tsusr; Tablespace: 
+--
+
+CREATE TABLE address_history (
+    address inet NOT NULL,
+    fingerprint character varying(40) NOT NULL,
+    first_va timestamp without time zone NOT NULL,
+    last_va timestamp without time zone NOT NULL
+);
+
+
+ALTER TABLE public.address_history OWNER TO tsusr;
+
 --
 -- Name: consensus; Type: TABLE; Schema: public; Owner: tsusr; Tablespace: 
 --
@@ -81,15 +103,35 @@ CREATE TABLE fingerprint (
     address character varying(15) NOT NULL,
     first_va timestamp without time zone NOT NULL,
     last_va timestamp without time zone NOT NULL,
-    sid integer NOT NULL
+    sid integer NOT NULL,
+    flags integer,
+    seq bigint NOT NULL
 );
 
 
 ALTER TABLE public.fingerprint OWNER TO postgres;
 
+--
+-- Name: presence; Type: TABLE; Schema: public; Owner: tsusr; Tablespace: 
+--
+
+CREATE TABLE presence (
+    fingerprint character varying(40) NOT NULL,
+    start_va timestamp without time zone NOT NULL,
+    end_va timestamp without time zone NOT NULL,
+    nickname character varying(19),
+    address character varying(15)
+);
+
+
+ALTER TABLE public.presence OWNER TO tsusr;
+
 --
 -- Name: statusentry; Type: TABLE; Schema: public; Owner: tsusr; Tablespace: 
 --
+-- partitioned by month on validafter (needs PostgreSQL >= 11); the importer
+-- creates the monthly partitions (statusentry_YYYY_MM) as it needs them.
+--
 
 CREATE TABLE statusentry (
     validafter timestamp without time zone NOT NULL,
@@ -105,22 +147,10 @@ CREATE TABLE statusentry (
     bandwidth bigint,
     measured bigint,
     is_unmeasured boolean,
-    "isAuthority" boolean,
-    "isBadExit" boolean,
-    "isBadDirectory" boolean,
-    "isExit" boolean,
-    "isFast" boolean,
-    "isGuard" boolean,
-    "isHSDir" boolean,
-    "isNamed" boolean,
-    "isStable" boolean,
-    "isRunning" boolean,
-    "isUnnamed" boolean,
-    "isValid" boolean,
-    "isV2Dir" boolean,
-    "isV3Dir" boolean,
+    flags integer,
     id integer NOT NULL
-);
+)
+PARTITION BY RANGE (validafter);
 
 
 ALTER TABLE public.statusentry OWNER TO tsusr;
@@ -146,6 +176,30 @@ ALTER TABLE public.statusentry_id_seq OWNER TO tsusr;
 ALTER SEQUENCE statusentry_id_seq OWNED BY statusentry.id;
 
 
+--
+-- Name: fingerprint_seq_seq; Type: SEQUENCE; Schema: public; Owner: postgres
+--
+-- numbers the fingerprint rows in the order they are inserted (see
+-- torsearch/bloom.py.)
+--
+
+CREATE SEQUENCE fingerprint_seq_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+ALTER TABLE public.fingerprint_seq_seq OWNER TO postgres;
+
+--
+-- Name: fingerprint_seq_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: postgres
+--
+
+ALTER SEQUENCE fingerprint_seq_seq OWNED BY fingerprint.seq;
+
+
 --
 -- Name: id; Type: DEFAULT; Schema: public; Owner: tsusr
 --
@@ -160,6 +214,21 @@ ALTER TABLE ONLY descriptor ALTER COLUMN id SET DEFAULT nextval('descriptor_id_s
 ALTER TABLE ONLY statusentry ALTER COLUMN id SET DEFAULT nextval('statusentry_id_seq'::regclass);
 
 
+--
+-- Name: seq; Type: DEFAULT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY fingerprint ALTER COLUMN seq SET DEFAULT nextval('fingerprint_seq_seq'::regclass);
+
+
+--
+-- Name: address_history_pkey; Type: CONSTRAINT; Schema: public; Owner: tsusr; Tablespace: 
+--
+
+ALTER TABLE ONLY address_history
+    ADD CONSTRAINT address_history_pkey PRIMARY KEY (address, fingerprint);
+
+
 --
 -- Name: consensus_pkey; Type: CONSTRAINT; Schema: public; Owner: tsusr; Tablespace: 
 --
@@ -184,12 +253,27 @@ ALTER TABLE ONLY fingerprint
     ADD CONSTRAINT fingerprint_pkey PRIMARY KEY (fp12);
 
 
+--
+-- Name: presence_pkey; Type: CONSTRAINT; Schema: public; Owner: tsusr; Tablespace: 
+--
+
+ALTER TABLE ONLY presence
+    ADD CONSTRAINT presence_pkey PRIMARY KEY (fingerprint, start_va);
+
+
 --
 -- Name: statusentry_pkey; Type: CONSTRAINT; Schema: public; Owner: tsusr; Tablespace: 
 --
 
-ALTER TABLE ONLY statusentry
-    ADD CONSTRAINT statusentry_pkey PRIMARY KEY (id);
+ALTER TABLE statusentry
+    ADD CONSTRAINT statusentry_pkey PRIMARY KEY (id, validafter);
+
+
+--
+-- Name: descriptor_descriptor_key; Type: INDEX; Schema: public; Owner: tsusr; Tablespace: 
+--
+
+CREATE UNIQUE INDEX descriptor_descriptor_key ON descriptor USING btree (descriptor);
 
 
 --
@@ -220,6 +304,48 @@ CREATE INDEX fingerprint_address_idx ON fingerprint USING btree (address);
 CREATE INDEX fingerprint_last_va_idx ON fingerprint USING btree (last_va);
 
 
+--
+-- Name: fingerprint_last_va_fingerprint_idx; Type: INDEX; Schema: public; Owner: postgres; Tablespace: 
+--
+
+CREATE INDEX fingerprint_last_va_fingerprint_idx ON fingerprint USING btree (last_va DESC, fingerprint DESC);
+
+
+--
+-- Name: fingerprint_seq_idx; Type: INDEX; Schema: public; Owner: postgres; Tablespace: 
+--
+
+CREATE INDEX fingerprint_seq_idx ON fingerprint USING btree (seq);
+
+
+--
+-- Name: fingerprint_authority_idx; Type: INDEX; Schema: public; Owner: postgres; Tablespace: 
+--
+
+CREATE INDEX fingerprint_authority_idx ON fingerprint USING btree (last_va DESC, fingerprint DESC) WHERE ((flags & 1) <> 0);
+
+
+--
+-- Name: fingerprint_badexit_idx; Type: INDEX; Schema: public; Owner: postgres; Tablespace: 
+--
+
+CREATE INDEX fingerprint_badexit_idx ON fingerprint USING btree (last_va DESC, fingerprint DESC) WHERE ((flags & 2) <> 0);
+
+
+--
+-- Name: fingerprint_exit_idx; Type: INDEX; Schema: public; Owner: postgres; Tablespace: 
+--
+
+CREATE INDEX fingerprint_exit_idx ON fingerprint USING btree (last_va DESC, fingerprint DESC) WHERE ((flags & 8) <> 0);
+
+
+--
+-- Name: fingerprint_guard_idx; Type: INDEX; Schema: public; Owner: postgres; Tablespace: 
+--
+
+CREATE INDEX fingerprint_guard_idx ON fingerprint USING btree (last_va DESC, fingerprint DESC) WHERE ((flags & 32) <> 0);
+
+
 --
 -- Name: fingerprint_lower_idx; Type: INDEX; Schema: public; Owner: postgres; Tablespace: 
 --
@@ -227,6 +353,13 @@ CREATE INDEX fingerprint_last_va_idx ON fingerprint USING btree (last_va);
 CREATE INDEX fingerprint_lower_idx ON fingerprint USING btree (lower((nickname)::text));
 
 
+--
+-- Name: fingerprint_lower_trgm_idx; Type: INDEX; Schema: public; Owner: postgres; Tablespace: 
+--
+
+CREATE INDEX fingerprint_lower_trgm_idx ON fingerprint USING gin (lower((nickname)::text) gin_trgm_ops);
+
+
 --
 -- Name: statusentry_substr_validafter_idx; Type: INDEX; Schema: public; Owner: tsusr; Tablespace: 
 --
@@ -1,6 +1,9 @@
-# note: one is advised to use the db/db_create.sql raw SQL script instead.
-
-from config import SQLALCHEMY_DATABASE_URI
-from torsearch import db
-
-db.create_all()
+# note: one is advised to use the db/db_create.sql raw SQL script instead.
+# this makes an unpartitioned statusentry table (the importer copes with
+# that, see importer.statusentry_partitioned()), and none of the indexes
+# which aren't declared in torsearch/models.py.
+
+from config import SQLALCHEMY_DATABASE_URI
+from torsearch import db
+
+db.create_all()
@@ -0,0 +1,22 @@
+# gunicorn settings for serving the API (see wsgi.py and torsearch/server.py):
+#
+#   gunicorn -c gunicorn.conf.py wsgi
+
+from config import BIND_HOST, BIND_PORT # (a module named config would clash
+                                        # with gunicorn's own setting)
+from torsearch import server
+
+bind = '%s:%d' % (BIND_HOST, BIND_PORT)
+workers = server.workers()
+worker_class = 'sync' # one request at a time per worker; responses may stream
+timeout = 60
+preload_app = True # import once, share the (read-only) code pages
+max_requests = 100000 # recycle workers every now and then,
+max_requests_jitter = 10000 # not all at once
+
+def when_ready(master):
+  server.prepare()
+
+def post_fork(master, worker):
+  server.after_fork()
+  server.warm_up()
@@ -0,0 +1,40 @@
+-- store fingerprints and digests as 20-byte bytea instead of 40-character hex
+-- strings: halves their size in statusentry, fingerprint, presence and
+-- address_history, and in every index which includes them. the statusentry
+-- lookup index moves from substr(fingerprint, 0, 12) to the (binary)
+-- fingerprint itself, and fingerprint.fp12 becomes the whole fingerprint.
+-- the descriptor table is left as it is.
+
+-- run via tools/migrate_binary_fingerprints.py, then set BINARY_FINGERPRINTS
+-- = True in config.py. this rewrites all of statusentry - will take a long
+-- while, and needs the importer (and the API) stopped meanwhile.
+
+BEGIN;
+
+DROP INDEX statusentry_substr_validafter_idx;
+
+ALTER TABLE statusentry
+  ALTER COLUMN fingerprint TYPE bytea USING decode(fingerprint, 'hex'),
+  ALTER COLUMN digest TYPE bytea USING decode(digest, 'hex');
+
+CREATE UNIQUE INDEX statusentry_fingerprint_validafter_idx ON statusentry
+  USING btree (fingerprint, validafter DESC);
+
+-- (the USING expressions see the old, hex, column values.)
+ALTER TABLE fingerprint
+  ALTER COLUMN fp12 TYPE bytea USING decode(fingerprint, 'hex'),
+  ALTER COLUMN fingerprint TYPE bytea USING decode(fingerprint, 'hex'),
+  ALTER COLUMN digest TYPE bytea USING decode(digest, 'hex');
+
+ALTER TABLE presence
+  ALTER COLUMN fingerprint TYPE bytea USING decode(fingerprint, 'hex');
+
+ALTER TABLE address_history
+  ALTER COLUMN fingerprint TYPE bytea USING decode(fingerprint, 'hex');
+
+COMMIT;
+
+ANALYZE statusentry;
+ANALYZE fingerprint;
+ANALYZE presence;
+ANALYZE address_history;
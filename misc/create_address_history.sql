@@ -0,0 +1,21 @@
+-- create and backfill the address history table on an existing database
+-- (new databases get it from db/db_create.sql.) from then on, the importer
+-- keeps it up to date (see importer.merge_address_history().)
+
+-- this reads all of statusentry once - will take a while.
+
+CREATE TABLE address_history (
+    address inet NOT NULL,
+    fingerprint character varying(40) NOT NULL,
+    first_va timestamp without time zone NOT NULL,
+    last_va timestamp without time zone NOT NULL,
+    PRIMARY KEY (address, fingerprint)
+);
+
+insert into address_history (address, fingerprint, first_va, last_va)
+  select cast(address as inet), fingerprint, min(validafter), max(validafter)
+  from statusentry
+  where address is not null
+  group by address, fingerprint;
+
+analyze address_history;
@@ -0,0 +1,11 @@
+-- trigram index for substring and fuzzy nickname search
+-- (search_mode=substring|fuzzy; see onionoo_api.search_nickname().)
+-- new databases get it from db/db_create.sql.
+
+-- needs the pg_trgm contrib module (postgresql-contrib package on most
+-- distributions), and a superuser to create the extension.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY fingerprint_lower_trgm_idx ON fingerprint
+  USING gin (lower((nickname)::text) gin_trgm_ops);
@@ -0,0 +1,35 @@
+-- create and backfill the presence interval table on an existing database
+-- (new databases get it from db/db_create.sql.) from then on, the importer
+-- keeps it up to date (see importer.update_presence().)
+
+-- this reads all of statusentry once - will take a while.
+
+CREATE TABLE presence (
+    fingerprint character varying(40) NOT NULL,
+    start_va timestamp without time zone NOT NULL,
+    end_va timestamp without time zone NOT NULL,
+    nickname character varying(19),
+    address character varying(15),
+    PRIMARY KEY (fingerprint, start_va)
+);
+
+-- gaps-and-islands: a gap longer than an hour (a consensus the relay was not
+-- in) starts a new interval.
+insert into presence (fingerprint, start_va, end_va, nickname, address)
+  select fingerprint, min(validafter), max(validafter),
+    (array_agg(nickname order by validafter desc))[1],
+    (array_agg(address order by validafter desc))[1]
+  from (
+    select fingerprint, validafter, nickname, address,
+      sum(gap) over (partition by fingerprint order by validafter) as island
+    from (
+      select fingerprint, validafter, nickname, address,
+        case when validafter - lag(validafter) over
+          (partition by fingerprint order by validafter) <= interval '1 hour'
+          then 0 else 1 end as gap
+      from statusentry
+    ) as gaps
+  ) as islands
+  group by fingerprint, island;
+
+analyze presence;
@@ -0,0 +1,11 @@
+-- make descriptor digests unique on an existing database (new databases get
+-- the index from db/db_create.sql.) the bulk descriptor importer relies on it
+-- to skip descriptors it has already seen (ON CONFLICT (descriptor) DO
+-- NOTHING, see importer.import_descriptor_rows().)
+
+-- the old importer imported every descriptor directory twice, so there may be
+-- duplicates to get rid of first (keeping the first copy of each.)
+DELETE FROM descriptor a USING descriptor b
+  WHERE a.descriptor = b.descriptor AND a.id > b.id;
+
+CREATE UNIQUE INDEX descriptor_descriptor_key ON descriptor USING btree (descriptor);
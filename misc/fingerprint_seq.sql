@@ -0,0 +1,30 @@
+-- number the fingerprint rows in the order they are inserted in, for the
+-- fingerprint Bloom filter to catch up on (see torsearch/bloom.py.) new
+-- databases get this from db/db_create.sql.
+
+-- existing rows are numbered in first_va order. this rewrites the fingerprint
+-- table; remove the saved filter (BLOOM_FILE) afterwards, so that it is
+-- rebuilt.
+
+BEGIN;
+
+CREATE SEQUENCE fingerprint_seq_seq;
+
+ALTER TABLE fingerprint ADD COLUMN seq bigint;
+
+UPDATE fingerprint SET seq = n.seq
+  FROM (SELECT fp12, nextval('fingerprint_seq_seq') AS seq
+    FROM (SELECT fp12 FROM fingerprint ORDER BY first_va, fp12) ordered) n
+  WHERE fingerprint.fp12 = n.fp12;
+
+ALTER TABLE fingerprint
+  ALTER COLUMN seq SET DEFAULT nextval('fingerprint_seq_seq'::regclass),
+  ALTER COLUMN seq SET NOT NULL;
+
+ALTER SEQUENCE fingerprint_seq_seq OWNED BY fingerprint.seq;
+
+CREATE INDEX fingerprint_seq_idx ON fingerprint USING btree (seq);
+
+COMMIT;
+
+ANALYZE fingerprint;
@@ -0,0 +1,57 @@
+-- replace the boolean flag columns of statusentry ("isAuthority" ..
+-- "isV3Dir") with a single integer bitmask column, and add the flags of each
+-- relay's last status entry to the fingerprint table (for flag=... searches.)
+-- new databases get this layout from db/db_create.sql. the bits are those of
+-- models.FLAG_BITS.
+
+-- this rewrites all of statusentry - will take a long while. afterwards,
+-- VACUUM FULL (each partition of) statusentry to actually reclaim the space
+-- (see maintenance.vacuum_partition().)
+
+BEGIN;
+
+ALTER TABLE statusentry ADD COLUMN flags integer;
+
+UPDATE statusentry SET flags =
+  (CASE WHEN "isAuthority" THEN 1 ELSE 0 END) |
+  (CASE WHEN "isBadExit" THEN 2 ELSE 0 END) |
+  (CASE WHEN "isBadDirectory" THEN 4 ELSE 0 END) |
+  (CASE WHEN "isExit" THEN 8 ELSE 0 END) |
+  (CASE WHEN "isFast" THEN 16 ELSE 0 END) |
+  (CASE WHEN "isGuard" THEN 32 ELSE 0 END) |
+  (CASE WHEN "isHSDir" THEN 64 ELSE 0 END) |
+  (CASE WHEN "isNamed" THEN 128 ELSE 0 END) |
+  (CASE WHEN "isStable" THEN 256 ELSE 0 END) |
+  (CASE WHEN "isRunning" THEN 512 ELSE 0 END) |
+  (CASE WHEN "isUnnamed" THEN 1024 ELSE 0 END) |
+  (CASE WHEN "isValid" THEN 2048 ELSE 0 END) |
+  (CASE WHEN "isV2Dir" THEN 4096 ELSE 0 END) |
+  (CASE WHEN "isV3Dir" THEN 8192 ELSE 0 END);
+
+ALTER TABLE statusentry
+  DROP COLUMN "isAuthority", DROP COLUMN "isBadExit",
+  DROP COLUMN "isBadDirectory", DROP COLUMN "isExit", DROP COLUMN "isFast",
+  DROP COLUMN "isGuard", DROP COLUMN "isHSDir", DROP COLUMN "isNamed",
+  DROP COLUMN "isStable", DROP COLUMN "isRunning", DROP COLUMN "isUnnamed",
+  DROP COLUMN "isValid", DROP COLUMN "isV2Dir", DROP COLUMN "isV3Dir";
+
+ALTER TABLE fingerprint ADD COLUMN flags integer;
+
+update fingerprint set flags = s.flags
+  from statusentry s
+  where s.id = fingerprint.sid and s.validafter = fingerprint.last_va;
+
+-- partial indexes for the usual flag=... searches
+CREATE INDEX fingerprint_authority_idx ON fingerprint
+  USING btree (last_va DESC, fingerprint DESC) WHERE ((flags & 1) <> 0);
+CREATE INDEX fingerprint_badexit_idx ON fingerprint
+  USING btree (last_va DESC, fingerprint DESC) WHERE ((flags & 2) <> 0);
+CREATE INDEX fingerprint_exit_idx ON fingerprint
+  USING btree (last_va DESC, fingerprint DESC) WHERE ((flags & 8) <> 0);
+CREATE INDEX fingerprint_guard_idx ON fingerprint
+  USING btree (last_va DESC, fingerprint DESC) WHERE ((flags & 32) <> 0);
+
+COMMIT;
+
+ANALYZE statusentry;
+ANALYZE fingerprint;
@@ -0,0 +1,53 @@
+-- turn an existing (monolithic) statusentry into a table partitioned by
+-- month on validafter, with one partition (statusentry_YYYY_MM) per month of
+-- existing data. needs PostgreSQL >= 11. new databases are created
+-- partitioned (see db/db_create.sql); from then on, the importer creates new
+-- partitions as it needs them (see importer.ensure_partitions().)
+
+-- this rewrites all of statusentry - will take a long while, and needs as
+-- much free disk space again. stop the importer while it runs.
+
+BEGIN;
+
+ALTER TABLE statusentry RENAME TO statusentry_unpartitioned;
+ALTER INDEX statusentry_pkey RENAME TO statusentry_unpartitioned_pkey;
+ALTER INDEX statusentry_substr_validafter_idx
+  RENAME TO statusentry_unpartitioned_substr_validafter_idx;
+ALTER INDEX statusentry_validafter_idx
+  RENAME TO statusentry_unpartitioned_validafter_idx;
+
+CREATE TABLE statusentry (LIKE statusentry_unpartitioned INCLUDING DEFAULTS)
+  PARTITION BY RANGE (validafter);
+ALTER SEQUENCE statusentry_id_seq OWNED BY statusentry.id;
+
+DO $$
+DECLARE
+  month date;
+BEGIN
+  FOR month IN
+    SELECT generate_series(date_trunc('month', min(validafter)),
+      max(validafter), interval '1 month')::date
+    FROM statusentry_unpartitioned
+  LOOP
+    EXECUTE format('CREATE TABLE %I PARTITION OF statusentry '
+      'FOR VALUES FROM (%L) TO (%L)', 'statusentry_' || to_char(month,
+      'YYYY_MM'), month, (month + interval '1 month')::date);
+  END LOOP;
+END
+$$;
+
+INSERT INTO statusentry SELECT * FROM statusentry_unpartitioned;
+
+-- (indexes are built after loading, per partition)
+ALTER TABLE statusentry
+  ADD CONSTRAINT statusentry_pkey PRIMARY KEY (id, validafter);
+CREATE UNIQUE INDEX statusentry_substr_validafter_idx ON statusentry
+  USING btree (substr((fingerprint)::text, 0, 12), validafter DESC);
+CREATE INDEX statusentry_validafter_idx ON statusentry
+  USING btree (validafter);
+
+DROP TABLE statusentry_unpartitioned;
+
+COMMIT;
+
+ANALYZE statusentry;
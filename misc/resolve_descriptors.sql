@@ -0,0 +1,15 @@
+-- link the status entries of an existing database to the server descriptors
+-- already in it (statusentry.descriptor.) from then on, the importer does this
+-- as consensuses and descriptors come in, in whichever order (see
+-- importer.resolve_descriptors() and importer.backfill_descriptors().)
+
+-- needs the unique descriptor index (misc/descriptor_unique.sql.) with
+-- BINARY_FINGERPRINTS, compare statusentry.digest to
+-- decode(descriptor.descriptor, 'hex') instead.
+
+-- this reads all of statusentry once - will take a while.
+
+UPDATE statusentry SET descriptor = descriptor.descriptor
+  FROM descriptor
+  WHERE statusentry.digest = upper(descriptor.descriptor)
+    AND statusentry.descriptor IS NULL;
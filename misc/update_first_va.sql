@@ -1,6 +1,9 @@
 -- update the first_va field in the fingerprint table.
 -- when we make the final import of all the olden status entry archives,
 -- we'll only need to do this once.
+-- (the importer now merges first_va/last_va with LEAST()/GREATEST() for every
+-- consensus - see importer.merge_fingerprints() - so this is only needed for
+-- databases populated before that.)
 
 UPDATE fingerprint SET first_va = oldest.validafter
 FROM (SELECT DISTINCT ON (fingerprint) fingerprint, validafter FROM statusentry ORDER BY fingerprint, validafter ASC) AS oldest
@@ -3,6 +3,7 @@
 -- statusentry rows, we need to run this. (this shouldn't be ever run in
 -- production, with db-model-bug-free code.
 -- only putting this here for reference.)
+-- (out-of-order imports are handled by importer.merge_fingerprints() now.)
 
 -- will run for >= 1h on a simple sata 7200rpm with 6gb of memory for pgsql.)
 
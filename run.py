@@ -1,5 +1,6 @@
 from torsearch import app
 import config
 
-app.run(debug = config.DEBUG, host=config.BIND_HOST, port=config.BIND_PORT,
+# the development server: always in debug mode (config.DEBUG is for wsgi.py)
+app.run(debug = True, host=config.BIND_HOST, port=config.BIND_PORT,
   threaded=True)
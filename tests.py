@@ -2,9 +2,99 @@
 # reference and ground for unit-like tests. We use benchmark.py to inspect the
 # backend.
 # Here is more of a (useful) stub for proper unit tests, to be expanded later.
+# TestOnionooAPISearch needs a populated database; without the metrics
+# archives at hand, tools/generate_consensuses.py (with over UPPER_LIMIT
+# relays) makes one, e.g.
+#   python generate_consensuses.py --days 7 /tmp/gen
+#   python import_consensuses.py /tmp/gen/consensuses-2013-01
 
+import os
+import datetime
+import json
+import tempfile
+import shutil
+import threading
 import unittest
+from sqlalchemy import func
+from stem.descriptor.server_descriptor import RelayDescriptor
+from torsearch import app, db
 from torsearch import onionoo_api as oapi
+from torsearch import importer, benchmark, metrics
+from torsearch.cache import LRUCache, LatestConsensusCache
+from torsearch import models, fingerprints
+from torsearch.query_info import TokenBucket
+from torsearch import profiler
+from torsearch.ingest import IngestDaemon
+from torsearch.models import Presence, Consensus, StatusEntry, Fingerprint,\
+  AddressHistory
+from torsearch.snapshot import Snapshot, RunningRelay, ip_to_int
+from torsearch.bloom import BloomFilter, KnownFingerprints, known_fingerprints
+
+# a few made-up relays in a few consensuses from long before the real ones,
+# imported out of order (see TestOutOfOrderImport.)
+HOUR = datetime.timedelta(hours=1)
+T0 = datetime.datetime(2001, 1, 1, 0, 0, 0)
+TEST_VALID_AFTERS = [T0 + HOUR * i for i in range(4)]
+TEST_IMPORT_ORDER = [3, 0, 2, 1] # (hours)
+TEST_RELAYS = { # fingerprint => hours present in the consensus
+  '0000000001' + 'F' * 30: [0, 1, 3],
+  '0000000002' + 'F' * 30: [0, 1, 2, 3],
+  '0000000003' + 'F' * 30: [2, 3],
+  '0000000004' + 'F' * 30: [3],
+  '0000000005' + 'F' * 30: [1, 2]}
+
+def make_status_row(fingerprint, hour):
+  values = {'validafter': T0 + HOUR * hour, 'fingerprint': fingerprint,
+    'nickname': 'tstrelay%s%d' % (fingerprint[9], hour), # (changes hourly)
+    'published': T0 + HOUR * hour - datetime.timedelta(minutes=30),
+    'address': '10.0.%s.%d' % (fingerprint[9], hour), 'or_port': 9001,
+    'dir_port': 0, 'digest': '%040X' % (int(fingerprint[:10]) * 100 + hour),
+    'flags': models.flags_to_bits(['Fast', 'Running', 'Valid'])}
+  return tuple(values.get(col) for col in StatusEntry.copy_columns())
+
+def import_test_consensus(hour):
+  valid_after = T0 + HOUR * hour
+  consensus = {'valid_after': valid_after,
+    'fresh_until': valid_after + HOUR, 'valid_until': valid_after + 3 * HOUR}
+  rows = [make_status_row(fp, hour) for fp, hours in
+    sorted(TEST_RELAYS.iteritems()) if hour in hours]
+  return importer.import_consensus_rows(consensus, rows)
+
+def delete_test_consensuses():
+  fps = TEST_RELAYS.keys()
+  db.session.rollback()
+  for model, column in ((StatusEntry, StatusEntry.fingerprint),
+      (Fingerprint, Fingerprint.fingerprint), (Presence, Presence.fingerprint),
+      (AddressHistory, AddressHistory.fingerprint)):
+    model.query.filter(column.in_(fps)).delete(synchronize_session=False)
+  Consensus.query.filter(Consensus.valid_after.in_(TEST_VALID_AFTERS))\
+    .delete(synchronize_session=False)
+  db.session.commit()
+  # (and the partitions the importer made for them)
+  if importer.statusentry_partitioned():
+    for months_later in (0, 1):
+      name = importer.partition_name(importer.month_start(T0, months_later))
+      db.session.execute('DROP TABLE IF EXISTS %s' % name)
+      importer._partitions_created.discard(name)
+    db.session.commit()
+
+# the tests run against the configured database: they keep the test
+# consensuses to themselves (no NOTIFYs to the API processes) and use a
+# fingerprint filter file of their own, not BLOOM_FILE.
+module_state = {}
+
+def setUpModule():
+  module_state['notify'] = importer.notify_new_consensus
+  module_state['bloom_path'] = known_fingerprints.path
+  module_state['tmp_dir'] = tempfile.mkdtemp()
+  importer.notify_new_consensus = lambda valid_after: None
+  known_fingerprints.path = os.path.join(module_state['tmp_dir'],
+    'fingerprints.bloom')
+
+def tearDownModule():
+  importer.notify_new_consensus = module_state['notify']
+  known_fingerprints.path = module_state['bloom_path']
+  shutil.rmtree(module_state['tmp_dir'])
 
 class TestOnionooAPISearch(unittest.TestCase):
   def setUp(self):
@@ -26,5 +116,416 @@ class TestOnionooAPISearch(unittest.TestCase):
           self.fingerprints.append(r)
       self.assertTrue(last_count < len(self.fingerprints))
 
+  def test_cursor_round_trip(self):
+    va = datetime.datetime(2013, 4, 1, 12, 0, 0)
+    fp = '9695DFC35FFEB861329B9F1AB04C46397020CE31'
+    self.assertEqual(oapi.decode_cursor(oapi.encode_cursor(va, fp)), (va, fp))
+    self.assertEqual(oapi.decode_cursor('garbage'), None)
+
+  def test_uptime_fraction(self):
+    day = datetime.datetime(2013, 4, 1)
+    hours = lambda n: datetime.timedelta(hours=n)
+    # present in consensuses 00:00..05:00 and 18:00..23:00 (12 of 24 hours),
+    # each interval partly outside the queried [03:00, 21:00)
+    intervals = [Presence(start_va=day + hours(18), end_va=day + hours(23)),
+      Presence(start_va=day, end_va=day + hours(5))]
+    self.assertEqual(oapi.uptime_fraction(intervals, day, day + hours(24)),
+      0.5)
+    self.assertEqual(oapi.uptime_fraction(intervals, day + hours(3),
+      day + hours(21)), 6.0 / 18)
+    self.assertEqual(oapi.uptime_fraction([], day, day), None)
+
+  def test_address_ranges(self):
+    self.assertEqual(oapi.address_ranges('10.1.'),
+      [('10.1.0.0', '10.1.255.255')])
+    self.assertEqual(oapi.address_ranges('10.1.2.3/16'),
+      [('10.1.0.0', '10.1.255.255')])
+    self.assertEqual(oapi.address_ranges('200.2'),
+      [('200.2.0.0', '200.2.255.255'), ('200.20.0.0', '200.29.255.255'),
+       ('200.200.0.0', '200.255.255.255')])
+    self.assertEqual(oapi.address_ranges('1.2.3.300'), None)
+
+  def test_fuzzy_search(self):
+    if not oapi.trgm_available():
+      self.skipTest('pg_trgm is not installed')
+    consensus, results = oapi.get_results(args={'search': 'moria1x',
+      'search_mode': 'fuzzy'})
+    self.assertEqual(list(results)[0].nickname.lower(), 'moria1')
+
+  def test_fuzzy_search_without_pg_trgm(self):
+    installed, oapi.trgm_installed = oapi.trgm_installed, False
+    try:
+      client = app.test_client()
+      for endpoint in ('/summary', '/details'):
+        response = client.get(endpoint + '?search=moria1&search_mode=fuzzy')
+        self.assertEqual(response.status_code, 400)
+      response = client.get('/summary?search=moria1&search_mode=substring')
+      self.assertEqual(response.status_code, 200)
+    finally:
+      oapi.trgm_installed = installed
+
+class TestOutOfOrderImport(unittest.TestCase):
+  # (needs a database, like TestOnionooAPISearch; the test consensuses are
+  # deleted again afterwards)
+  def setUp(self):
+    delete_test_consensuses() # (left over from an interrupted run, maybe)
+    for hour in TEST_IMPORT_ORDER:
+      self.assertTrue(import_test_consensus(hour))
+
+  def tearDown(self):
+    delete_test_consensuses()
+
+  def test_fingerprint_first_last_seen(self):
+    for fp, hours in TEST_RELAYS.iteritems():
+      relay = Fingerprint.query.filter(Fingerprint.fingerprint == fp).one()
+      last = StatusEntry.query.filter(StatusEntry.fingerprint == fp)\
+        .filter(StatusEntry.validafter == T0 + HOUR * max(hours)).one()
+      self.assertEqual(relay.first_va, T0 + HOUR * min(hours))
+      self.assertEqual(relay.last_va, T0 + HOUR * max(hours))
+      # the rest is that of the latest status entry, not the latest imported
+      self.assertEqual(relay.sid, last.id)
+      self.assertEqual((relay.nickname, relay.address, relay.digest),
+        (last.nickname, last.address, last.digest))
+
+  def test_unchecked_merge_keeps_sid(self):
+    fp = '0000000001' + 'F' * 30 # (hours 0, 1 and 3)
+    importer.merge_fingerprints(T0, upsert_check_va=False)
+    relay = Fingerprint.query.filter(Fingerprint.fingerprint == fp).one()
+    self.assertEqual(relay.last_va, T0 + HOUR * 3)
+    self.assertEqual(relay.nickname, 'tstrelay10') # (overwritten)
+    sid_va = db.session.query(StatusEntry.validafter)\
+      .filter(StatusEntry.id == relay.sid).scalar()
+    self.assertEqual(sid_va, relay.last_va)
+
+  def test_presence_intervals(self):
+    # e.g. 0000000002 was present throughout: 00:00 and 03:00 make two
+    # intervals, 02:00 extends one backward, 01:00 fills the gap (merging)
+    for fp, hours in TEST_RELAYS.iteritems():
+      runs = [] # runs of consecutive hours
+      for hour in hours:
+        if runs and runs[-1][-1] == hour - 1:
+          runs[-1].append(hour)
+        else:
+          runs.append([hour])
+      expected = [(T0 + HOUR * run[0], T0 + HOUR * run[-1],
+        make_status_row(fp, run[-1])) for run in runs]
+      intervals = Presence.query.filter(Presence.fingerprint == fp)\
+        .order_by(Presence.start_va).all()
+      columns = StatusEntry.copy_columns()
+      self.assertEqual([(i.start_va, i.end_va, i.nickname, i.address)
+        for i in intervals], [(start, end, row[columns.index('nickname')],
+          row[columns.index('address')]) for start, end, row in expected])
+
+  def test_cursor_paging(self):
+    # four of the relays were last seen in the same consensus: pages split
+    # between them must neither repeat nor skip any (ties go by fingerprint)
+    expected = sorted(TEST_RELAYS, key=lambda fp:
+      (max(TEST_RELAYS[fp]), fp), reverse=True)
+    for limit in range(1, len(TEST_RELAYS) + 1):
+      seen = []
+      args = {'search': 'tstrelay', 'limit': str(limit)}
+      while True:
+        consensus, results = oapi.get_results(args=args)
+        results = list(results)
+        seen.extend(r.fingerprint for r in results)
+        cursor = oapi.next_cursor(results, args)
+        if not cursor:
+          break
+        args = dict(args, cursor=cursor)
+      self.assertEqual(seen, expected)
+
+  def test_condensed_statuses_paging(self):
+    fp = '0000000001' + 'F' * 30 # present at 00:00, 01:00 and 03:00
+    client = app.test_client()
+    url = '/statuses?condensed=true&limit=1&lookup=' + fp
+    ranges = []
+    while url and len(ranges) < 10: # (a cursor which doesn't move on)
+      response = json.loads(client.get(url).data)
+      ranges.extend((r['valid_after_from'], r['valid_after_to'])
+        for r in response['ranges'])
+      url = '/statuses?condensed=true&limit=1&lookup=%s&cursor=%s' % (fp,
+        response['next']) if 'next' in response else None
+    self.assertEqual(ranges, [('2001-01-01 03:00:00', '2001-01-01 03:00:00'),
+      ('2001-01-01 00:00:00', '2001-01-01 01:00:00')])
+
+  def test_presence_ranges(self):
+    # the ranges from the presence table are those of the status entries,
+    # including where from..to cuts into them
+    variants = [{}, {'from': '2001-01-01 00:30:00'},
+      {'to': '2001-01-01 01:30:00'},
+      {'from': '2001-01-01 01:00:00', 'to': '2001-01-01 03:00:00'},
+      {'limit': '1', 'offset': '1'},
+      {'cursor': oapi.encode_cursor(T0 + HOUR * 3, '0' * 40)}]
+    for fp in TEST_RELAYS:
+      for args in variants:
+        args = dict(args, lookup=fp)
+        self.assertEqual(map(tuple, oapi.presence_ranges(fp, args)),
+          map(tuple, oapi.entry_ranges(fp, args)), args)
+
+class TestBulkImport(unittest.TestCase):
+  def test_copy_value(self):
+    self.assertEqual(importer.copy_value(None), '\\N')
+    self.assertEqual(importer.copy_value(True), 't')
+    self.assertEqual(importer.copy_value(False), 'f')
+    self.assertEqual(importer.copy_value(9001), '9001')
+    self.assertEqual(importer.copy_value(
+      datetime.datetime(2013, 4, 1, 12, 0, 0)), '2013-04-01 12:00:00')
+    self.assertEqual(importer.copy_value('Tor 0.2.4\tx\\y\n'),
+      'Tor 0.2.4\\tx\\\\y\\n')
+    self.assertEqual(importer.copy_bytes_value('a\xfe'), '\\\\x61fe')
+
+  def test_descriptor_row(self):
+    desc = RelayDescriptor('router moria1 128.31.0.34 9101 0 9131\n'
+      'platform Tor 0.2.4.10-alpha on Linux\n'
+      'published 2013-04-01 12:00:00\n'
+      'bandwidth 512000 1024000 300000\n'
+      'reject *:*\n', validate=False)
+    desc._path = '/data/server-descriptors-2013-04/a/b/ab0123'
+    row = dict(zip(models.Descriptor.copy_columns(),
+      models.Descriptor.row_from_stem(desc)))
+    self.assertEqual(row['descriptor'], 'ab0123')
+    self.assertEqual(row['nickname'], 'moria1')
+    self.assertEqual(row['dir_port'], 9131)
+    self.assertEqual(row['observed_bandwidth'], 300000)
+    self.assertEqual(row['exit_policy'], 'reject 1-65535')
+    self.assertEqual(row['is_bridge'], False)
+    self.assertEqual(row['contact'], None)
+
+class TestDetails(unittest.TestCase):
+  def test_exit_policy_summary(self):
+    self.assertEqual(oapi.exit_policy_summary('accept 80, 443, 6660-6669'),
+      {'accept': ['80', '443', '6660-6669']})
+    self.assertEqual(oapi.exit_policy_summary('reject 1-65535'),
+      {'reject': ['1-65535']})
+
+  def test_descriptor_fields(self):
+    consensus, results = oapi.get_results('details', args={'limit': '50'})
+    for relay in results:
+      # (the descriptor columns are there, NULL or not)
+      self.assertTrue(hasattr(relay, 'platform'))
+      self.assertTrue(hasattr(relay, 'exit_policy'))
+
+class TestIngest(unittest.TestCase):
+  def test_skips_temporary_and_fresh_files(self):
+    watch_dir = tempfile.mkdtemp()
+    try:
+      daemon = IngestDaemon(watch_dir, settle=60, use_inotify=False)
+      daemon.running = True
+      paths = [os.path.join(watch_dir, name) for name in
+        ('.2013-04-01-12-00-00-consensus.Xy12ab', # rsync, mid-transfer
+         '2013-04-01-12-00-00-consensus')]
+      for path in paths:
+        open(path, 'w').close()
+      daemon.import_files(paths)
+      self.assertTrue(daemon.rescan_due) # (left for later)
+      self.assertEqual(daemon.processed, {})
+    finally:
+      shutil.rmtree(watch_dir)
+
+class TestSnapshot(unittest.TestCase):
+  def test_indexes(self):
+    va = datetime.datetime(2013, 4, 1, 12, 0, 0)
+    relay = lambda fp, nickname, address: RunningRelay(*([nickname, fp, va,
+      va, address] + [None] * 10))
+    snapshot = Snapshot(va, [relay('B' * 40, 'moria1', '128.31.0.34'),
+      relay('A' * 40, 'Moria2', '128.31.0.39'),
+      relay('C' * 40, 'gabelmoo', '131.188.40.189')],
+      [(ip_to_int('128.31.0.34'), 'B' * 40), (ip_to_int('128.31.0.39'),
+        'A' * 40), (ip_to_int('10.0.0.1'), 'D' * 40)]) # (D isn't running)
+    rows = lambda found: sorted(snapshot.rows[i].nickname for i in found)
+    self.assertEqual(rows(snapshot.lookup('C' * 40)), ['gabelmoo'])
+    self.assertEqual(rows(snapshot.fingerprint_prefix('AA')), ['Moria2'])
+    self.assertEqual(rows(snapshot.nickname_prefix('MOR')),
+      ['Moria2', 'moria1'])
+    self.assertEqual(rows(snapshot.nickname_substring('elm')), ['gabelmoo'])
+    self.assertEqual(rows(snapshot.address_ranges(
+      oapi.address_ranges('128.31.0.'))), ['Moria2', 'moria1'])
+
+class TestBloomFilter(unittest.TestCase):
+  def test_no_false_negatives_and_round_trip(self):
+    bloom = BloomFilter.for_capacity(1000, 0.01)
+    fps = ['%040X' % (i * 7919) for i in range(1000)]
+    for fp in fps:
+      bloom.add(fp)
+    bloom.add(fps[0]) # (repeats aren't counted)
+    self.assertEqual(bloom.count, 1000)
+    self.assertTrue(all(fp in bloom for fp in fps))
+    others = sum('%040X' % (i * 7919 + 1) in bloom for i in range(1000))
+    self.assertTrue(others < 50)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmp_dir, 'fingerprints.bloom')
+      bloom.save(path, 4321)
+      loaded, high_water = BloomFilter.load(path)
+      self.assertEqual(high_water, 4321)
+      self.assertEqual((loaded.bits, loaded.hashes, loaded.count, loaded.data),
+        (bloom.bits, bloom.hashes, bloom.count, bloom.data))
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def test_union(self):
+    a, b = BloomFilter(1000, 3), BloomFilter(1000, 3)
+    a.add('A' * 40)
+    b.add('B' * 40)
+    a.union(b)
+    self.assertTrue('A' * 40 in a and 'B' * 40 in a)
+    self.assertEqual(len(a.data), len(b.data))
+
+class TestKnownFingerprints(unittest.TestCase):
+  '''the fingerprint filter, with consensuses imported out of order and two
+  importers saving it at once.
+  '''
+
+  def setUp(self):
+    delete_test_consensuses()
+    self.tmp_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp_dir, 'fingerprints.bloom')
+
+  def tearDown(self):
+    delete_test_consensuses()
+    shutil.rmtree(self.tmp_dir)
+
+  def test_out_of_order_and_concurrent_imports(self):
+    fp = '0000000005' + 'F' * 30 # (only in hours 1 and 2)
+    unknown = '0000000006' + 'F' * 30
+    import_test_consensus(3)
+    api = KnownFingerprints(self.path, capacity=1000)
+    api.refresh()
+    self.assertFalse(api.might_exist(fp))
+    self.assertFalse(api.might_exist(unknown))
+
+    # (say, a batch import next to the ingest daemon)
+    importers = [KnownFingerprints(self.path, capacity=1000) for i in range(2)]
+    def save(known):
+      for i in range(10):
+        known.save()
+      db.session.remove()
+    threads = [threading.Thread(target=save, args=(known,))
+      for known in importers]
+    for thread in threads:
+      thread.start()
+    for hour in (0, 2, 1):
+      import_test_consensus(hour)
+    for thread in threads:
+      thread.join()
+    importers[0].save()
+
+    self.assertFalse(api.might_exist(fp)) # (misses make no query)
+    api.refresh() # (as the importer's NOTIFY makes it)
+    self.assertTrue(api.might_exist(fp))
+    self.assertFalse(api.might_exist(unknown))
+    bloom, high_water = BloomFilter.load(self.path)
+    self.assertEqual(high_water,
+      db.session.query(func.max(Fingerprint.seq)).scalar())
+    missing = [f for f, in db.session.query(Fingerprint.fingerprint)
+      if f.upper() not in bloom]
+    self.assertEqual(missing, [])
+
+  def test_failed_save(self):
+    known = KnownFingerprints(os.path.join(self.tmp_dir, 'nowhere', 'f.bloom'),
+      capacity=1000)
+    known.save() # (logged, not raised)
+    self.assertFalse(os.path.exists(known.path))
+
+class TestLatestConsensusCache(unittest.TestCase):
+  def test_listeners(self):
+    cache = LatestConsensusCache()
+    changes, refreshes = [], []
+    cache.add_listener(changes.append)
+    cache.add_listener(refreshes.append, every_refresh=True)
+    cache.refresh()
+    cache.refresh()
+    self.assertEqual(len(changes), 1)
+    self.assertEqual(len(refreshes), 2)
+    self.assertEqual(refreshes[0], refreshes[1])
+
+class TestFingerprints(unittest.TestCase):
+  def test_hex_bytes_round_trip(self):
+    fp = '9695DFC35FFEB861329B9F1AB04C46397020CE31'
+    hex_bytes = fingerprints.HexBytes()
+    value = hex_bytes.process_bind_param(fp.lower(), None)
+    self.assertEqual(len(value), 20)
+    self.assertEqual(hex_bytes.process_result_value(value, None), fp)
+    self.assertEqual(importer.copy_hex_value(fp), '\\\\x' + fp)
+    self.assertEqual(importer.copy_hex_value(None), '\\N')
+
+  def test_valid_fingerprint(self):
+    self.assertTrue(oapi.valid_fingerprint(
+      '9695DFC35FFEB861329B9F1AB04C46397020CE31'))
+    self.assertFalse(oapi.valid_fingerprint(
+      '9695DFC35FFEB861329B9F1AB04C46397020CE3Z'))
+    self.assertFalse(oapi.valid_fingerprint('9695DFC35FFEB861'))
+
+class TestFlagBits(unittest.TestCase):
+  def test_flags_round_trip(self):
+    bits = models.flags_to_bits(['Exit', 'guard', 'NoSuchFlag'])
+    self.assertEqual(bits,
+      models.FLAG_BITS['Exit'] | models.FLAG_BITS['Guard'])
+    self.assertEqual(models.bits_to_flags(bits), ['Exit', 'Guard'])
+    self.assertEqual(models.flags_to_bits([]), 0)
+
+class TestBenchmark(unittest.TestCase):
+  def test_percentile(self):
+    self.assertEqual(benchmark.percentile([3, 1, 2, 4], 50), 2.5)
+    self.assertEqual(benchmark.percentile([1, 2, 3, 4, 5], 99), 4.96)
+    self.assertEqual(benchmark.percentile([7], 95), 7)
+    self.assertEqual(benchmark.percentile([], 50), None)
+
+  def test_explain_buffers(self):
+    info = [('Limit  (cost=0.29..16.34 rows=2 width=259)',),
+      ('  Buffers: shared hit=12 read=3 dirtied=1',),
+      ('        Buffers: shared hit=4',)]
+    self.assertEqual(benchmark.explain_buffers(info), {'hit': 12, 'read': 3})
+    self.assertEqual(benchmark.explain_buffers(info[:1]), None)
+
+class TestMetrics(unittest.TestCase):
+  def test_histogram(self):
+    h = metrics.Histogram('t_seconds', 'test', ('endpoint',),
+      buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+      h.observe(value, ('summary',))
+    lines = h.render()
+    self.assertTrue('t_seconds_bucket{endpoint="summary",le="0.1"} 1' in lines)
+    self.assertTrue('t_seconds_bucket{endpoint="summary",le="1.0"} 2' in lines)
+    self.assertTrue('t_seconds_bucket{endpoint="summary",le="+Inf"} 3' in
+      lines)
+    self.assertTrue('t_seconds_count{endpoint="summary"} 3' in lines)
+
+  def test_query_class(self):
+    self.assertEqual(oapi.query_class({'search': 'moria1'}), 'nickname')
+    self.assertEqual(oapi.query_class({'search': '86.59.'}), 'address')
+    self.assertEqual(oapi.query_class({'search': '$9695DFC3'}),
+      'fingerprint')
+    self.assertEqual(oapi.query_class({'running': 'true'}), 'running')
+
+class TestTokenBucket(unittest.TestCase):
+  def test_token_bucket(self):
+    bucket = TokenBucket(2) # per minute
+    self.assertTrue(bucket.take())
+    self.assertTrue(bucket.take())
+    self.assertFalse(bucket.take()) # (refills at one per 30 seconds)
+
+class TestProfiler(unittest.TestCase):
+  def test_profile_filenames(self):
+    a = profiler.profile_filename('summary', 'nickname')
+    b = profiler.profile_filename('summary', 'nickname')
+    self.assertNotEqual(a, b)
+    self.assertEqual(profiler.parse_filename('/tmp/' + a),
+      ('summary', 'nickname'))
+    self.assertEqual(profiler.parse_filename('profiler_output.log'), None)
+
+class TestLRUCache(unittest.TestCase):
+  def test_eviction_and_counters(self):
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    self.assertEqual(cache.get('a'), 1) # 'b' is now least recently used
+    cache.put('c', 3)
+    self.assertEqual(cache.get('b'), None)
+    self.assertEqual(cache.get('c'), 3)
+    self.assertEqual(cache.stats()['hits'], 2)
+    self.assertEqual(cache.stats()['misses'], 1)
+    self.assertEqual(cache.stats()['evictions'], 1)
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Generate synthetic (but realistic-looking) hourly consensus documents
+
+for testing and benchmarking torsearch without the metrics archives. The
+documents are written in the metrics archive layout,
+
+  <output dir>/consensuses-YYYY-MM/DD/YYYY-MM-DD-HH-00-00-consensus
+
+so they can be imported as usual (import_consensuses.py, or
+import_year_of_consensuses.sh.) Relays come and go (churn), some retire for
+good and are replaced by new ones, some share nicknames (collisions), and
+some change their addresses. The directory authorities are in there as
+themselves (moria1, gabelmoo, Faravahar, ...), always running. The same seed
+always makes the same documents.
+
+usage: generate_consensuses.py [options] <output dir>
+(see generate_consensuses.py --help)
+'''
+
+import os
+import sys
+import base64
+import hashlib
+import random
+import argparse
+import datetime
+
+HOUR = datetime.timedelta(hours=1)
+REPUBLISH_INTERVAL = datetime.timedelta(hours=18) # descriptor lifetime
+
+# (nickname, fingerprint, address, or_port, dir_port)
+AUTHORITIES = [
+  ('moria1', '9695DFC35FFEB861329B9F1AB04C46397020CE31', '128.31.0.34',
+    9101, 9131),
+  ('tor26', '847B1F850344D7876491A54892F904934E4EB85D', '86.59.21.38', 443,
+    80),
+  ('dizum', '7EA6EAD6FD83083C538F44038BBFA077587DD755', '194.109.206.212',
+    443, 80),
+  ('gabelmoo', 'F2044413DAC2E02E3D6BCF4735A19BCA1DE97281', '212.112.245.170',
+    443, 80),
+  ('dannenberg', '7BE683E65D48141321C5ED92F075C55364AC7123',
+    '193.23.244.244', 443, 80),
+  ('maatuska', 'BD6A829255CB08E66FBE7D3748363586E46B3810', '171.25.193.9', 80,
+    443),
+  ('Faravahar', 'CF6D0AAFB385BE71B8E111FC5CFF4B47923733BC', '154.35.32.5',
+    443, 80),
+  ('urras', '80AAF8D5956A43C197104CEF2550CD42D165C6FB', '208.83.223.34', 80,
+    443),
+]
+
+KNOWN_FLAGS = ['Authority', 'BadExit', 'Exit', 'Fast', 'Guard', 'HSDir',
+  'Named', 'Running', 'Stable', 'Unnamed', 'V2Dir', 'Valid']
+
+# popular default-ish nicknames which many (unrelated) relays end up using
+COMMON_NICKNAMES = ['Unnamed', 'default', 'ididnteditheconfig', 'tor',
+  'relay', 'torrelay', 'myrelay', 'Tor']
+
+SYLLABLES = ['ka', 'ri', 'mo', 'ne', 'tor', 'lu', 'za', 'fi', 'gon', 'bel',
+  'ox', 'qua', 'sen', 'dra', 'vi', 'pel', 'mar', 'tek', 'noi', 'ush']
+
+VERSIONS = ['0.2.2.35', '0.2.2.37', '0.2.3.22-rc', '0.2.3.25', '0.2.4.10-alpha',
+  '0.2.4.20', '0.2.4.21', '0.2.5.3-alpha']
+
+EXIT_POLICIES = ['accept 80,443', 'accept 20-23,43,53,79-81,88,110,143,443',
+  'accept 1-65535', 'reject 25,119,135-139,445,563,1214,4661-4666,6346-6429']
+
+def b64(raw):
+  return base64.b64encode(raw).rstrip('=')
+
+class Relay(object):
+  def __init__(self, rnd, nickname, fingerprint, address, or_port, dir_port,
+      authority=False):
+    self.nickname = nickname
+    self.identity = fingerprint.decode('hex')
+    self.address = address
+    self.or_port = or_port
+    self.dir_port = dir_port
+    self.authority = authority
+    self.running = True
+    self.up_since = None
+    self.published = None
+    self.digest = None
+    self.version = rnd.choice(VERSIONS)
+    self.bandwidth = int(rnd.lognormvariate(5, 2)) + 1
+    self.exit_policy = rnd.choice(EXIT_POLICIES) if \
+      rnd.random() < 0.2 else 'reject 1-65535'
+    self.named = not authority and rnd.random() < 0.3
+    self.bad_exit = rnd.random() < 0.005
+
+  def republish(self, rnd, valid_after):
+    '''a new descriptor, published some time in the last hour or two.
+    '''
+
+    self.published = valid_after - datetime.timedelta(
+      seconds=rnd.randint(60, 7200))
+    self.digest = ''.join(chr(rnd.getrandbits(8)) for _ in range(20))
+    if rnd.random() < 0.02: # upgrades
+      self.version = rnd.choice(VERSIONS)
+
+  def flags(self, valid_after, hsdir):
+    uptime = valid_after - self.up_since
+    flags = ['Running', 'Valid']
+    if self.authority:
+      flags.append('Authority')
+    if self.bandwidth > 20:
+      flags.append('Fast')
+    stable = uptime > datetime.timedelta(days=1)
+    if stable:
+      flags.append('Stable')
+    if stable and self.bandwidth > 250:
+      flags.append('Guard')
+    if self.exit_policy.startswith('accept'):
+      flags.append('Exit')
+      if self.bad_exit:
+        flags.append('BadExit')
+    if hsdir and uptime > datetime.timedelta(hours=25):
+      flags.append('HSDir')
+    if self.dir_port:
+      flags.append('V2Dir')
+    return sorted(flags)
+
+  def entry(self, valid_after, named):
+    flags = self.flags(valid_after, hsdir=self.identity[0] < '\x80')
+    if named:
+      flags = sorted(flags + ['Named'])
+    return ('r %s %s %s %s %s %d %d\n' % (self.nickname, b64(self.identity),
+        b64(self.digest), self.published.strftime('%Y-%m-%d %H:%M:%S'),
+        self.address, self.or_port, self.dir_port) +
+      's %s\n' % ' '.join(flags) +
+      'v Tor %s\n' % self.version +
+      'w Bandwidth=%d\n' % self.bandwidth +
+      'p %s\n' % self.exit_policy)
+
+class Network(object):
+  '''the simulated relay population.
+  '''
+
+  def __init__(self, args):
+    self.args = args
+    self.rnd = random.Random(args.seed)
+    self.relays = [Relay(self.rnd, *authority, authority=True)
+      for authority in AUTHORITIES]
+    self.relays += [self.new_relay() for _ in range(args.relays)]
+
+  def random_address(self):
+    return '%d.%d.%d.%d' % (self.rnd.randint(1, 223), self.rnd.randint(0, 255),
+      self.rnd.randint(0, 255), self.rnd.randint(1, 254))
+
+  def random_nickname(self):
+    if self.rnd.random() < self.args.collisions:
+      return self.rnd.choice(COMMON_NICKNAMES)
+    name = ''.join(self.rnd.choice(SYLLABLES)
+      for _ in range(self.rnd.randint(2, 4)))
+    if self.rnd.random() < 0.3:
+      name += str(self.rnd.randint(1, 99))
+    return name[:19]
+
+  def new_relay(self):
+    fingerprint = ''.join(chr(self.rnd.getrandbits(8))
+      for _ in range(20)).encode('hex').upper()
+    dir_port = self.rnd.choice([0, 0, 80, 9030])
+    return Relay(self.rnd, self.random_nickname(), fingerprint,
+      self.random_address(), self.rnd.choice([443, 9001, 9001, 8080]),
+      dir_port)
+
+  def step(self, valid_after):
+    '''advance the network to valid_after (an hour after the last step.)
+    '''
+
+    args = self.args
+    for n, relay in enumerate(self.relays):
+      if relay.authority:
+        pass
+      elif relay.running and self.rnd.random() < args.churn:
+        relay.running = False
+      elif not relay.running and self.rnd.random() < args.retire:
+        self.relays[n] = relay = self.new_relay() # gone for good; a new one
+      elif not relay.running and self.rnd.random() < args.rejoin:
+        relay.running = True
+        relay.up_since = None
+      if relay.running and self.rnd.random() < args.address_changes:
+        if self.rnd.random() < 0.5: # same /16, e.g. a dynamic IP
+          relay.address = '.'.join(relay.address.split('.')[:2] +
+            [str(self.rnd.randint(0, 255)), str(self.rnd.randint(1, 254))])
+        else:
+          relay.address = self.random_address()
+        relay.republish(self.rnd, valid_after)
+      if relay.running and (relay.up_since is None or relay.published is None
+          or valid_after - relay.published > REPUBLISH_INTERVAL):
+        relay.republish(self.rnd, valid_after)
+      if relay.running and relay.up_since is None:
+        relay.up_since = valid_after
+
+  def consensus(self, valid_after):
+    running = sorted((r for r in self.relays if r.running),
+      key=lambda r: r.identity)
+    # a nickname is only Named if a single relay (that wants it) uses it
+    counts = {}
+    for relay in running:
+      counts[relay.nickname.lower()] = counts.get(relay.nickname.lower(), 0) + 1
+    parts = [header(valid_after)]
+    for relay in running:
+      parts.append(relay.entry(valid_after,
+        relay.named and counts[relay.nickname.lower()] == 1))
+    parts.append(footer(self.rnd))
+    return ''.join(parts)
+
+def header(valid_after):
+  lines = ['@type network-status-consensus-3 1.0',
+    'network-status-version 3',
+    'vote-status consensus',
+    'consensus-method 12',
+    'valid-after %s' % valid_after.strftime('%Y-%m-%d %H:%M:%S'),
+    'fresh-until %s' % (valid_after + HOUR).strftime('%Y-%m-%d %H:%M:%S'),
+    'valid-until %s' % (valid_after + 3 * HOUR).strftime('%Y-%m-%d %H:%M:%S'),
+    'voting-delay 300 300',
+    'client-versions %s' % ','.join(VERSIONS),
+    'server-versions %s' % ','.join(VERSIONS),
+    'known-flags %s' % ' '.join(KNOWN_FLAGS),
+    'params CircuitPriorityHalflifeMsec=30000']
+  for nickname, fingerprint, address, or_port, dir_port in AUTHORITIES:
+    lines += ['dir-source %s %s %s %s %d %d' % (nickname, fingerprint,
+      address, address, dir_port, or_port),
+      'contact %s operators' % nickname,
+      'vote-digest %s' % hashlib.sha1(nickname + str(valid_after))\
+        .hexdigest().upper()]
+  return '\n'.join(lines) + '\n'
+
+def footer(rnd):
+  lines = ['directory-footer',
+    'bandwidth-weights Wbd=3335 Wbe=0 Wbg=3536 Wbm=10000 Wdb=10000 Web=10000 '
+    'Wed=3329 Wee=10000 Weg=3329 Wem=10000 Wgb=10000 Wgd=3335 Wgg=6464 '
+    'Wgm=6464 Wmb=10000 Wmd=3335 Wme=0 Wmg=3536 Wmm=10000']
+  for nickname, fingerprint, _, _, _ in AUTHORITIES:
+    signature = base64.b64encode(''.join(chr(rnd.getrandbits(8))
+      for _ in range(128))) # (not a real one, obviously)
+    lines += ['directory-signature %s %s' % (fingerprint,
+      ''.join(chr(rnd.getrandbits(8)) for _ in range(20)).encode('hex')
+        .upper()),
+      '-----BEGIN SIGNATURE-----'] + \
+      [signature[i:i+64] for i in range(0, len(signature), 64)] + \
+      ['-----END SIGNATURE-----']
+  return '\n'.join(lines) + '\n'
+
+def consensus_path(output_dir, valid_after):
+  return os.path.join(output_dir, valid_after.strftime('consensuses-%Y-%m'),
+    valid_after.strftime('%d'),
+    valid_after.strftime('%Y-%m-%d-%H-%M-%S-consensus'))
+
+def generate(args):
+  network = Network(args)
+  valid_after = datetime.datetime.strptime(args.start, '%Y-%m-%d')
+  end = valid_after + datetime.timedelta(days=args.days)
+  written = 0
+  while valid_after < end:
+    network.step(valid_after)
+    # the archives are missing the odd consensus, too
+    if network.rnd.random() >= args.missing:
+      path = consensus_path(args.output_dir, valid_after)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as f:
+        f.write(network.consensus(valid_after))
+      written += 1
+      if written % 100 == 0:
+        print 'Wrote %d consensuses (up to %s)' % (written, valid_after)
+    valid_after += HOUR
+  print 'Wrote %d consensuses to %s' % (written, args.output_dir)
+  return written
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+    description='generate synthetic hourly consensus documents')
+  parser.add_argument('output_dir')
+  parser.add_argument('--start', default='2013-01-01',
+    help='first valid-after date, YYYY-MM-DD (default: %(default)s)')
+  parser.add_argument('--days', type=int, default=30,
+    help='days of hourly consensuses (default: %(default)s)')
+  parser.add_argument('--relays', type=int, default=3000,
+    help='relay population, besides the authorities (default: %(default)s)')
+  parser.add_argument('--churn', type=float, default=0.02,
+    help='chance per hour that a running relay goes away (default: '
+      '%(default)s)')
+  parser.add_argument('--rejoin', type=float, default=0.2,
+    help='chance per hour that a relay which went away comes back '
+      '(default: %(default)s)')
+  parser.add_argument('--retire', type=float, default=0.005,
+    help='chance per hour that a relay which went away is replaced by a '
+      'new one, for good (default: %(default)s)')
+  parser.add_argument('--collisions', type=float, default=0.05,
+    help='share of new relays using a common nickname (default: '
+      '%(default)s)')
+  parser.add_argument('--address-changes', type=float, default=0.002,
+    help='chance per hour that a relay changes its address (default: '
+      '%(default)s)')
+  parser.add_argument('--missing', type=float, default=0.005,
+    help='share of consensuses missing from the archive (default: '
+      '%(default)s)')
+  parser.add_argument('--seed', type=int, default=0,
+    help='random seed (default: %(default)s)')
+  generate(parser.parse_args(argv[1:]))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -4,16 +4,20 @@
 '''A simple independent script for importing our consensus documents
 
 (including status entries)
+
+usage: import_consensuses.py [path] [number of parse workers]
 '''
 
 import sys
 sys.path.append('..')
 from torsearch.importer import batch_import_consensuses
+from config import IMPORT_WORKERS
 
 def main(args):
   path = args[1] if len(args) > 1 else \
     '/home/kostas/priv/tordev/data/consensuses-2013-04'
-  batch_import_consensuses(path)
+  workers = int(args[2]) if len(args) > 2 else IMPORT_WORKERS
+  batch_import_consensuses(path, workers=workers)
 
 if __name__ == '__main__':
   sys.exit(main(sys.argv))
@@ -2,16 +2,20 @@
 # -*- coding: utf-8 -*-
 
 '''A simple independent script for importing our server descriptors
+
+usage: import_descriptors.py [path] [number of import workers]
 '''
 
 import sys
 sys.path.append('..')
 from torsearch.importer import batch_import_descriptors
+from config import IMPORT_WORKERS
 
 def main(args):
   path = args[1] if len(args) > 1 else \
     '/home/kostas/priv/tordev/data/server-descriptors-2013-04'
-  batch_import_descriptors(path)
+  workers = int(args[2]) if len(args) > 2 else IMPORT_WORKERS
+  batch_import_descriptors(path, workers=workers)
 
 if __name__ == '__main__':
   sys.exit(main(sys.argv))
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Run the consensus ingest daemon (see torsearch/ingest.py): import new
+consensus files as soon as they appear under path (say, rsync'ed there by
+tools/rsync_consensuses.sh.) Stops on SIGTERM / SIGINT.
+
+usage: ingest_consensuses.py [path] [--poll]
+'''
+
+import sys
+import signal
+sys.path.append('..')
+from torsearch.ingest import IngestDaemon
+
+def main(args):
+  poll = '--poll' in args # (don't use inotify even if we could)
+  args = [arg for arg in args if arg != '--poll']
+  path = args[1] if len(args) > 1 else \
+    '/home/z/p/tor/data/recent/consensuses'
+  daemon = IngestDaemon(path, use_inotify=False if poll else None)
+  for signum in (signal.SIGTERM, signal.SIGINT):
+    signal.signal(signum, lambda signum, frame: daemon.stop())
+  daemon.run()
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
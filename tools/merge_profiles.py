@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Merge per-request profiles (see torsearch/profiler.py) into one report of
+where the time goes.
+
+usage: merge_profiles.py [-e endpoint] [-q query class] [-s sort] [-n lines]
+                         [--callers] [-o merged.pstats] [path ...]
+
+paths are pstats files or directories of them (default: PROFILE_DIR.)
+'''
+
+import os
+import sys
+import pstats
+import argparse
+from collections import Counter
+sys.path.append('..')
+from torsearch.profiler import profile_dir, parse_filename, PROFILE_SUFFIX
+
+def profile_files(paths):
+  for path in paths:
+    if os.path.isdir(path):
+      for name in sorted(os.listdir(path)):
+        if name.endswith(PROFILE_SUFFIX):
+          yield os.path.join(path, name)
+    else:
+      yield path
+
+def main(args):
+  parser = argparse.ArgumentParser(description='merge request profiles')
+  parser.add_argument('paths', nargs='*')
+  parser.add_argument('-e', '--endpoint', help='only these requests')
+  parser.add_argument('-q', '--query-class', help='ditto')
+  parser.add_argument('-s', '--sort', default='cumulative',
+    help='pstats sort key (cumulative, tottime, calls, ...)')
+  parser.add_argument('-n', '--lines', type=int, default=40)
+  parser.add_argument('--callers', action='store_true',
+    help='also print who calls the top functions')
+  parser.add_argument('-o', '--output', help='save the merged pstats, too')
+  args = parser.parse_args(args[1:])
+
+  files = []
+  tally = Counter()
+  for filename in profile_files(args.paths or [profile_dir()]):
+    tag = parse_filename(filename) or ('?', '?')
+    if args.endpoint and tag[0] != args.endpoint or \
+        args.query_class and tag[1] != args.query_class:
+      continue
+    files.append(filename)
+    tally[tag] += 1
+  if not files:
+    print 'no profiles found'
+    return 1
+
+  print '%d profiles:' % len(files)
+  for (endpoint, query_class), count in tally.most_common():
+    print '  %-10s %-12s %d' % (endpoint, query_class, count)
+  print
+
+  stats = pstats.Stats(files[0])
+  for filename in files[1:]:
+    stats.add(filename)
+  if args.output:
+    stats.dump_stats(args.output)
+  stats.strip_dirs().sort_stats(args.sort)
+  stats.print_stats(args.lines)
+  if args.callers:
+    stats.print_callers(args.lines)
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
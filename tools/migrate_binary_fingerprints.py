@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Convert the database to binary (bytea) fingerprint and digest storage
+
+(see misc/binary_fingerprints.sql.) Prints table and index sizes before and
+after. Set BINARY_FINGERPRINTS = True in config.py once done, and restart
+the API and the importer.
+
+usage: migrate_binary_fingerprints.py [path to binary_fingerprints.sql]
+'''
+
+import os
+import sys
+sys.path.append('..')
+from torsearch import db
+
+TABLES = ('statusentry', 'fingerprint', 'presence', 'address_history')
+
+def mb(size):
+  return '%.1f MB' % (float(size) / 1024 / 1024)
+
+def relation_sizes(cursor):
+  '''(table, total size, index size), summing up partitions.
+  '''
+
+  # (the partitions by way of pg_inherits: pg_partition_tree() needs
+  # PostgreSQL 12, partitioning only 11)
+  sizes = []
+  for table in TABLES:
+    cursor.execute("WITH RECURSIVE tree (relid) AS ("
+      "  SELECT CAST(CAST(%s AS regclass) AS oid) "
+      "  UNION ALL SELECT i.inhrelid FROM pg_inherits i "
+      "    JOIN tree ON i.inhparent = tree.relid) "
+      "SELECT coalesce(sum(pg_total_relation_size(relid)), 0), "
+      "  coalesce(sum(pg_indexes_size(relid)), 0) "
+      "  FROM tree", (table,))
+    sizes.append((table,) + tuple(cursor.fetchone()))
+  return sizes
+
+def fingerprint_type(cursor):
+  cursor.execute("SELECT data_type FROM information_schema.columns "
+    "  WHERE table_name = 'statusentry' AND column_name = 'fingerprint'")
+  return cursor.fetchone()[0]
+
+def main(args):
+  path = args[1] if len(args) > 1 else os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'misc',
+    'binary_fingerprints.sql')
+  conn = db.engine.raw_connection()
+  conn.connection.set_isolation_level(0) # the script has its own BEGIN/COMMIT
+  cursor = conn.cursor()
+  if fingerprint_type(cursor) == 'bytea':
+    print 'Fingerprints are already stored as bytea.'
+    return 0
+
+  before = relation_sizes(cursor)
+  print 'Converting (this will take a while)...'
+  cursor.execute(open(path).read())
+  after = relation_sizes(cursor)
+
+  print '%-16s %12s %12s %12s %12s' % ('table', 'total before', 'total after',
+    'idx before', 'idx after')
+  for (table, total, idx), (_, total_after, idx_after) in zip(before, after):
+    print '%-16s %12s %12s %12s %12s' % (table, mb(total), mb(total_after),
+      mb(idx), mb(idx_after))
+  print 'Done. Now set BINARY_FINGERPRINTS = True in config.py.'
+  conn.close()
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
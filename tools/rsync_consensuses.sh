@@ -0,0 +1,8 @@
+#!/bin/sh
+# fetch the latest consensuses; the ingest daemon (ingest_consensuses.py)
+# imports them as soon as they land. (rsync_and_import.sh does both, for when
+# the daemon is not running.)
+
+DEST="/home/z/p/tor/data/recent"
+
+rsync -az metrics.torproject.org::metrics-recent/relay-descriptors/consensuses $DEST
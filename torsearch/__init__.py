@@ -3,6 +3,7 @@
 
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
 import logging
 import os
 from logging import Formatter, FileHandler
@@ -14,7 +15,9 @@ db = SQLAlchemy(app, session_options={'autocommit': False, 'autoflush': False})
 from torsearch import models # now we can import models which use the db we've
                              # just defined
 
-debug_logger = logging.getLogger('torsearch')
+# app.logger is the 'torsearch' logger too: Flask gets rid of its handlers
+# when it first makes it, so have it made before adding ours
+debug_logger = app.logger
 debug_log_handler = FileHandler(os.path.join(basedir, 'debug.log'))
 debug_log_formatter = Formatter('%(asctime)s %(levelname)s %(message)s '
 '[in %(pathname)s:%(lineno)d]')
@@ -23,15 +26,30 @@ debug_logger.addHandler(debug_log_handler)
 debug_logger.setLevel(logging.DEBUG)
 
 if not app.debug:
+  # (warnings and errors; the logger itself stays at DEBUG, for debug.log)
   file_handler = FileHandler(os.path.join(basedir, 'error.log'))
   file_handler.setFormatter(debug_log_formatter)
-  app.logger.setLevel(logging.INFO)
-  file_handler.setLevel(logging.INFO)
+  file_handler.setLevel(logging.WARNING)
   app.logger.addHandler(file_handler)
   app.logger.info('errors')
 
 #init_db()
 
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+  '''pool checkout hook: make sure that a pooled connection still works (e.g.
+  after a database restart.) if it doesn't, the pool retries with a new one.
+  '''
+
+  try:
+    cursor = dbapi_connection.cursor()
+    cursor.execute('SELECT 1')
+    cursor.close()
+  except Exception:
+    raise exc.DisconnectionError()
+
+if app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+  event.listen(db.engine.pool, 'checkout', ping_connection)
+
 from torsearch import onionoo_api
 
 @app.teardown_request
@@ -9,18 +9,41 @@ low-level bottlenecks. here, we are simply concerned with the overall query
 time. If we want, we can also run our EXPLAIN ANALYZEr. If we specify not to
 use it (default when instantiating Benchmark objects), the tool is generic
 enough to be used outside of an ORM context.
+
+Each run reports p50/p95/p99 per case (and shared buffer hits/reads, from
+EXPLAIN (ANALYZE, BUFFERS)), and can be written out as JSON, so that two runs
+(e.g. before and after a change) can be compared:
+
+  python -m torsearch.benchmark run 'before' -n 10 -o before.json
+  python -m torsearch.benchmark run 'after' -n 10 -o after.json
+  python -m torsearch.benchmark compare before.json after.json
 '''
 
 import os
+import re
 import sys
 import time
+import json
+import datetime
+import argparse
 import logging
 from logging import Formatter, FileHandler
-from torsearch import query_info, onionoo_api
+from sqlalchemy.sql.expression import Select
+from flask_sqlalchemy import BaseQuery
+from torsearch import db, query_info, onionoo_api
+from torsearch.cache import latest_consensus
 from config import basedir
 
+PERCENTILES = (50, 95, 99)
+REGRESSION_THRESHOLD = 0.2 # compare(): flag cases this much (20%) worse
+
+# the top plan node's line comes first, and its counts include its children's
+BUFFERS_RE = re.compile(r'Buffers: shared((?: \w+=\d+)+)')
+
 def get_logger(filename, absolute_path=False):
   logger = logging.getLogger('torsearch.benchmark')
+  if logger.handlers: # one Benchmark after another
+    return logger
   log_handler = FileHandler(
     (os.path.join(basedir, filename)) if not absolute_path else filename
   )
@@ -30,6 +53,49 @@ def get_logger(filename, absolute_path=False):
   logger.setLevel(logging.DEBUG)
   return logger
 
+def percentile(values, p):
+  '''the p-th percentile of values, interpolating between the closest ranks.
+  '''
+
+  if not values:
+    return None
+  values = sorted(values)
+  k = (len(values) - 1) * p / 100.0
+  lo = int(k)
+  hi = min(lo + 1, len(values) - 1)
+  return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def explain_buffers(info):
+  '''{'hit': .., 'read': ..} shared buffers of the whole query, from the
+  output of EXPLAIN (ANALYZE, BUFFERS) - or None if there's no such line.
+  '''
+
+  for row in info:
+    match = BUFFERS_RE.search(row[0])
+    if match:
+      counts = dict(pair.split('=') for pair in match.group(1).split())
+      return {'hit': int(counts.get('hit', 0)),
+              'read': int(counts.get('read', 0))}
+  return None
+
+def is_query(result):
+  return isinstance(result, (Select, BaseQuery))
+
+def fetch(result):
+  '''run a test function's result to completion; returns the number of rows.
+
+  queries are executed; (latest consensus, entries) pairs, as returned by
+  get_results() and the like, are iterated over.
+  '''
+
+  if isinstance(result, Select):
+    result = db.session.execute(result)
+  elif isinstance(result, tuple):
+    result = result[1]
+  if result is None:
+    return 0
+  return sum(1 for _ in result)
+
 class Benchmark(object):
   '''a simple placeholder + benchmarker that stores:
   name -- a title / short description of this benchmark.
@@ -43,8 +109,8 @@ class Benchmark(object):
   run_in_order -- whether to run each case in the order specified in params.
     if False, will run as (e.g. if n_runs=3) [case1, case1, case1, case2,
     case2, case2, . . .]
-  run_explain -- whether to expect a query object as the return value, and to
-    feed it into torsearch.query_info.run_explain()
+  run_explain -- whether to feed query objects returned by testfunc into
+    torsearch.query_info.run_explain() (other results are simply fetched.)
   '''
 
   default_output_filename = 'benchmarks.log'
@@ -61,8 +127,31 @@ class Benchmark(object):
     self.run_explain = run_explain
     self.logger = get_logger(output_filename)
 
+  def schedule(self, n_runs, run_in_order):
+    '''(case number, run number) pairs, in the order to run them in.
+    '''
+
+    if run_in_order:
+      return [(n, i) for i in range(n_runs) for n in range(len(self.params))]
+    return [(n, i) for n in range(len(self.params)) for i in range(n_runs)]
+
+  def warm_up(self, paramset):
+    '''one untimed call of a case: EXPLAINed if it's a query (and we were
+    asked to), otherwise simply fetched. returns the buffer counts, if any.
+    '''
+
+    result = self.testfunc(*paramset)
+    if self.run_explain and is_query(result):
+      info = query_info.run_explain(result, analyze=True, buffers=True,
+        output_statement=True, output_explain=True,
+        debug_log=self.logger.info, warning_log=self.logger.warning)
+      return explain_buffers(info)
+    fetch(result)
+    return None
+
   def run(self, run_name, n_runs=None, run_in_order=None):
-    '''run the benchmark (all the testfunc cases.)
+    '''run the benchmark (all the testfunc cases.) returns a dict of results
+    (see case_results()), which can be written out as JSON.
 
     run_name -- the name of this particular run.
     the idea is to call this benchmark multiple times, perhaps on different
@@ -78,85 +167,263 @@ class Benchmark(object):
     self.logger.info('### Benchmark: ' + self.name + ' (%s)',
       self.testfunc.__name__)
     self.logger.info('Run case: ' + run_name)
-    total_time = 0.0
+
+    buffers = []
     for n, paramset in enumerate(self.params):
       self.logger.info('%d) Parameters: ' + str(paramset), n+1)
-      if 1: #run_in_order: # TODO: we're not using differences in run_in_order
-                           # for torsearch, but it would be good idea to try
-                           # that. hence TODO: Implement both run_in_order
-                           # cases.
-        for i in range(n_runs):
-          t1 = time.time()
-          result = self.testfunc(*paramset)
+      buffers.append(self.warm_up(paramset))
 
-          if run_explain: # True => the actual execution is upon result.all()
-            # (we want the buffer info every time we run this, but let's
-            # output the query statement only once)
-            query_info.run_explain(result, analyze=True, buffers=True,
-              output_statement=(i==0), output_explain=True,
-              debug_log=self.logger.info, warning_log=self.logger.warning)
+    times = [[] for _ in self.params]
+    rows = [None] * len(self.params)
+    for n, i in self.schedule(n_runs, run_in_order):
+      t1 = time.time()
+      rows[n] = fetch(self.testfunc(*self.params[n]))
+      t2 = time.time()
+      times[n].append(t2 - t1)
+      self.logger.info(' ==> %d) %d) time: %s', n+1, i+1, t2 - t1)
+
+    total_time = sum(map(sum, times))
+    self.logger.info('End of benchmark. Total time: %s', total_time)
+    return {'name': self.name, 'function': self.testfunc.__name__,
+      'total_time': total_time,
+      'cases': [case_results(paramset, times[n], rows[n], buffers[n])
+        for n, paramset in enumerate(self.params)]}
+
+def case_label(paramset):
+  '''a stable, readable key for a case (to match cases across runs.)
+  '''
 
-          t2 = time.time()
-          total_time += (t2 - t1)
-          self.logger.info(' ==> %d) %d) time: %s', n+1, i+1, t2 - t1)
+  return json.dumps(paramset, sort_keys=True)
 
-    logger.info('End of benchmark. Total time: %s', total_time)
-    return total_time
+def case_results(paramset, times, rows, buffers):
+  results = {'params': case_label(paramset), 'runs': len(times),
+    'times': times, 'rows': rows,
+    'mean': sum(times) / len(times) if times else None}
+  for p in PERCENTILES:
+    results['p%d' % p] = percentile(times, p)
+  if buffers:
+    results['shared_hit'] = buffers['hit']
+    results['shared_read'] = buffers['read']
+  return results
 
+# the test functions. do_search() only builds the query, which makes it
+# EXPLAINable; get_results() is the whole thing, minus the result cache.
+
+def search(args):
+  return onionoo_api.do_search(latest_consensus.get().valid_after, args=args)
+
+def uncached_results(query_type, args):
+  onionoo_api.result_cache.clear()
+  return onionoo_api.get_results(query_type, args=args)
+
+MORIA1 = '9695DFC35FFEB861329B9F1AB04C46397020CE31'
+GABELMOO = 'F2044413DAC2E02E3D6BCF4735A19BCA1DE97281'
+A_WEEK = {'from': '2013-04-01', 'to': '2013-04-08'}
+
+def with_args(args, **more):
+  args = dict(args)
+  args.update(more)
+  return args
 
 # here we define a simple way of constructing a list of the benchmarks we
-# actually want to run.
+# actually want to run. (args are plain dicts, as with request.args.)
 
 torsearch_orm_benchmarks =\
   {
-    'raw sql - search for nickname': # name of the benchmark to test
+    'fingerprint lookup': # name of the benchmark to test
       [
         # each benchmark contains the function to call as its first item in
         # the external list
-        onionoo_api.sql_search_nickname,
+        search,
         # the remainder of the list is parameter lists / call cases (each
         # internal list can contain any number of items)
-        ['moria2'], ['moria1'], ['gabelmoo'], ['cekuolis'], ['torland1'],
-        ['unknown'], ['default']
-      ] # /benchmark
+        [{'lookup': MORIA1}], [{'lookup': GABELMOO}]
+      ], # /benchmark
+    'fingerprint prefix search':
+      [
+        search,
+        [{'search': MORIA1[:8]}], [{'search': '$' + GABELMOO[:20]}]
+      ],
+    'nickname prefix search':
+      [
+        search,
+        [{'search': 'moria'}], [{'search': 'gabelmoo'}],
+        [{'search': 'default'}], [{'search': 'unknown'}]
+      ],
+    'address search':
+      [
+        search,
+        [{'search': '128.31.0.34'}], [{'search': '86.59.'}],
+        [{'search': '10.0.0.0/8'}]
+      ],
+    'running':
+      [
+        search,
+        [{'running': 'true'}], [{'running': 'false'}],
+        [{'running': 'true', 'search': 'default'}]
+      ],
+    'date range':
+      [
+        search,
+        [A_WEEK], [with_args(A_WEEK, search='default')],
+        [with_args(A_WEEK, running='false')]
+      ],
+    'deep offset':
+      [
+        search,
+        [{'offset': '5000'}], [{'offset': '20000', 'limit': '50'}],
+        [{'search': 'default', 'offset': '1000'}]
+      ],
+    'get_results (uncached)':
+      [
+        uncached_results,
+        ['summary', {'search': 'moria'}], ['details', {'running': 'true'}],
+        ['details', {'search': '86.59.'}]
+      ],
+    'statuses lookup':
+      [
+        onionoo_api.statuses_query,
+        [{'lookup': MORIA1}], [with_args(A_WEEK, lookup=MORIA1)],
+        [{'lookup': MORIA1, 'offset': '2000'}]
+      ],
+    'get_statuses':
+      [
+        onionoo_api.get_statuses,
+        [{'lookup': MORIA1}], [{'lookup': GABELMOO, 'flag': 'guard'}]
+      ],
+    'condensed statuses':
+      [
+        onionoo_api.get_status_ranges,
+        [{'lookup': MORIA1}], [with_args(A_WEEK, lookup=GABELMOO)]
+      ]
   }
 
 
-def get_torsearch_benchmarks(benchmarks=torsearch_orm_benchmarks):
+def get_torsearch_benchmarks(benchmarks=torsearch_orm_benchmarks,
+  run_explain=True):
   '''useful for manual inspection / tinkering from the console:
   >>> from torsearch import benchmark as b
   >>> bmarks = b.get_torsearch_benchmarks()
   >>> for bmark in bmarks:
   >>>   print 'Running', bmark.name, '...',
-  >>>   time = bmark.run('test run', n_runs=5)
-  >>>   print time, '(', time / (float) 5, 'per run )'
+  >>>   results = bmark.run('test run', n_runs=5)
+  >>>   print results['total_time'], '(', results['total_time'] / 5.0,
+  >>>     'per run )'
   '''
 
   objects = []
-  for name, data in benchmarks.iteritems():
+  for name, data in sorted(benchmarks.iteritems()):
     func = data[0]
     paramlists = data[1:]
-    #yield Benchmark(name, func, params=paramlists, run_explain=True)
-    objects.append(Benchmark(name, func, params=paramlists, run_explain=True))
+    objects.append(Benchmark(name, func, params=paramlists,
+      run_explain=run_explain))
   return objects
 
 def run_torsearch_benchmarks(run_name, n_runs, run_in_order=True,
-  benchmarks=torsearch_orm_benchmarks):
+  benchmarks=torsearch_orm_benchmarks, run_explain=True):
+  '''returns the results of the whole run (see Benchmark.run().)
+  '''
 
-  for benchmark in get_torsearch_benchmarks(benchmarks):
+  results = {'run_name': run_name, 'n_runs': n_runs,
+    'run_in_order': run_in_order,
+    'started': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+    'benchmarks': []}
+  for benchmark in get_torsearch_benchmarks(benchmarks, run_explain):
     print 'Running benchmark:', benchmark.name
-    benchmark.run(run_name, n_runs=n_runs, run_in_order=run_in_order)
+    results['benchmarks'].append(benchmark.run(run_name, n_runs=n_runs,
+      run_in_order=run_in_order))
+  return results
 
+def print_results(results, out=sys.stdout):
+  for benchmark in results['benchmarks']:
+    out.write('%s (%s)\n' % (benchmark['name'], benchmark['function']))
+    for case in benchmark['cases']:
+      out.write('  %s\n' % case['params'])
+      out.write('    p50 %.4fs  p95 %.4fs  p99 %.4fs  rows %s' % (case['p50'],
+        case['p95'], case['p99'], case['rows']))
+      if 'shared_hit' in case:
+        out.write('  buffers hit %d read %d' % (case['shared_hit'],
+          case['shared_read']))
+      out.write('\n')
 
-if __name__ == '__main__':
-  # TODO: provide a --help menu, etc. if we end up using this outside of
-  # (pre)alpha-version development
-  #run_torsearch_benchmarks(sys.argv[1] if len(sys.argv) > 1 else 'test run',\
-  #  sys.argv[2] if len(sys.argv) > 2 else 5)
+def compare(old, new, threshold=REGRESSION_THRESHOLD):
+  '''cases (of two run_torsearch_benchmarks() results) which got worse by
+  more than threshold: [(benchmark, params, what, old value, new value)].
+
+  p50 and p95 are compared, and so is the number of buffers touched.
+  '''
 
-  # better simply use
-  # >>> from torsearch import benchmark
-  # >>> benchmark.run_torsearch_benchmarks('my test run case', 5)
+  old_cases = dict(((b['name'], c['params']), c)
+    for b in old['benchmarks'] for c in b['cases'])
+  regressions = []
+  for benchmark in new['benchmarks']:
+    for case in benchmark['cases']:
+      old_case = old_cases.get((benchmark['name'], case['params']))
+      if not old_case:
+        continue
+      values = [(stat, old_case.get(stat), case.get(stat))
+        for stat in ('p50', 'p95')]
+      if 'shared_hit' in old_case and 'shared_hit' in case:
+        values.append(('buffers',
+          old_case['shared_hit'] + old_case['shared_read'],
+          case['shared_hit'] + case['shared_read']))
+      for what, old_value, new_value in values:
+        if old_value is not None and new_value is not None and \
+            new_value > old_value * (1 + threshold):
+          regressions.append((benchmark['name'], case['params'], what,
+            old_value, new_value))
+  return regressions
 
-  pass
+def main(argv):
+  parser = argparse.ArgumentParser(description='torsearch query benchmarks')
+  commands = parser.add_subparsers(dest='command')
 
+  run = commands.add_parser('run', help='run the benchmarks')
+  run.add_argument('run_name', nargs='?', default='test run')
+  run.add_argument('-n', '--runs', type=int, default=5,
+    help='times to run each case (default: %(default)s)')
+  run.add_argument('-o', '--output', help='write the results to this JSON '
+    'file')
+  run.add_argument('--grouped', action='store_true',
+    help='run all the runs of a case before the next case')
+  run.add_argument('--no-explain', action='store_true',
+    help='skip EXPLAIN (ANALYZE, BUFFERS)')
+  run.add_argument('--only', help='only run benchmarks whose name contains '
+    'this')
+
+  comp = commands.add_parser('compare', help='compare two JSON results')
+  comp.add_argument('old')
+  comp.add_argument('new')
+  comp.add_argument('-t', '--threshold', type=float,
+    default=REGRESSION_THRESHOLD,
+    help='relative slowdown to flag (default: %(default)s)')
+
+  args = parser.parse_args(argv[1:])
+
+  if args.command == 'run':
+    benchmarks = dict((name, data) for name, data
+      in torsearch_orm_benchmarks.iteritems()
+      if not args.only or args.only in name)
+    results = run_torsearch_benchmarks(args.run_name, args.runs,
+      run_in_order=not args.grouped, benchmarks=benchmarks,
+      run_explain=not args.no_explain)
+    print_results(results)
+    if args.output:
+      with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+  with open(args.old) as f:
+    old = json.load(f)
+  with open(args.new) as f:
+    new = json.load(f)
+  regressions = compare(old, new, args.threshold)
+  for name, params, what, old_value, new_value in regressions:
+    print 'REGRESSION %s %s: %s %s -> %s' % (name, params, what, old_value,
+      new_value)
+  if not regressions:
+    print 'No regressions (threshold: %s)' % args.threshold
+  return 1 if regressions else 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''A Bloom filter over all the fingerprints we know of.
+
+Many lookups are for fingerprints which we have never seen (typos, hashed
+bridge fingerprints, scanners); the filter tells those apart from the rest
+without a database query. It may say yes for a fingerprint we don't know
+(about BLOOM_ERROR_RATE of the time), but never no for one we do.
+
+Fingerprint rows are numbered in the order they are inserted in
+(fingerprint.seq, see misc/fingerprint_seq.sql), and the filter knows the
+highest number it has added (its high-water mark.) Catching up is adding the
+rows numbered above it, whichever consensus they were first seen in - older
+consensuses may be imported at any time. Importers add rows one at a time
+(see importer.merge_fingerprints()), so that no row is ever committed below a
+high-water mark.
+
+The filter is saved to BLOOM_FILE, together with its high-water mark. A
+process loads it from there (or, if there isn't one, builds it from the
+fingerprint table), and then catches up. The API processes catch up whenever
+the importer lets them know of a consensus it has imported, in or out of
+order (see cache.LatestConsensusCache.add_listener()); lookups themselves
+never query. The importer saves the file once it is done with a directory
+(or file) of consensuses - the file is only there for quick startup, so
+failing to save it is logged, not fatal.
+
+Processes share the file under an flock(): each one merges the saved filter
+into its own before saving, so that nobody's additions are lost.
+'''
+
+import fcntl
+import hashlib
+import json
+import math
+import os
+import struct
+import threading
+import time
+from binascii import hexlify, unhexlify
+from contextlib import contextmanager
+from sqlalchemy import select
+from torsearch import db, debug_logger
+from torsearch.models import Fingerprint
+from config import basedir, BLOOM_FILE, BLOOM_CAPACITY, BLOOM_ERROR_RATE
+
+def highest(a, b):
+  # (None is lower than anything)
+  return b if a is None else a if b is None else max(a, b)
+
+class BloomFilter(object):
+  '''a set of strings, with false positives. bits and hashes are best picked
+  by for_capacity().
+  '''
+
+  def __init__(self, bits, hashes, data=None, count=0):
+    self.bits = bits
+    self.hashes = hashes
+    self.data = data if data is not None else bytearray((bits + 7) // 8)
+    self.count = count # (roughly) distinct strings added
+
+  @classmethod
+  def for_capacity(cls, capacity, error_rate=BLOOM_ERROR_RATE):
+    '''a filter holding up to capacity strings at error_rate false
+    positives.
+    '''
+
+    bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    hashes = max(1, int(round(bits * math.log(2) / capacity)))
+    return cls(bits, hashes)
+
+  def capacity(self, error_rate=BLOOM_ERROR_RATE):
+    return int(-self.bits * math.log(2) ** 2 / math.log(error_rate))
+
+  def positions(self, value):
+    # (double hashing: two 64-bit hashes make all the rest)
+    h1, h2 = struct.unpack('<QQ', hashlib.sha1(value).digest()[:16])
+    return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+  def add(self, value):
+    new = False
+    for i in self.positions(value):
+      byte, bit = i >> 3, 1 << (i & 7)
+      if not self.data[byte] & bit:
+        self.data[byte] |= bit
+        new = True
+    if new: # (not counting repeats, which the importer adds every hour)
+      self.count += 1
+
+  def __contains__(self, value):
+    return all(self.data[i >> 3] & (1 << (i & 7))
+      for i in self.positions(value))
+
+  def compatible(self, other):
+    return (self.bits, self.hashes) == (other.bits, other.hashes)
+
+  def union(self, other):
+    '''add all the strings of other (a compatible() filter.)
+    '''
+
+    # (OR-ing them as long integers is much quicker than byte by byte)
+    data = int(hexlify(self.data), 16) | int(hexlify(other.data), 16)
+    self.data = bytearray(unhexlify('%0*x' % (2 * len(self.data), data)))
+    # (roughly: filters of the same table have most of their strings in
+    # common)
+    self.count = max(self.count, other.count)
+
+  def save(self, path, high_water=None):
+    '''write the filter to path (atomically), with a one-line JSON header.
+    '''
+
+    header = {'bits': self.bits, 'hashes': self.hashes, 'count': self.count,
+      'high_water': high_water}
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+      f.write(json.dumps(header) + '\n')
+      f.write(self.data)
+    os.rename(tmp_path, path)
+
+  @classmethod
+  def load(cls, path):
+    '''returns (filter, high_water) as saved by save().
+    '''
+
+    with open(path, 'rb') as f:
+      header = json.loads(f.readline())
+      data = bytearray(f.read())
+    if len(data) != (header['bits'] + 7) // 8:
+      raise ValueError('%s is truncated' % path)
+    high_water = header['high_water']
+    if high_water is not None and not isinstance(high_water, (int, long)):
+      raise ValueError('%s has no fingerprint.seq high-water mark' % path)
+    return cls(header['bits'], header['hashes'], data,
+      header['count']), high_water
+
+class KnownFingerprints(object):
+  '''the process' fingerprint filter (None until it is first needed.)
+
+  path -- where the filter is saved (and path + '.lock', the lock file.)
+  capacity -- the least number of fingerprints to size a new filter for
+    (it's made for twice as many as there are, if that's more.) a filter
+    which is past its capacity is rebuilt.
+  '''
+
+  def __init__(self, path=os.path.join(basedir, BLOOM_FILE),
+      capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+    self.path = path
+    self.capacity = capacity
+    self.error_rate = error_rate
+    self.filter = None
+    self.high_water = None # the highest fingerprint.seq in the filter
+    self.mtime = None # of the file as last merged in / saved
+    self.misses = 0 # definite ones
+    self._lock = threading.Lock()
+
+  def might_exist(self, fingerprint):
+    '''False if we definitely don't know the (hex) fingerprint. (True if
+    there is no filter yet.)
+    '''
+
+    bloom = self.filter
+    if bloom is None or fingerprint.upper() in bloom:
+      return True
+    self.misses += 1
+    return False
+
+  def refresh(self, latest_consensus=None):
+    '''catch up on the fingerprints added since, loading or building the
+    filter first if need be (or if it is too full.) a
+    cache.LatestConsensusCache listener, called after each import.
+    '''
+
+    with self._lock:
+      try:
+        if self.filter is not None and not self._too_full():
+          self._catch_up() # (the usual case: a quick index scan)
+          return
+        with self._file_lock():
+          if self._sync(): # (built it: spare the other processes that)
+            self._save_or_warn()
+      except Exception as e:
+        # lookups go to the database until the next try
+        debug_logger.error('Could not refresh the fingerprint filter: %s',
+          str(e))
+        db.session.rollback()
+        self.filter = None
+
+  def save(self):
+    '''catch up (on what has been committed), merge in the saved filter and
+    save the result. for the importer, once it is done with a batch of
+    consensuses. failures are logged: the saved filter is only a cache.
+    '''
+
+    with self._lock:
+      try:
+        with self._file_lock():
+          self._sync()
+          self._save_or_warn()
+      except Exception as e:
+        debug_logger.warning('Could not save the fingerprint filter to %s: '
+          '%s', self.path, str(e))
+        db.session.rollback()
+
+  @contextmanager
+  def _file_lock(self):
+    # (flock()s of separate open()s exclude each other even within a process;
+    # self._lock is taken first, so one instance never waits for itself)
+    with open(self.path + '.lock', 'a') as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+  def _file_mtime(self):
+    try:
+      return os.stat(self.path).st_mtime
+    except OSError:
+      return None
+
+  def _sync(self):
+    '''(with the file locked) merge in the saved filter if someone else has
+    saved it since, build a new one if need be, and catch up. returns whether
+    it built one.
+    '''
+
+    self._merge_file()
+    built = self.filter is None or self._too_full()
+    if built:
+      self._build() # (too full to keep to error_rate: make a bigger one)
+    self._catch_up()
+    return built
+
+  def _too_full(self):
+    return self.filter.count > self.filter.capacity(self.error_rate)
+
+  def _merge_file(self):
+    mtime = self._file_mtime()
+    if mtime is None or mtime == self.mtime:
+      return
+    try:
+      bloom, high_water = BloomFilter.load(self.path)
+    except (IOError, ValueError, KeyError) as e:
+      debug_logger.warning('Could not load the fingerprint filter from %s: '
+        '%s', self.path, str(e))
+      return
+    self.mtime = mtime
+    if self.filter is not None and self.filter.compatible(bloom):
+      self.filter.union(bloom)
+      self.high_water = highest(self.high_water, high_water)
+    elif self.filter is None or bloom.bits > self.filter.bits:
+      # (the bigger one; either is complete up to its own high-water mark)
+      self.filter, self.high_water = bloom, high_water
+
+  def _build(self):
+    t1 = time.time()
+    count = db.session.query(Fingerprint.fp12).count()
+    bloom = BloomFilter.for_capacity(max(self.capacity, 2 * count),
+      self.error_rate)
+    high_water = None
+    rows = db.session.execute(select([Fingerprint.fingerprint,
+      Fingerprint.seq]).execution_options(stream_results=True))
+    for fingerprint, seq in rows:
+      bloom.add(fingerprint.upper())
+      high_water = highest(high_water, seq)
+    self.filter, self.high_water = bloom, high_water
+    debug_logger.info('Built the fingerprint filter (%d fingerprints, %d '
+      'bytes) in %.2fs', bloom.count, len(bloom.data), time.time() - t1)
+
+  def _catch_up(self):
+    q = select([Fingerprint.fingerprint, Fingerprint.seq])
+    if self.high_water is not None:
+      q = q.where(Fingerprint.seq > self.high_water)
+    for fingerprint, seq in db.session.execute(q):
+      self.filter.add(fingerprint.upper())
+      self.high_water = highest(self.high_water, seq)
+
+  def _save_or_warn(self):
+    try:
+      self.filter.save(self.path, self.high_water)
+      self.mtime = self._file_mtime()
+    except EnvironmentError as e:
+      debug_logger.warning('Could not save the fingerprint filter to %s: %s',
+        self.path, str(e))
+
+known_fingerprints = KnownFingerprints()
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Process-level caches for values that change (at most) once per consensus.
+
+The latest consensus is needed by every API request, but it only changes
+when the importer commits a new consensus document, i.e. once an hour. The
+importer NOTIFYs on CONSENSUS_NOTIFY_CHANNEL when it does so (see
+importer.notify_new_consensus()); each process LISTENs on its own dedicated
+connection, so that all the API worker processes pick up the change. The TTL
+is a fallback for when notifications can not be received.
+
+LRUCache is a small size-bounded, thread-safe mapping with hit/miss
+counters, used e.g. for API query results (see onionoo_api.result_cache.)
+'''
+
+import os
+import threading
+import time
+from collections import namedtuple, OrderedDict
+import psycopg2
+import psycopg2.extensions
+from torsearch import db, debug_logger
+from torsearch.models import Consensus
+from config import CONSENSUS_CACHE_TTL, CONSENSUS_NOTIFY_CHANNEL
+
+LatestConsensus = namedtuple('LatestConsensus',
+  ['valid_after', 'fresh_until', 'valid_until'])
+
+class LatestConsensusCache(object):
+  '''holds the latest consensus (valid_after, fresh_until, valid_until).
+
+  ttl -- seconds after which the value is re-read from the database, even if
+    no notification has been received.
+  channel -- the LISTEN/NOTIFY channel the importer notifies on.
+  '''
+
+  def __init__(self, ttl=CONSENSUS_CACHE_TTL, channel=CONSENSUS_NOTIFY_CHANNEL):
+    self.ttl = ttl
+    self.channel = channel
+    self._value = None
+    self._fetched_at = 0.0
+    self._listen_conn = None
+    self._listen_pid = None # connections must not be shared across forks
+    self._listen_failed_at = 0.0
+    self._listeners = []
+    self._lock = threading.Lock()
+
+  def add_listener(self, callback, every_refresh=False):
+    '''callback(latest_consensus) will be called whenever the latest
+    consensus is found to have changed - or, with every_refresh, whenever it
+    is re-read: after each import we are notified of (older consensuses
+    included), and when the TTL is up.
+    '''
+
+    self._listeners.append((callback, every_refresh))
+
+  def get(self):
+    '''returns a LatestConsensus, or None if there are no consensuses yet.
+    '''
+
+    self._poll_notifications()
+    if self._value is None or time.time() - self._fetched_at > self.ttl:
+      self.refresh()
+    return self._value
+
+  def invalidate(self):
+    self._fetched_at = 0.0
+
+  def refresh(self):
+    consensus = Consensus.query.order_by(Consensus.valid_after.desc()).first()
+    value = LatestConsensus(consensus.valid_after, consensus.fresh_until,
+      consensus.valid_until) if consensus else None
+    changed = value != self._value
+    self._value = value
+    self._fetched_at = time.time()
+    if changed:
+      debug_logger.info('Latest consensus is now %s',
+        value.valid_after if value else None)
+    for callback, every_refresh in self._listeners:
+      if changed or every_refresh:
+        callback(value)
+    return value
+
+  def _listen_connection(self):
+    if self._listen_conn is not None and not self._listen_conn.closed and \
+        self._listen_pid == os.getpid():
+      return self._listen_conn
+
+    args = db.engine.url.translate_connect_args(username='user')
+    conn = psycopg2.connect(**args)
+    conn.set_isolation_level(
+      psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = conn.cursor()
+    cursor.execute('LISTEN ' + self.channel)
+    cursor.close()
+    self._listen_conn = conn
+    self._listen_pid = os.getpid()
+    self.invalidate() # we may have missed notifications until now
+    return conn
+
+  def _poll_notifications(self):
+    '''non-blocking: only reads what the server has already sent us.
+    '''
+
+    with self._lock:
+      if time.time() - self._listen_failed_at < self.ttl:
+        return # don't try to reconnect on every request
+      try:
+        conn = self._listen_connection()
+        conn.poll()
+        if conn.notifies:
+          del conn.notifies[:]
+          self.invalidate()
+      except psycopg2.Error as e:
+        debug_logger.warning('Could not poll for consensus notifications '
+          '(falling back to TTL): %s', str(e))
+        self._listen_conn = None
+        self._listen_failed_at = time.time()
+
+class LRUCache(object):
+  '''a size-bounded mapping which evicts the least recently used entries.
+
+  hits, misses and evictions are counted for inspection (see stats().)
+  '''
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        value = self._entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      self._entries[key] = value # re-insert as most recently used
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    if self.max_size <= 0:
+      return
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = value
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def stats(self):
+    return {'size': len(self._entries), 'max_size': self.max_size,
+      'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+latest_consensus = LatestConsensusCache()
+
+if __name__ == '__main__':
+  pass
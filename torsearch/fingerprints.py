@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Fingerprint (and digest) storage helpers.
+
+Fingerprints and digests are stored either as 40-character hex strings (the
+default), or - with BINARY_FINGERPRINTS - as 20-byte bytea, which makes for
+half the row and index size (see tools/migrate_binary_fingerprints.py.) The
+rest of the code deals in hex strings either way; these helpers translate.
+
+The fingerprint table is keyed on fp12, the first 11 hex characters of the
+fingerprint (substr(fingerprint, 0, 12)), and status entries are looked up
+by the same expression. In binary mode, fp12 simply holds the whole (binary)
+fingerprint, and status entries are indexed on the fingerprint column itself.
+'''
+
+import binascii
+import string
+from sqlalchemy import func, false, literal
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.dialects.postgresql import BYTEA
+from torsearch import db
+from config import BINARY_FINGERPRINTS
+
+FP_LEN = 40
+FP_SUBSTR_LEN = 12
+
+class HexBytes(TypeDecorator):
+  '''bytea in the database, upper-case hex strings in python.
+  '''
+
+  impl = BYTEA
+
+  def process_bind_param(self, value, dialect):
+    if value is None:
+      return None
+    return buffer(binascii.unhexlify(value))
+
+  def process_result_value(self, value, dialect):
+    if value is None:
+      return None
+    return binascii.hexlify(value).upper()
+
+def fingerprint_type(length=FP_LEN):
+  '''the column type for fingerprints and digests.
+  '''
+
+  return HexBytes() if BINARY_FINGERPRINTS else db.String(length)
+
+def is_hex(value):
+  return all(c in string.hexdigits for c in value)
+
+def fp_key(column):
+  '''the expression that fingerprint table keys (fp12) and status entry
+  lookups are made of.
+  '''
+
+  return column if BINARY_FINGERPRINTS else \
+    func.substr(column, 0, FP_SUBSTR_LEN)
+
+def fp_key_value(fingerprint):
+  '''the fp_key() of a (hex) fingerprint.
+  '''
+
+  return fingerprint if BINARY_FINGERPRINTS else \
+    fingerprint[:FP_SUBSTR_LEN-1]
+
+def fp_key_sql(column='fingerprint'):
+  '''fp_key(), for raw SQL (with an :fp_substr_len param.)
+  '''
+
+  return column if BINARY_FINGERPRINTS else \
+    'substr(%s, 0, :fp_substr_len)' % column
+
+def from_hex_sql(expression):
+  '''SQL for a fingerprint (or digest) column value, from an SQL expression
+  yielding a hex string (such as descriptor.descriptor, a lower-case digest.)
+  '''
+
+  return "decode(%s, 'hex')" % expression if BINARY_FINGERPRINTS else \
+    'upper(%s)' % expression
+
+def fp_bind(fingerprint):
+  '''a (hex) fingerprint as a bind parameter of the fingerprint column type,
+  for comparisons whose type SQLAlchemy can't infer (e.g. in tuple_()s.)
+  '''
+
+  return literal(fingerprint, fingerprint_type())
+
+def prefix_filter(column, prefix):
+  '''fingerprints (or digests) starting with the given hex prefix.
+
+  a LIKE for hex strings; in binary mode, a range between the lowest and the
+  highest fingerprint with that prefix, which a btree index can serve just
+  the same.
+  '''
+
+  prefix = prefix.upper() # (hex fingerprints are upper-case)
+  if not BINARY_FINGERPRINTS:
+    return column.like(prefix + '%')
+  if not prefix or len(prefix) > FP_LEN or not is_hex(prefix):
+    return false()
+  return column.between(prefix.ljust(FP_LEN, '0'), prefix.ljust(FP_LEN, 'F'))
+
+if __name__ == '__main__':
+  pass
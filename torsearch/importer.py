@@ -3,117 +3,433 @@
 
 from torsearch import db, debug_logger
 log = debug_logger.info
-from torsearch.models import Descriptor, Consensus, StatusEntry, Fingerprint
+from torsearch.models import Descriptor, Consensus, StatusEntry, Fingerprint,\
+  Presence
 from sqlalchemy import func
+from sqlalchemy.exc import DBAPIError
 from stem.descriptor import DocumentHandler
-from stem.descriptor.reader import DescriptorReader
-from config import COMMIT_AFTER
+from stem.descriptor.reader import DescriptorReader, load_processed_files,\
+  save_processed_files
+from torsearch.cache import latest_consensus
+from torsearch.bloom import known_fingerprints
+from torsearch.fingerprints import fp_key_sql, from_hex_sql, HexBytes
+from config import COMMIT_AFTER, BULK_IMPORT, IMPORT_WORKERS, IMPORT_WINDOW,\
+  CONSENSUS_NOTIFY_CHANNEL, UPDATE_PRESENCE, UPDATE_ADDRESS_HISTORY,\
+  RESOLVE_DESCRIPTORS, BLOOM_FILTER
+from cStringIO import StringIO
+import binascii
+import datetime
 import gc
 import os
-from multiprocessing import Process
+import time
+from multiprocessing import Process, Queue, BoundedSemaphore, Pool
 
 def get_subdirectories(dirname):
   return [name for name in os.listdir(dirname)
     if os.path.isdir(os.path.join(dirname, name))]
 
-def import_descriptors(wherefrom, persistence_file):
-  if not gc.isenabled():
-    gc.enable()
+# one set-based merge of a whole consensus worth of status entries into the
+# fingerprint table. the statusentry rows of that consensus (which we've just
+# inserted, and which are indexed on validafter) serve as the staging set.
+#
+# first_va/last_va are merged with LEAST()/GREATEST(), and the 'latest' fields
+# are only taken over if our consensus is the newest one seen for that
+# fingerprint, so importing older archives after recent data is safe (no need
+# for misc/update_first_va.sql or misc/update_fp.sql anymore.)
+#
+# requires PostgreSQL >= 9.5 (ON CONFLICT).
+FINGERPRINT_MERGE_SQL = ("INSERT INTO fingerprint (fp12, sid, fingerprint, "
+  "  digest, nickname, address, flags, first_va, last_va) "
+  "SELECT DISTINCT ON (%(fp_key)s) "
+  "  %(fp_key)s, id, fingerprint, digest, "
+  "  nickname, address, flags, validafter, validafter "
+  "  FROM statusentry WHERE validafter = :valid_after "
+  "  ORDER BY %(fp_key)s "
+  "ON CONFLICT (fp12) DO UPDATE SET "
+  "  first_va = LEAST(fingerprint.first_va, EXCLUDED.first_va), "
+  "  last_va = GREATEST(fingerprint.last_va, EXCLUDED.last_va), "
+  "  %(latest)s")
+
+FINGERPRINT_MERGE_LATEST = ('digest', 'nickname', 'address', 'flags', 'sid')
+
+# pg_advisory_xact_lock() key, held from the fingerprint merge until commit so
+# that importers add fingerprint rows one at a time: new rows are then
+# committed in fingerprint.seq order (which bloom.py relies on.)
+FINGERPRINT_LOCK = 0x746f72
+
+def merge_fingerprints(valid_after, upsert_check_va=True):
+  '''update/insert the Fingerprint table entries for all the status entries
+  of the consensus with the given valid_after, in a single statement.
+
+  upsert_check_va -- only take over the latest FINGERPRINT_MERGE_LATEST
+    columns (digest, nickname, ...) when valid_after is newer than the
+    entry's last_va. if False, they are overwritten unconditionally - all but
+    sid, which always stays that of the last_va status entry (the searches
+    join on both, see onionoo_api.do_search().)
+  '''
 
-  reader = DescriptorReader(wherefrom, persistence_path=persistence_file)
-  log('recalled %d files processed from my source(s) provided',
-    len(reader.get_processed_files()))
-  with reader:
-    i = 0 # need due to for() scope
-    for i, desc in enumerate(reader):
-      desc_model = Descriptor(desc)
-      db.session.add(desc_model)
-      if (i+1) % COMMIT_AFTER == 0:
-        log('row %d: committing.', i+1)
-        db.session.commit()
-        gc.collect()
-  log('iterated over %d files', i+1)
+  latest = ', '.join(('%s = CASE WHEN EXCLUDED.last_va > fingerprint.last_va '
+      'THEN EXCLUDED.%s ELSE fingerprint.%s END' % (col, col, col))
+    if upsert_check_va or col == 'sid' else '%s = EXCLUDED.%s' % (col, col)
+    for col in FINGERPRINT_MERGE_LATEST)
+
+  # (the CASE expressions see the old row's last_va, not the GREATEST() one.)
+  sql = FINGERPRINT_MERGE_SQL % {'fp_key': fp_key_sql(), 'latest': latest}
+  db.session.execute(db.text('SELECT pg_advisory_xact_lock(:key)'),
+    {'key': FINGERPRINT_LOCK})
+  return db.session.execute(db.text(sql),
+    {'valid_after': valid_after,
+     'fp_substr_len': Fingerprint.FP_SUBSTR_LEN}).rowcount
+
+# maintain the presence interval table for one consensus, set-based. each
+# status entry either extends an interval which ends just before it, or one
+# which starts just after it (consensuses may be imported out of order), or
+# both - in which case the two intervals are merged into one - or else starts
+# a new interval.
+PRESENCE_UPDATE_SQL = (
+  # extend forward
+  "UPDATE presence SET end_va = s.validafter, nickname = s.nickname, "
+  "  address = s.address "
+  "  FROM statusentry s "
+  "  WHERE s.validafter = :valid_after "
+  "    AND presence.fingerprint = s.fingerprint "
+  "    AND presence.end_va < :valid_after "
+  "    AND presence.end_va >= :valid_after - :gap",
+  # extend backward (keeping the nickname/address of the last entry)
+  "UPDATE presence SET start_va = s.validafter "
+  "  FROM statusentry s "
+  "  WHERE s.validafter = :valid_after "
+  "    AND presence.fingerprint = s.fingerprint "
+  "    AND presence.start_va > :valid_after "
+  "    AND presence.start_va <= :valid_after + :gap",
+  # merge intervals which now meet at valid_after
+  "WITH later AS ("
+  "  DELETE FROM presence b USING presence a "
+  "    WHERE a.fingerprint = b.fingerprint AND a.start_va < b.start_va "
+  "      AND a.end_va = :valid_after AND b.start_va = :valid_after "
+  "    RETURNING b.fingerprint, b.end_va, b.nickname, b.address) "
+  "UPDATE presence SET end_va = later.end_va, nickname = later.nickname, "
+  "  address = later.address "
+  "  FROM later "
+  "  WHERE presence.fingerprint = later.fingerprint "
+  "    AND presence.end_va = :valid_after",
+  # new intervals for everyone else
+  "INSERT INTO presence (fingerprint, start_va, end_va, nickname, address) "
+  "SELECT s.fingerprint, s.validafter, s.validafter, s.nickname, s.address "
+  "  FROM statusentry s "
+  "  WHERE s.validafter = :valid_after "
+  "    AND NOT EXISTS (SELECT 1 FROM presence p "
+  "      WHERE p.fingerprint = s.fingerprint "
+  "        AND p.start_va <= :valid_after AND p.end_va >= :valid_after)")
+
+def update_presence(valid_after):
+  '''update the Presence table with the status entries of the consensus with
+  the given valid_after. returns the number of new intervals.
+  '''
+
+  params = {'valid_after': valid_after, 'gap': Presence.CONSENSUS_INTERVAL}
+  for statement in PRESENCE_UPDATE_SQL:
+    result = db.session.execute(db.text(statement), params)
+  return result.rowcount
+
+# (DISTINCT ON: ON CONFLICT can't touch the same row twice in one statement.)
+ADDRESS_HISTORY_MERGE_SQL = ("INSERT INTO address_history (address, "
+  "  fingerprint, first_va, last_va) "
+  "SELECT DISTINCT ON (address, fingerprint) "
+  "  CAST(address AS inet), fingerprint, validafter, validafter "
+  "  FROM statusentry WHERE validafter = :valid_after AND address IS NOT NULL "
+  "ON CONFLICT (address, fingerprint) DO UPDATE SET "
+  "  first_va = LEAST(address_history.first_va, EXCLUDED.first_va), "
+  "  last_va = GREATEST(address_history.last_va, EXCLUDED.last_va)")
+
+# statusentry may be partitioned by month on validafter (see db/db_create.sql
+# and misc/partition_statusentry.sql.) if so, the importer creates monthly
+# partitions as it needs them.
+PARTITION_SQL = ("CREATE TABLE IF NOT EXISTS %s PARTITION OF statusentry "
+  "  FOR VALUES FROM ('%s') TO ('%s')")
+
+_statusentry_partitioned = None
+_partitions_created = set()
+
+def statusentry_partitioned():
+  '''whether statusentry is a partitioned table (checked once per process.)
+  '''
+
+  global _statusentry_partitioned
+  if _statusentry_partitioned is None:
+    relkind = db.session.execute(db.text("SELECT relkind FROM pg_class "
+      "WHERE oid = CAST('statusentry' AS regclass)")).scalar()
+    _statusentry_partitioned = relkind == 'p'
+  return _statusentry_partitioned
+
+def month_start(dt, months_later=0):
+  month = dt.month - 1 + months_later
+  return datetime.date(dt.year + month // 12, month % 12 + 1, 1)
+
+def partition_name(dt):
+  return 'statusentry_%04d_%02d' % (dt.year, dt.month)
+
+def ensure_partitions(valid_after):
+  '''make sure there are statusentry partitions for the month of valid_after
+  and the one after it (so that a new month's partition is usually created
+  well before it is needed, not while the API is busy reading the parent
+  table at the turn of the month.)
+
+  the DDL runs on a separate connection, outside the import transaction, so
+  that the lock it takes on statusentry is held only briefly.
+  '''
+
+  if not statusentry_partitioned():
+    return
+  for months_later in (0, 1):
+    start = month_start(valid_after, months_later)
+    name = partition_name(start)
+    if name in _partitions_created:
+      continue
+    try:
+      db.engine.execute(db.text(PARTITION_SQL % (name, start,
+        month_start(start, 1))).execution_options(autocommit=True))
+    except DBAPIError: # another importer process may have just created it
+      if not db.engine.execute(db.text("SELECT to_regclass(:name)"),
+          name=name).scalar():
+        raise
+    _partitions_created.add(name)
+
+def merge_address_history(valid_after):
+  '''update/insert the AddressHistory table entries for all the status
+  entries of the consensus with the given valid_after.
+  '''
+
+  return db.session.execute(db.text(ADDRESS_HISTORY_MERGE_SQL),
+    {'valid_after': valid_after}).rowcount
+
+def notify_new_consensus(valid_after):
+  '''let API processes know that a consensus has been imported (whether it is
+  the latest one or not: see bloom.py.) the NOTIFY is part of the current
+  transaction, so it is only delivered upon commit.
+  '''
+
+  db.session.execute(db.text("SELECT pg_notify(:channel, :valid_after)"),
+    {'channel': CONSENSUS_NOTIFY_CHANNEL,
+     'valid_after': valid_after.strftime('%Y-%m-%d %H:%M:%S')})
+
+def copy_value(value):
+  '''format a single value for COPY ... FROM STDIN (text format).
+  '''
+
+  if value is None:
+    return '\\N'
+  if isinstance(value, bool):
+    return 't' if value else 'f'
+  if isinstance(value, datetime.datetime):
+    return value.isoformat(' ')
+  return str(value).replace('\\', '\\\\').replace('\t', '\\t')\
+    .replace('\n', '\\n').replace('\r', '\\r')
+
+def copy_hex_value(value):
+  '''format a hex string for COPY into a bytea column (see HexBytes.)
+  '''
+
+  if value is None:
+    return '\\N'
+  return '\\\\x' + value # (hex format, backslash escaped)
+
+def copy_bytes_value(value):
+  '''format arbitrary bytes for COPY into a bytea column.
+  '''
+
+  if value is None:
+    return '\\N'
+  return copy_hex_value(binascii.hexlify(value))
+
+def copy_rows(table, columns, rows, like=None):
+  '''stream rows into table using COPY, as part of the current session's
+  transaction. returns the number of rows copied.
+
+  like -- the model table to take column types from, if table is not one
+    (e.g. a staging table.)
+  '''
+
+  table_columns = db.metadata.tables[like or table].columns
+  formats = [copy_hex_value if isinstance(table_columns[col].type, HexBytes)
+    else copy_bytes_value if isinstance(table_columns[col].type,
+      db.LargeBinary)
+    else copy_value for col in columns]
+  buf = StringIO()
+  n_rows = 0
+  for row in rows:
+    buf.write('\t'.join(f(value) for f, value in zip(formats, row)))
+    buf.write('\n')
+    n_rows += 1
+  buf.seek(0)
+
+  cursor = db.session.connection().connection.cursor()
+  try:
+    cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table,
+      ', '.join('"%s"' % col for col in columns)), buf)
+  finally:
+    cursor.close()
+  return n_rows
+
+def import_statuses_bulk(valid_after, statuses):
+  '''COPY all the status entries of a single consensus in one go.
+
+  returns the number of rows copied.
+  '''
+
+  return copy_rows(StatusEntry.__tablename__, StatusEntry.copy_columns(),
+    (StatusEntry.row_from_stem(status, valid_after) for status in statuses))
+
+def known_descriptors(digests):
+  '''the descriptor keys (lower-case digests) out of the given (hex) digests
+  whose server descriptors are in the database.
+  '''
+
+  keys = list(set(digest.lower() for digest in digests if digest))
+  if not keys:
+    return set()
+  return set(key for key, in db.session.execute(db.text("SELECT descriptor "
+    "FROM descriptor WHERE descriptor = ANY(:keys)"), {'keys': keys}))
+
+def resolve_descriptors(rows):
+  '''fill in the descriptor column of StatusEntry.row_from_stem() rows, for
+  those descriptors we already have (one index lookup per digest, before the
+  rows go in - no updates afterwards.) the rest are left to
+  import_descriptor_rows(), if and when their descriptors arrive.
+  '''
+
+  columns = StatusEntry.copy_columns()
+  digest_i = columns.index('digest')
+  descriptor_i = columns.index('descriptor')
+  known = known_descriptors(row[digest_i] for row in rows)
+  if not known:
+    return rows
+  resolved = []
+  for row in rows:
+    key = row[digest_i].lower() if row[digest_i] else None
+    if key in known:
+      row = row[:descriptor_i] + (key,) + row[descriptor_i+1:]
+    resolved.append(row)
+  return resolved
+
+def consensus_exists(valid_after):
+  # this is needed if the persistence file may contain different paths to
+  # the same documents. there are multiple ways of getting around this.
+
+  # this is the easiest way to solve things, and the query is fast and will
+  # be run only once per a whole consensus document.
+  # we need this when we switch to the 'recent' folder in rsync after having
+  # imported most of our stuff from the metrics archives.
+  # the archives and the rsync'ed 'recent' may overlap.
+
+  if Consensus.query.filter(Consensus.valid_after==valid_after).count():
+    log('Consensus document with valid-after %s already in database '
+        '- skipping this document.', valid_after.strftime('%y-%m-%d %H:%M:%S'))
+    return True
+  return False
+
+def consensus_to_rows(document, import_statuses=True):
+  '''turn Stem's NetworkStatusDocument into a compact, picklable form:
+
+  (dict of Consensus column values, list of StatusEntry.row_from_stem() rows)
+  '''
+
+  consensus = dict((col.name, getattr(document, col.name, None))
+    for col in Consensus.__table__.columns)
+  rows = []
+  if import_statuses:
+    rows = [StatusEntry.row_from_stem(status, document.valid_after)
+      for status in document.routers.values()]
+  return consensus, rows
+
+def import_consensus_rows(consensus, rows, check_if_exists=True,
+    upsert_check_va=True):
+  '''write a consensus_to_rows() result: COPY the status entries, merge the
+  fingerprint table, commit.
+  '''
+
+  if check_if_exists and consensus_exists(consensus['valid_after']):
+    return False
+
+  t1 = time.time()
+  if rows:
+    ensure_partitions(consensus['valid_after'])
+  doc_model = Consensus()
+  for name, value in consensus.iteritems():
+    setattr(doc_model, name, value)
+  db.session.add(doc_model)
+  db.session.flush() # the consensus row goes in before the COPY
+
+  n_statuses = 0
+  if rows:
+    if RESOLVE_DESCRIPTORS:
+      rows = resolve_descriptors(rows)
+    n_statuses = copy_rows(StatusEntry.__tablename__,
+      StatusEntry.copy_columns(), rows)
+    # update/insert relevant entries in the Fingerprint table.
+    merge_fingerprints(consensus['valid_after'],
+      upsert_check_va=upsert_check_va)
+    if UPDATE_PRESENCE:
+      update_presence(consensus['valid_after'])
+    if UPDATE_ADDRESS_HISTORY:
+      merge_address_history(consensus['valid_after'])
+
+  notify_new_consensus(consensus['valid_after'])
   db.session.commit()
+  latest_consensus.invalidate()
+  elapsed = time.time() - t1
+  log('Imported %d status entries in %.2fs (%.1f rows/s)', n_statuses,
+    elapsed, n_statuses / elapsed if elapsed else 0.0)
+  return True
 
 def import_consensus(document, import_statuses=True,
-    delete_statuses_later=True, check_if_exists=True, upsert_check_va=True):
-  if check_if_exists:
-    # this is needed if the persistence file may contain different paths to
-    # the same documents. there are multiple ways of getting around this.
-
-    # this is the easiest way to solve things, and the query is fast and will
-    # be run only once per a whole consensus document.
-    # we need this when we switch to the 'recent' folder in rsync after having
-    # imported most of our stuff from the metrics archives.
-    # the archives and the rsync'ed 'recent' may overlap.
-
-    if Consensus.query.filter(Consensus.valid_after==document.valid_after)\
-      .count():
-
-      log('Consensus document with valid-after %s already in database '
-          '- skipping this document.',
-          document.valid_after.strftime('%y-%m-%d %H:%M:%S'))
-      del document
-      return False
+    delete_statuses_later=True, check_if_exists=True, upsert_check_va=True,
+    bulk=BULK_IMPORT):
+  if bulk:
+    consensus, rows = consensus_to_rows(document, import_statuses)
+    if delete_statuses_later and import_statuses:
+      del document.routers
+    return import_consensus_rows(consensus, rows,
+      check_if_exists=check_if_exists, upsert_check_va=upsert_check_va)
 
+  if check_if_exists and consensus_exists(document.valid_after):
+    del document
+    return False
+
+  t1 = time.time()
+  n_statuses = 0
   doc_model = Consensus(document)
   db.session.add(doc_model)
 
   if import_statuses:
+    ensure_partitions(document.valid_after)
+    known = known_descriptors(status.digest
+      for status in document.routers.values()) if RESOLVE_DESCRIPTORS \
+      else set()
     for status in document.routers.values():
-      stat_model = StatusEntry(status, document.valid_after)
-      db.session.add(stat_model)
-      db.session.flush() # so we can get the new id attribute
-
-      # update/insert relevant entry in the Fingerprint table.
-      # we could simply query Fingerprint to see if there's already an entry
-      # for this particular fingerprint there (and depending on result, either
-      # update or insert), but it is much more efficient
-      # to do a kind of an 'upsert' in one transaction.
-      # to do this, we use a raw SQL query.
-
-      if not upsert_check_va:
-
-        # this query silently fails if there's no match in WHERE.
-        db.session.execute(db.text("UPDATE fingerprint SET "
-          "digest=:digest, nickname=:nickname, address=:address, "
-          "last_va=:last_va, sid=:sid WHERE fp12=:fp12"),
-          {'digest': stat_model.digest, 'nickname': stat_model.nickname,
-            'address': stat_model.address, 'last_va': stat_model.validafter,
-            'sid': stat_model.id, # the ORM will have assigned an id before
-                                  # our later commit - ORMs are useful
-            'fp12': stat_model.fingerprint[0:(Fingerprint.FP_SUBSTR_LEN-1)]})
-
-      else: # only UPDATE when the last entry's last_va is < our new one.
-
-        db.session.execute(db.text("UPDATE fingerprint SET "
-          "digest=:digest, nickname=:nickname, address=:address, "
-          "last_va=:last_va, sid=:sid "
-          "WHERE fp12=:fp12 AND EXISTS ("
-          "  SELECT 1 FROM fingerprint "
-          "    WHERE fp12=:fp12 AND last_va < :last_va)"),
-          {'digest': stat_model.digest, 'nickname': stat_model.nickname,
-            'address': stat_model.address, 'last_va': stat_model.validafter,
-            'sid': stat_model.id,
-            'fp12': stat_model.fingerprint[0:(Fingerprint.FP_SUBSTR_LEN-1)]})
-
-      # this query will also silently fail (in this case, if our fp is already
-      # in the table.)
-      db.session.execute(db.text("INSERT INTO fingerprint (fp12, sid, "
-        "fingerprint, digest, nickname, address, last_va, first_va) SELECT "
-        "  :fp12, :sid, :fingerprint, :digest, :nickname, :address, :last_va,"
-        "  :first_va "
-        "WHERE NOT EXISTS (SELECT 1 FROM fingerprint WHERE fp12=:fp12)"),
-          {'digest': stat_model.digest, 'nickname': stat_model.nickname,
-            'address': stat_model.address, 'last_va': stat_model.validafter,
-            'sid': stat_model.id, 'first_va': stat_model.validafter,
-            'fp12': stat_model.fingerprint[0:(Fingerprint.FP_SUBSTR_LEN-1)],
-            'fingerprint': stat_model.fingerprint, 'sid': stat_model.id})
+      status_model = StatusEntry(status, document.valid_after)
+      if status.digest and status.digest.lower() in known:
+        status_model.descriptor = status.digest.lower()
+      db.session.add(status_model)
+      n_statuses += 1
+    db.session.flush()
+
+    # update/insert relevant entries in the Fingerprint table.
+    merge_fingerprints(document.valid_after, upsert_check_va=upsert_check_va)
+    if UPDATE_PRESENCE:
+      update_presence(document.valid_after)
+    if UPDATE_ADDRESS_HISTORY:
+      merge_address_history(document.valid_after)
 
     if delete_statuses_later:
       del document.routers
 
+  notify_new_consensus(document.valid_after)
   db.session.commit()
+  latest_consensus.invalidate()
+  elapsed = time.time() - t1
+  log('Imported %d status entries in %.2fs (%.1f rows/s)', n_statuses,
+    elapsed, n_statuses / elapsed if elapsed else 0.0)
   return True
 
 def import_consensuses(wherefrom, persistence_file, import_statuses=True):
@@ -124,27 +440,185 @@ def import_consensuses(wherefrom, persistence_file, import_statuses=True):
     document_handler = DocumentHandler.DOCUMENT)
 
   iterated_over_something = False
+  n_statuses = 0
+  t1 = time.time()
   with reader:
     i = 0
 
     for i, doc in enumerate(reader):
+      doc_statuses = len(doc.routers) if import_statuses else 0
       if import_consensus(doc, import_statuses):
         log('Document %d (valid-after %s) committed.', i+1, doc.valid_after)
         iterated_over_something = True
+        n_statuses += doc_statuses
       gc.collect()
   gc.collect() # calling again just in case: reader is now closed,
                # can gc it (and docs)
+  if iterated_over_something and BLOOM_FILTER:
+    known_fingerprints.save() # (once per directory, see bloom.py)
   if iterated_over_something:
-    log('Iterated over %d documents', i+1)
+    elapsed = time.time() - t1
+    log('Iterated over %d documents, imported %d status entries '
+      '(%.1f rows/s overall)', i+1, n_statuses,
+      n_statuses / elapsed if elapsed else 0.0)
   else:
     log('No documents at %s were (re-)imported.', wherefrom)
 
-def batch_import_consensuses(consensus_dir, single_dir=False):
+def get_unprocessed_files(import_dir, persistence_file):
+  '''list the files under import_dir that DescriptorReader would read,
+  given the persistence file (same semantics: a file is skipped if its
+  last modified timestamp is not newer than the one recorded.)
+
+  returns (processed files dict as loaded, list of (path, mtime) to import)
+  '''
+
+  try:
+    processed = load_processed_files(persistence_file)
+  except (IOError, TypeError):
+    processed = {}
+
+  to_import = []
+  for dirname, dirnames, filenames in os.walk(import_dir):
+    dirnames.sort()
+    for filename in sorted(filenames):
+      path = os.path.abspath(os.path.join(dirname, filename))
+      if path == os.path.abspath(persistence_file) or \
+          not os.path.isfile(path):
+        continue
+      mtime = int(os.stat(path).st_mtime)
+      last_used = processed.get(path)
+      if last_used and last_used >= mtime:
+        continue
+      to_import.append((path, mtime))
+  return processed, to_import
+
+def parse_consensus_file(path, import_statuses=True):
+  '''parse a single consensus file (or archive) into a list of
+  consensus_to_rows() results.
+  '''
+
+  reader = DescriptorReader([path],
+    document_handler = DocumentHandler.DOCUMENT)
+  with reader:
+    return [consensus_to_rows(doc, import_statuses) for doc in reader]
+
+def parse_worker(tasks, results, window, import_statuses=True):
+  '''parse worker process body: take (seq, path) tasks, put
+  (seq, list of parsed documents) results.
+
+  the window semaphore is acquired before taking each task, and released by
+  the writer once that task's documents have been committed: this bounds how
+  many parsed documents can be in flight (waiting to be written.)
+  '''
+
+  while True:
+    window.acquire()
+    task = tasks.get()
+    if task is None:
+      window.release()
+      break
+    seq, path = task
+    try:
+      docs = parse_consensus_file(path, import_statuses)
+    except Exception as e:
+      debug_logger.error('Failed to parse %s: %s', path, str(e))
+      docs = []
+    results.put((seq, docs))
+    del docs
+    gc.collect()
+
+def import_consensuses_parallel(import_dirs, workers=IMPORT_WORKERS,
+    import_statuses=True, window_size=IMPORT_WINDOW):
+  '''pipelined import: N worker processes parse consensus files with Stem in
+  parallel, a single writer (this process) COPYs and commits them in order.
+
+  each import_dir keeps its own imported.persistence file, which is only
+  saved once all the files of that directory have been committed.
+  '''
+
+  if not gc.isenabled():
+    gc.enable()
+
+  tasks = [] # (import_dir index, path, mtime), in commit order
+  processed = []
+  for n, import_dir in enumerate(import_dirs):
+    persistence_file = os.path.join(import_dir, 'imported.persistence')
+    dir_processed, to_import = get_unprocessed_files(import_dir,
+      persistence_file)
+    log('Importing from directory %s.. (%d files already processed, %d to '
+      'go)', import_dir, len(dir_processed), len(to_import))
+    processed.append(dir_processed)
+    tasks.extend((n, path, mtime) for path, mtime in to_import)
+  if not tasks:
+    log('No documents at %s were (re-)imported.', ', '.join(import_dirs))
+    return
+
+  # files left in each directory, so we know when to save its persistence
+  remaining = [0] * len(import_dirs)
+  for n, path, mtime in tasks:
+    remaining[n] += 1
+
+  task_queue = Queue()
+  for seq, (n, path, mtime) in enumerate(tasks):
+    task_queue.put((seq, path))
+  workers = max(1, min(workers, len(tasks)))
+  for i in range(workers):
+    task_queue.put(None)
+  result_queue = Queue(window_size)
+  window = BoundedSemaphore(window_size)
+
+  procs = [Process(target=parse_worker, args=(task_queue, result_queue,
+    window, import_statuses)) for i in range(workers)]
+  for p in procs:
+    p.start()
+
+  t1 = time.time()
+  n_docs = n_statuses = 0
+  pending = {}
+  next_seq = 0
+  try:
+    while next_seq < len(tasks):
+      seq, docs = result_queue.get()
+      pending[seq] = docs
+      while next_seq in pending: # commit strictly in task order
+        n, path, mtime = tasks[next_seq]
+        for consensus, rows in pending.pop(next_seq):
+          if import_consensus_rows(consensus, rows):
+            n_docs += 1
+            n_statuses += len(rows)
+        processed[n][path] = mtime
+        remaining[n] -= 1
+        if not remaining[n]:
+          save_processed_files(os.path.join(import_dirs[n],
+            'imported.persistence'), processed[n])
+          if BLOOM_FILTER:
+            known_fingerprints.save() # (once per directory, see bloom.py)
+          log('Done importing from directory %s.', import_dirs[n])
+        window.release()
+        next_seq += 1
+        gc.collect()
+  finally:
+    for p in procs:
+      if next_seq < len(tasks):
+        p.terminate()
+      p.join()
+
+  elapsed = time.time() - t1
+  log('Imported %d documents, %d status entries with %d parse workers in '
+    '%.2fs (%.1f rows/s overall)', n_docs, n_statuses, workers, elapsed,
+    n_statuses / elapsed if elapsed else 0.0)
+
+def batch_import_consensuses(consensus_dir, single_dir=False,
+    workers=IMPORT_WORKERS):
   '''a simple high-level function to import consensuses and network statuses.
 
   garbage allocation does not happen on objects in an iterable while it's being
   iterated, this is a simple but more memory-efficient way to import larger
   amounts of consensuses (including network statuses)
+
+  workers -- number of parse worker processes (see
+    import_consensuses_parallel()). 0 means the old way: one process per
+    directory, one directory after another.
   '''
 
   def do_import(import_dir):
@@ -156,45 +630,166 @@ def batch_import_consensuses(consensus_dir, single_dir=False):
 
   if single_dir or not get_subdirectories(consensus_dir): # nowhere to recurse
                                                           # into (last level)
-    do_import(consensus_dir)
+    import_dirs = [consensus_dir]
+  else:
+    # we should not recurse (done by DescriptorReader / get_unprocessed_files)
+    import_dirs = [os.path.join(consensus_dir, subdir)
+      for subdir in sorted(get_subdirectories(consensus_dir))]
+
+  if workers:
+    import_consensuses_parallel(import_dirs, workers=workers)
     return
 
-  # FIXME: os.listdir() would be enough here.
-  # normally, here we'd iterate over os.walk()
-  # we should not recurse (done by DescriptorReader).
-  for dirname, dirnames, filenames in os.walk(consensus_dir):
-    for subdir in dirnames:
-      dir_to_import = os.path.join(dirname, subdir)
-      # the default/old way was:
-      #import_consensuses(dir_to_import, os.path.join(dir_to_import,
-      #  'imported.persistence'))
-
-      # not only does this (lazily) avoid possible memory leaks, but it's also
-      # one step towards parallelized import.
-      # no parallelization right now (lots of global state), but this is worth
-      # it in any case.
-      do_import(dir_to_import) # will create a Process object
-    break
-
-def batch_import_descriptors(descriptor_dir):
-  '''a simple high-level function to import server descriptors.
+  for dir_to_import in import_dirs:
+    # the default/old way was:
+    #import_consensuses(dir_to_import, os.path.join(dir_to_import,
+    #  'imported.persistence'))
+
+    # not only does this (lazily) avoid possible memory leaks, but it's also
+    # one step towards parallelized import.
+    do_import(dir_to_import) # will create a Process object
+
+# server descriptors are COPYed into a staging table, and from there into
+# descriptor, skipping the ones whose digest is already in (the archives and
+# the rsync'ed 'recent' descriptors overlap, and directories may be imported
+# more than once.) requires the unique index on descriptor.descriptor (see
+# misc/descriptor_unique.sql.)
+DESCRIPTOR_STAGING_SQL = ("CREATE TEMPORARY TABLE descriptor_staging "
+  "  ON COMMIT DROP AS SELECT %(columns)s FROM descriptor WITH NO DATA")
+DESCRIPTOR_MERGE_SQL = ("INSERT INTO descriptor (%(columns)s) "
+  "SELECT %(columns)s FROM descriptor_staging "
+  "ON CONFLICT (descriptor) DO NOTHING")
+
+# descriptors may be imported after the consensuses which refer to them: the
+# status entries still lacking a descriptor key get theirs once it arrives.
+# they are looked up by fingerprint and validafter (the statusentry index),
+# from when the descriptor was published up to DESCRIPTOR_MAX_AGE later.
+DESCRIPTOR_BACKFILL_SQL = ("UPDATE statusentry SET descriptor = d.descriptor "
+  "  FROM descriptor_staging d "
+  "  WHERE %(fp_key)s = %(descriptor_fp_key)s "
+  "    AND statusentry.validafter >= d.published "
+  "    AND statusentry.validafter < d.published + :max_age "
+  "    AND statusentry.digest = %(digest)s "
+  "    AND statusentry.descriptor IS NULL")
+
+# relays publish a new descriptor at least every 18 hours; the authorities
+# drop the ones that are older than a couple of days.
+DESCRIPTOR_MAX_AGE = datetime.timedelta(days=2)
+
+def backfill_descriptors():
+  '''link the status entries which refer to the descriptors in the staging
+  table to them (see DESCRIPTOR_BACKFILL_SQL.) returns the number of status
+  entries updated.
+  '''
+
+  sql = DESCRIPTOR_BACKFILL_SQL % {
+    'fp_key': fp_key_sql('statusentry.fingerprint'),
+    'descriptor_fp_key': fp_key_sql(from_hex_sql('d.fingerprint')),
+    'digest': from_hex_sql('d.descriptor')}
+  return db.session.execute(db.text(sql), {'max_age': DESCRIPTOR_MAX_AGE,
+    'fp_substr_len': Fingerprint.FP_SUBSTR_LEN}).rowcount
 
-  descriptor import is less cannibalistic in terms of memory usage, but
-  subprocess isolation still makes sense.
+def import_descriptor_rows(rows):
+  '''write a batch of Descriptor.row_from_stem() rows, commit. returns the
+  number of descriptors which were new.
   '''
 
-  for dirname, dirnames, filenames in os.walk(descriptor_dir):
-    for subdir in dirnames:
-      dir_to_import = os.path.join(dirname, subdir)
-      log('importing from directory %s..', dir_to_import)
-      import_descriptors(dir_to_import, os.path.join(dir_to_import,
-        'imported.persistence'))
+  columns = Descriptor.copy_columns()
+  sql_columns = {'columns': ', '.join('"%s"' % col for col in columns)}
+  db.session.execute(db.text(DESCRIPTOR_STAGING_SQL % sql_columns))
+  copy_rows('descriptor_staging', columns, rows,
+    like=Descriptor.__tablename__)
+  n_new = db.session.execute(db.text(DESCRIPTOR_MERGE_SQL % sql_columns))\
+    .rowcount
+  if RESOLVE_DESCRIPTORS:
+    n_linked = backfill_descriptors()
+    if n_linked:
+      log('linked %d earlier status entries to their descriptors', n_linked)
+  db.session.commit() # (drops the staging table)
+  return n_new
 
-      p = Process(target=import_descriptors, args=(dir_to_import,
-        os.path.join(dir_to_import, 'imported.persistence')))
-      p.start()
-      p.join()
-    break
+def import_descriptors(wherefrom, persistence_file):
+  '''import the server descriptors under wherefrom, COMMIT_AFTER at a time.
+
+  returns (descriptors read, descriptors new to the database.)
+  '''
+
+  if not gc.isenabled():
+    gc.enable()
+
+  reader = DescriptorReader(wherefrom, persistence_path=persistence_file)
+  log('recalled %d files processed from my source(s) provided',
+    len(reader.get_processed_files()))
+  n_read = n_new = 0
+  rows = []
+  with reader:
+    for desc in reader:
+      rows.append(Descriptor.row_from_stem(desc))
+      n_read += 1
+      if len(rows) >= COMMIT_AFTER:
+        n_new += import_descriptor_rows(rows)
+        log('row %d: committed.', n_read)
+        rows = []
+        gc.collect()
+    if rows:
+      n_new += import_descriptor_rows(rows)
+  return n_read, n_new
+
+def import_descriptor_dir(import_dir):
+  '''import one directory of server descriptors (a descriptor worker's
+  task.) returns (import_dir, descriptors read, new, seconds taken.)
+  '''
+
+  t1 = time.time()
+  log('importing from directory %s..', import_dir)
+  n_read, n_new = import_descriptors(import_dir,
+    os.path.join(import_dir, 'imported.persistence'))
+  elapsed = time.time() - t1
+  log('Imported %d new descriptors (of %d read) from %s in %.2fs '
+    '(%.1f descriptors/s)', n_new, n_read, import_dir, elapsed,
+    n_read / elapsed if elapsed else 0.0)
+  return import_dir, n_read, n_new, elapsed
+
+def batch_import_descriptors(descriptor_dir, workers=IMPORT_WORKERS):
+  '''a simple high-level function to import server descriptors.
+
+  the subdirectories of descriptor_dir (e.g. 0..f in the metrics archives)
+  are imported by that many worker processes in parallel, each with its own
+  database connection and persistence file.
+
+  workers -- number of worker processes. 0 means one directory after
+    another, in this process.
+  '''
+
+  import_dirs = [os.path.join(descriptor_dir, subdir)
+    for subdir in sorted(get_subdirectories(descriptor_dir))] or \
+    [descriptor_dir] # nowhere to recurse into (last level)
+
+  t1 = time.time()
+  n_read = n_new = 0
+  if workers:
+    # forked workers must not share the pooled connections of this process
+    db.session.remove()
+    db.engine.dispose()
+    pool = Pool(min(workers, len(import_dirs)))
+    try:
+      for import_dir, dir_read, dir_new, elapsed in \
+          pool.imap_unordered(import_descriptor_dir, import_dirs):
+        n_read += dir_read
+        n_new += dir_new
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    for import_dir in import_dirs:
+      import_dir, dir_read, dir_new, elapsed = import_descriptor_dir(import_dir)
+      n_read += dir_read
+      n_new += dir_new
+
+  elapsed = time.time() - t1
+  log('Imported %d new descriptors (of %d read) from %d directories with %d '
+    'workers in %.2fs (%.1f descriptors/s overall)', n_new, n_read,
+    len(import_dirs), workers, elapsed, n_read / elapsed if elapsed else 0.0)
 
 if __name__ == '__main__':
   pass
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''A long-running consensus ingest daemon (see tools/ingest_consensuses.py.)
+
+Watches a consensus directory (e.g. the rsync'ed metrics 'recent'
+consensuses) and imports every new or updated file as soon as it lands,
+instead of once an hour from cron. The database connection stays open (and
+is pinged when idle), and each committed consensus is NOTIFYed to the API
+processes (see importer.notify_new_consensus() and cache.py), so that they
+serve it within seconds.
+
+With pyinotify installed, the directory is watched with inotify; otherwise
+it is rescanned every INGEST_POLL_INTERVAL seconds (only file mtimes are
+looked at.) Either way, what has been imported is recorded in the
+directory's imported.persistence file, in the same format that the batch
+importer uses, so the two can take turns.
+'''
+
+import gc
+import os
+import time
+from sqlalchemy.exc import DBAPIError
+from stem.descriptor.reader import save_processed_files
+from torsearch import db, debug_logger
+from torsearch.importer import get_unprocessed_files, parse_consensus_file,\
+  import_consensus_rows
+from torsearch.bloom import known_fingerprints
+from config import INGEST_POLL_INTERVAL, INGEST_SETTLE, INGEST_KEEPALIVE,\
+  BLOOM_FILTER
+
+try:
+  import pyinotify
+except ImportError:
+  pyinotify = None
+
+log = debug_logger.info
+
+class IngestDaemon(object):
+  '''imports the consensus files under watch_dir as they come in.
+
+  poll_interval -- seconds between rescans, when not using inotify (or
+    between checks for files left for later, when using it.)
+  settle -- files modified less than this many seconds ago are left for the
+    next round (they may still be being written. rsync renames files into
+    place, so they land all at once.)
+  use_inotify -- None: if pyinotify is available.
+  '''
+
+  def __init__(self, watch_dir, poll_interval=INGEST_POLL_INTERVAL,
+      settle=INGEST_SETTLE, keepalive=INGEST_KEEPALIVE, use_inotify=None):
+    self.watch_dir = os.path.abspath(watch_dir)
+    self.persistence_file = os.path.join(self.watch_dir,
+      'imported.persistence')
+    self.poll_interval = poll_interval
+    self.settle = settle
+    self.keepalive = keepalive
+    self.use_inotify = pyinotify is not None if use_inotify is None \
+      else use_inotify
+    self.processed = {}
+    self.pending = set() # paths inotify told us about
+    self.rescan_due = False # there may be files inotify didn't tell us about
+    self.last_used = 0.0 # the database connection
+    self.running = False
+
+  def stop(self):
+    self.running = False
+
+  def run(self):
+    log('Ingesting consensuses from %s (%s)', self.watch_dir,
+      'inotify' if self.use_inotify else
+      'polling every %ds' % self.poll_interval)
+    self.running = True
+    self.ping()
+    self.rescan() # catch up with whatever came in while we were away
+    if self.use_inotify:
+      self._run_inotify()
+    else:
+      while self.running:
+        time.sleep(self.poll_interval)
+        self.rescan()
+        self.ping_if_idle()
+
+  def _run_inotify(self):
+    daemon = self
+
+    # (rsync writes into a temporary file, which it then moves into place)
+    written = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+
+    class Handler(pyinotify.ProcessEvent):
+      def process_default(self, event):
+        if event.dir:
+          # files may land in a new directory before we watch it
+          daemon.rescan_due = True
+        elif event.mask & written:
+          # (not IN_CREATE: those files may well be still being written)
+          daemon.pending.add(event.pathname)
+
+    manager = pyinotify.WatchManager()
+    manager.add_watch(self.watch_dir, written | pyinotify.IN_CREATE, rec=True,
+      auto_add=True)
+    notifier = pyinotify.Notifier(manager, Handler(),
+      timeout=self.poll_interval * 1000)
+    try:
+      while self.running:
+        if notifier.check_events():
+          notifier.read_events()
+          notifier.process_events()
+        if self.pending:
+          # (the files of these events have been written and closed)
+          paths, self.pending = self.pending, set()
+          self.import_files(paths, settle=0)
+        if self.rescan_due:
+          self.rescan_due = False
+          self.rescan()
+        self.ping_if_idle()
+    finally:
+      notifier.stop()
+
+  def rescan(self):
+    '''import whatever is new under watch_dir.
+    '''
+
+    self.processed, to_import = get_unprocessed_files(self.watch_dir,
+      self.persistence_file)
+    self.pending = set() # (we'll see those again, if they're still due)
+    self.import_files(path for path, mtime in to_import)
+
+  def import_files(self, paths, settle=None):
+    settle = self.settle if settle is None else settle
+    imported = False
+    for path in sorted(paths):
+      if not self.running:
+        break
+      if os.path.basename(path).startswith('.') or \
+          path == self.persistence_file or not os.path.isfile(path):
+        continue # (e.g. rsync's temporary files)
+      mtime = int(os.stat(path).st_mtime)
+      if self.processed.get(path) >= mtime:
+        continue
+      if time.time() - mtime < settle:
+        self.rescan_due = True # (look again next time)
+        continue
+      if self.import_file(path, mtime):
+        imported = True
+    if imported:
+      self.save_processed()
+      if BLOOM_FILTER:
+        known_fingerprints.save() # (see bloom.py)
+
+  def import_file(self, path, mtime):
+    '''returns whether path is done with (imported, or failed to parse.)
+    '''
+
+    t1 = time.time()
+    try:
+      docs = parse_consensus_file(path)
+    except Exception as e:
+      debug_logger.error('Failed to parse %s: %s', path, str(e))
+      self.processed[path] = mtime # (DescriptorReader would skip it, too)
+      return True
+
+    n_docs = 0
+    try:
+      for consensus, rows in docs:
+        if import_consensus_rows(consensus, rows):
+          n_docs += 1
+    except DBAPIError as e:
+      # (say, the database went away) - try again next time
+      debug_logger.error('Failed to import %s: %s', path, str(e))
+      self.reconnect()
+      self.pending.add(path)
+      return False
+    finally:
+      del docs
+      gc.collect()
+
+    self.last_used = time.time()
+    self.processed[path] = mtime
+    log('Ingested %s: %d new consensus documents, %.1fs after it landed '
+      '(import took %.2fs)', path, n_docs, time.time() - mtime,
+      time.time() - t1)
+    return True
+
+  def save_processed(self):
+    # (files which have since been removed, e.g. by rsync --delete, are
+    # forgotten)
+    save_processed_files(self.persistence_file,
+      dict((path, mtime) for path, mtime in self.processed.iteritems()
+        if os.path.exists(path)))
+
+  def ping(self):
+    '''keep the database connection warm (and find out if it's gone.)
+    '''
+
+    try:
+      db.session.execute('SELECT 1')
+      db.session.commit()
+    except DBAPIError as e:
+      debug_logger.warning('Database connection lost (%s), reconnecting',
+        str(e))
+      self.reconnect()
+    self.last_used = time.time()
+
+  def ping_if_idle(self):
+    if time.time() - self.last_used > self.keepalive:
+      self.ping()
+
+  def reconnect(self):
+    try:
+      db.session.rollback()
+    except DBAPIError:
+      pass
+    db.session.remove()
+    db.engine.dispose()
+
+if __name__ == '__main__':
+  pass
@@ -8,13 +8,13 @@ def exec_transactionless_query(query):
   "BEGIN TRANSACTION" / "END TRANSACTION" blocks.
   '''
 
-  conn = db.session.connection()
+  conn = db.session.connection().connection # the DB-API (psycopg2) one
   #conn.autocommit(False)
   orig_ilevel = conn.isolation_level
   try:
     conn.set_isolation_level(0)
     debug_logger.info('Running maintenance operation: %s', query)
-    db.session.execute(query)
+    conn.cursor().execute(query)
     debug_logger.info('Done running maintenance (%s)\nNotices: %s', query,
       conn.notices)
   except Exception as e:
@@ -24,7 +24,37 @@ def exec_transactionless_query(query):
     conn.set_isolation_level(orig_ilevel)
 
 def vacuum_full_analyze(table):
-  exec_transactionless_query('VACUUM FULL ANALYZE VERBOSE ' + table)
+  exec_transactionless_query('VACUUM FULL VERBOSE ANALYZE ' + table)
+
+def list_partitions(table='statusentry'):
+  '''(name, partition bound expression) of each partition of table, oldest
+  first. empty if table is not partitioned.
+  '''
+
+  return db.session.execute(db.text(
+    "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+    "  FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+    "  WHERE i.inhparent = CAST(:table AS regclass) "
+    "  ORDER BY c.relname"), {'table': table}).fetchall()
+
+def vacuum_partition(partition, full=False):
+  '''partitions can be vacuumed one at a time, e.g. only the current month's
+  (old months don't change.)
+  '''
+
+  exec_transactionless_query(('VACUUM FULL ANALYZE ' if full else
+    'VACUUM ANALYZE ') + partition)
+
+def detach_partition(partition, table='statusentry'):
+  '''take a partition (e.g. an old month) out of table. its rows are no
+  longer seen by queries; the partition is left as a standalone table, to be
+  archived or dropped.
+  '''
+
+  debug_logger.info('Detaching partition %s from %s', partition, table)
+  db.session.execute('ALTER TABLE %s DETACH PARTITION %s' % (table,
+    partition))
+  db.session.commit()
 
 if __name__ == '__main__':
   pass
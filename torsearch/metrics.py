@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Request metrics, exposed in the Prometheus text format (see /metrics.)
+
+Every API request is timed, labelled with its endpoint and query class
+(lookup, fingerprint, address, nickname, running, no-term; see
+onionoo_api.query_class().) The time spent fetching rows from the database is
+measured separately (see db_time() and timed_rows()); the rest of the
+request is (mostly) serialization. For streamed responses, the two are
+interleaved, and the request is only done once the response is closed.
+
+Metrics are kept per process, like the caches: with several worker
+processes, each one reports its own.
+'''
+
+import time
+import threading
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+
+# in seconds. our queries are mostly in the milliseconds, but tails matter
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+  1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000)
+
+def label_str(names, values, extra=''):
+  pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+    .replace('"', '\\"')) for name, value in zip(names, values)]
+  if extra:
+    pairs.append(extra)
+  return '{%s}' % ','.join(pairs) if pairs else ''
+
+class Counter(object):
+  def __init__(self, name, help, labelnames=()):
+    self.name = name
+    self.help = help
+    self.labelnames = labelnames
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def inc(self, labels=(), amount=1):
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+  def render(self):
+    lines = ['# HELP %s %s' % (self.name, self.help),
+      '# TYPE %s counter' % self.name]
+    with self._lock:
+      for labels, value in sorted(self._values.iteritems()):
+        lines.append('%s%s %s' % (self.name,
+          label_str(self.labelnames, labels), value))
+    return lines
+
+class Histogram(object):
+  def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.help = help
+    self.labelnames = labelnames
+    self.buckets = buckets
+    self._values = {} # labels => [per-bucket counts, sum, count]
+    self._lock = threading.Lock()
+
+  def observe(self, value, labels=()):
+    with self._lock:
+      counts, total, count = self._values.get(labels,
+        ([0] * len(self.buckets), 0, 0))
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+      self._values[labels] = (counts, total + value, count + 1)
+
+  def render(self):
+    lines = ['# HELP %s %s' % (self.name, self.help),
+      '# TYPE %s histogram' % self.name]
+    with self._lock:
+      for labels, (counts, total, count) in sorted(self._values.iteritems()):
+        for bound, bucket_count in zip(self.buckets, counts):
+          lines.append('%s_bucket%s %d' % (self.name,
+            label_str(self.labelnames, labels, 'le="%s"' % bound),
+            bucket_count))
+        lines.append('%s_bucket%s %d' % (self.name,
+          label_str(self.labelnames, labels, 'le="+Inf"'), count))
+        lines.append('%s_sum%s %s' % (self.name,
+          label_str(self.labelnames, labels), repr(total)))
+        lines.append('%s_count%s %d' % (self.name,
+          label_str(self.labelnames, labels), count))
+    return lines
+
+class Gauge(object):
+  '''a value read at render time, from fn().
+  '''
+
+  def __init__(self, name, help, fn, type='gauge'):
+    self.name = name
+    self.help = help
+    self.fn = fn
+    self.type = type
+
+  def render(self):
+    return ['# HELP %s %s' % (self.name, self.help),
+      '# TYPE %s %s' % (self.name, self.type),
+      '%s %s' % (self.name, self.fn())]
+
+LABELS = ('endpoint', 'query_class')
+
+REQUESTS = Counter('torsearch_requests_total',
+  'API requests, by response status.', LABELS + ('status',))
+REQUEST_SECONDS = Histogram('torsearch_request_duration_seconds',
+  'API request latency, until the response is closed.', LABELS)
+DB_SECONDS = Histogram('torsearch_db_duration_seconds',
+  'Time per request spent executing queries and fetching rows.', LABELS)
+SERIALIZE_SECONDS = Histogram('torsearch_serialize_duration_seconds',
+  'Time per request spent outside the database (mostly serialization.)',
+  LABELS)
+ROWS = Histogram('torsearch_rows_returned',
+  'Result rows fetched per request.', LABELS, buckets=ROW_BUCKETS)
+
+registry = [REQUESTS, REQUEST_SECONDS, DB_SECONDS, SERIALIZE_SECONDS, ROWS]
+
+def register(metric):
+  registry.append(metric)
+  return metric
+
+def render():
+  '''all the metrics, in the Prometheus text exposition format.
+  '''
+
+  lines = []
+  for metric in registry:
+    lines.extend(metric.render())
+  return '\n'.join(lines) + '\n'
+
+class RequestMetrics(object):
+  '''the timings of a single request.
+  '''
+
+  def __init__(self, endpoint, query_class):
+    self.labels = (endpoint, query_class)
+    self.started = time.time()
+    self.db_seconds = 0.0
+    self.rows = 0
+
+  def finish(self, status):
+    total = time.time() - self.started
+    REQUESTS.inc(self.labels + (str(status),))
+    REQUEST_SECONDS.observe(total, self.labels)
+    DB_SECONDS.observe(self.db_seconds, self.labels)
+    SERIALIZE_SECONDS.observe(max(total - self.db_seconds, 0.0), self.labels)
+    ROWS.observe(self.rows, self.labels)
+
+def current():
+  '''the RequestMetrics of the current request, if any (None outside of
+  requests, e.g. in benchmarks.)
+  '''
+
+  if not has_request_context():
+    return None
+  return getattr(g, 'request_metrics', None)
+
+class Stopwatch(object):
+  seconds = 0.0
+
+@contextmanager
+def db_time():
+  '''count the time spent in the block as database time. yields a Stopwatch,
+  whose seconds are set once the block is done.
+  '''
+
+  stopwatch = Stopwatch()
+  began = time.time()
+  try:
+    yield stopwatch
+  finally:
+    stopwatch.seconds = time.time() - began
+    metrics = current()
+    if metrics:
+      metrics.db_seconds += stopwatch.seconds
+
+def add_rows(n):
+  metrics = current()
+  if metrics:
+    metrics.rows += n
+
+def timed_rows(rows, done=None):
+  '''passes (streamed) rows through, counting them and the time spent
+  fetching them as database time. done(seconds), if given, is called with
+  the total once all the rows have been fetched.
+  '''
+
+  metrics = current()
+  rows = iter(rows)
+  total = 0.0
+  while True:
+    began = time.time()
+    try:
+      row = next(rows)
+    except StopIteration:
+      row = StopIteration
+    elapsed = time.time() - began
+    total += elapsed
+    if metrics:
+      metrics.db_seconds += elapsed
+    if row is StopIteration:
+      if done:
+        done(total)
+      return
+    if metrics:
+      metrics.rows += 1
+    yield row
+
+def init_app(app, query_class, skip_endpoints=('metrics', 'static')):
+  '''time all the requests to app. query_class(args) classifies a request
+  by its arguments.
+  '''
+
+  @app.before_request
+  def start_request_metrics():
+    if request.endpoint and request.endpoint not in skip_endpoints:
+      g.request_metrics = RequestMetrics(request.endpoint,
+        query_class(request.args))
+
+  @app.after_request
+  def finish_request_metrics(response):
+    metrics = current()
+    if metrics:
+      # (streamed responses are still to be generated at this point)
+      status = response.status_code
+      response.call_on_close(lambda: metrics.finish(status))
+    return response
+
+if __name__ == '__main__':
+  pass
@@ -2,8 +2,34 @@
 # -*- coding: utf-8 -*-
 
 from torsearch import db
+from torsearch.fingerprints import fingerprint_type, FP_LEN, FP_SUBSTR_LEN
+from sqlalchemy.dialects.postgresql import INET
+from collections import OrderedDict
+import datetime
 import stem
 
+# router flags are stored packed into an integer bitmask, one bit per flag.
+# (the bits follow the order of the boolean isAuthority..isV3Dir columns they
+# replace, see misc/flags_bitmask.sql.) new flags go at the end - never
+# reorder these.
+FLAG_BITS = OrderedDict((flag, 1 << i) for i, flag in enumerate([
+  'Authority', 'BadExit', 'BadDirectory', 'Exit', 'Fast', 'Guard', 'HSDir',
+  'Named', 'Stable', 'Running', 'Unnamed', 'Valid', 'V2Dir', 'V3Dir']))
+FLAG_BITS_LOWER = dict((flag.lower(), bit) for flag, bit in
+  FLAG_BITS.iteritems()) # flag names are matched case-insensitively
+
+def flags_to_bits(flags):
+  '''pack a list of flag names into a bitmask (unknown flags are ignored.)
+  '''
+
+  bits = 0
+  for flag in flags:
+    bits |= FLAG_BITS_LOWER.get(flag.lower(), 0)
+  return bits
+
+def bits_to_flags(bits):
+  return [flag for flag, bit in FLAG_BITS.iteritems() if bits & bit]
+
 class Descriptor(db.Model):
   '''Corresponds to Stem's ServerDescriptor.
 
@@ -65,8 +91,9 @@ class Descriptor(db.Model):
       value = None
       if col.name in onto.morphisms:
         value = onto.morphisms[col.name](stem_desc)
-      elif col.name in stem_desc.__dict__:
-        value = stem_desc.__dict__[col.name]
+      else:
+        # (not __dict__: Stem parses server descriptors lazily)
+        value = getattr(stem_desc, col.name, None)
       if value:
         if self.NO_UNICODE and isinstance(value, unicode):
           value = str(value) # this already assumes that the original value
@@ -74,6 +101,35 @@ class Descriptor(db.Model):
                              # so safe
         setattr(onto, col.name, value)
 
+  @classmethod
+  def copy_columns(cls):
+    '''column names, in the order row_from_stem() returns values in.
+    '''
+
+    return [col.name for col in cls.__table__.columns]
+
+  @classmethod
+  def row_from_stem(cls, stem_desc):
+    '''map Stem's ServerDescriptor onto a plain tuple of column values
+
+    does what map_from_stem() does, minus the ORM object; used by the bulk
+    (COPY) import path.
+    '''
+
+    row = []
+    for name in cls.copy_columns():
+      value = None
+      if name in cls.morphisms:
+        value = cls.morphisms[name](stem_desc)
+      else:
+        value = getattr(stem_desc, name, None)
+      if not value and value is not False:
+        value = None # (map_from_stem() leaves these unset, too)
+      elif cls.NO_UNICODE and isinstance(value, unicode):
+        value = str(value) # ditto re: we know it is ascii-encodable
+      row.append(value)
+    return tuple(row)
+
 class Consensus(db.Model):
   '''Represents a network status document.
 
@@ -120,17 +176,19 @@ class StatusEntry(db.Model):
 
   NO_UNICODE = True
 
-  id = db.Column(db.Integer, primary_key=True)
-  validafter = db.Column(db.DateTime, index=True)#, primary_key=True) # composite primary key (1/2)
+  # the primary key has to include the partitioning column (see
+  # db/db_create.sql); id alone is still unique.
+  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+  validafter = db.Column(db.DateTime, primary_key=True, index=True)
   nickname = db.Column(db.String(19))
-  fingerprint = db.Column(db.String(40))#, primary_key=True) # composite primary key (2/2)
+  fingerprint = db.Column(fingerprint_type())
   published = db.Column(db.DateTime, index=True)
 
-  # TODO: proper column naming.
-  # As of now, what we call a 40-char-length 'descriptor' is called
-  # a 'digest'; that is how it is referred to
-  # in dir-spec.txt, and how it appears in Stem's RouterStatusEntry.
-  # Hence as of now, this column is empty.
+  # what we call a 40-char-length 'descriptor' is called a 'digest' in
+  # dir-spec.txt and in Stem's RouterStatusEntry (see below.) this column is
+  # the key of the server descriptor (Descriptor.descriptor, the lower-case
+  # digest) - set by the importer only once we have that descriptor (see
+  # importer.resolve_descriptors() and import_descriptor_rows()), NULL before.
   descriptor = db.Column(db.String(40), index=True)
 
   address = db.Column(db.String(15), index=True)
@@ -143,32 +201,14 @@ class StatusEntry(db.Model):
 
   # to quote dir-spec.txt, '"Digest" is a hash of its most recent descriptor as
   # signed (that is, not including the signature), encoded in base64.'
-  digest = db.Column(db.String(40), index=True)
+  digest = db.Column(fingerprint_type(), index=True)
 
   bandwidth = db.Column(db.BigInteger)
   measured = db.Column(db.BigInteger)
   is_unmeasured = db.Column(db.Boolean)
 
-  # and now the flags (for automatic mapping, we will
-  # wickedly access __tables__ again directly, and look
-  # for fields starting with 'is')
-  # this does allow for some nice automated model mapping, and will need
-  # minimal adjustments upon protocol / data format changes.
-
-  isAuthority = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isBadExit = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isBadDirectory = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isExit = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isFast = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isGuard = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isHSDir = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isNamed = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isStable = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isRunning = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isUnnamed = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isValid = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isV2Dir = db.Column(db.Boolean, server_default=db.text('FALSE'))
-  isV3Dir = db.Column(db.Boolean, server_default=db.text('FALSE'))
+  # and now the flags, as a FLAG_BITS bitmask (see flags_to_bits().)
+  flags = db.Column(db.Integer)
 
   morphisms = {}
 
@@ -188,40 +228,112 @@ class StatusEntry(db.Model):
     onto.validafter = validafter
     for col in onto.__table__.columns:
       value = None
-      if col.name in stem_status.__dict__:
+      if col.name == 'flags':
+        value = flags_to_bits(stem_status.flags)
+      elif col.name in stem_status.__dict__:
         if col.name not in onto.morphisms:
           value = stem_status.__dict__[col.name]
         else:
           value = onto.morphisms[col.name](stem_status)
-      elif col.name.startswith('is'): #and col.name[2:] in \
-                                      #  map(str.lower, stem_status.flags):
-        for flag in stem_status.flags: # is_measured will have been processed
-                                       # before
-          if flag.lower() == col.name[2:].lower(): # just in case
-            setattr(onto, col.name, True)
       if value is not None:
         if self.NO_UNICODE and isinstance(value, unicode):
           value = str(value) # ditto re: we know it is ascii-encodable
         setattr(onto, col.name, value)
 
+  @classmethod
+  def copy_columns(cls):
+    '''column names, in the order row_from_stem() returns values in.
+
+    the id is left for the database (sequence default) to fill in.
+    '''
+
+    return [col.name for col in cls.__table__.columns if col.name != 'id']
+
+  @classmethod
+  def row_from_stem(cls, stem_status, validafter):
+    '''map Stem's RouterStatusEntry onto a plain tuple of column values
+
+    does what map_from_stem() does, minus the ORM object; used by the bulk
+    (COPY) import path.
+    '''
+
+    row = []
+    for name in cls.copy_columns():
+      value = None
+      if name == 'validafter':
+        value = validafter
+      elif name == 'flags':
+        value = flags_to_bits(stem_status.flags)
+      elif name in stem_status.__dict__:
+        if name not in cls.morphisms:
+          value = stem_status.__dict__[name]
+        else:
+          value = cls.morphisms[name](stem_status)
+      if cls.NO_UNICODE and isinstance(value, unicode):
+        value = str(value) # ditto re: we know it is ascii-encodable
+      row.append(value)
+    return tuple(row)
+
 class Fingerprint(db.Model):
   '''A helper table which contains a unique fingerprint index.
   '''
 
   __tablename__ = 'fingerprint'
 
-  FP_LEN = 40
-  FP_SUBSTR_LEN = 12
+  FP_LEN = FP_LEN
+  FP_SUBSTR_LEN = FP_SUBSTR_LEN
 
-  fp12 = db.Column(db.String(FP_SUBSTR_LEN), primary_key=True)
-  fingerprint = db.Column(db.String(40))
-  digest = db.Column(db.String(40))
+  # in binary mode, the whole fingerprint (see torsearch.fingerprints.)
+  fp12 = db.Column(fingerprint_type(FP_SUBSTR_LEN), primary_key=True)
+  fingerprint = db.Column(fingerprint_type())
+  digest = db.Column(fingerprint_type())
   nickname = db.Column(db.String(19), index=True)
   address = db.Column(db.String(15))
   first_va = db.Column(db.DateTime)
   last_va = db.Column(db.DateTime)
-  sid = db.Column(db.ForeignKey('statusentry.id'))
+  # StatusEntry.id of the last_va entry. (no foreign key: on a partitioned
+  # table, id alone isn't a key.)
+  sid = db.Column(db.Integer)
+  flags = db.Column(db.Integer) # those of the last status entry (see sid)
+  # numbers rows in the order they were inserted in (see bloom.py)
+  seq = db.Column(db.BigInteger, db.Sequence('fingerprint_seq_seq'),
+    server_default=db.text("nextval('fingerprint_seq_seq'::regclass)"))
+
+class Presence(db.Model):
+  '''Intervals during which a relay was (continuously) present in the
+  consensus.
+
+  Maintained by the importer (see importer.update_presence()), one row per
+  run of status entries no more than CONSENSUS_INTERVAL apart. nickname and
+  address are those of the last status entry in the interval.
+  '''
+
+  __tablename__ = 'presence'
 
+  # consensuses are (normally) published every hour. a relay missing from
+  # a consensus (a gap longer than this) ends its interval.
+  CONSENSUS_INTERVAL = datetime.timedelta(hours=1)
+
+  fingerprint = db.Column(fingerprint_type(), primary_key=True)
+  start_va = db.Column(db.DateTime, primary_key=True)
+  end_va = db.Column(db.DateTime)
+  nickname = db.Column(db.String(19))
+  address = db.Column(db.String(15))
+
+class AddressHistory(db.Model):
+  '''Every address a relay has ever been seen with, and when.
+
+  Maintained by the importer (see importer.merge_address_history().) The
+  address is an inet, so that (btree) index range scans can answer prefix
+  and CIDR searches.
+  '''
+
+  __tablename__ = 'address_history'
+
+  address = db.Column(INET, primary_key=True)
+  fingerprint = db.Column(fingerprint_type(), primary_key=True)
+  first_va = db.Column(db.DateTime)
+  last_va = db.Column(db.DateTime)
 
 if __name__ == '__main__':
   pass
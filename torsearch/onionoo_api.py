@@ -2,31 +2,67 @@
 # -*- coding: utf-8 -*-
 
 import sys
-import time
 import datetime
+import base64
+import json
+from collections import namedtuple
 from dateutil.parser import parse as dt_parse
-from flask import Response, request, jsonify, abort, redirect
-from sqlalchemy import func, select, distinct
+from flask import Response, request, jsonify, abort, redirect, \
+  stream_with_context
+from sqlalchemy import func, select, distinct, tuple_, case, and_, or_, false
 from sqlalchemy.sql.expression import Select
 from torsearch import app, db, debug_logger
-from torsearch.models import Descriptor, Consensus, StatusEntry, Fingerprint
-from torsearch.query_info import run_explain
-from torsearch.profiler import profile
+from torsearch.models import Descriptor, Consensus, StatusEntry, Fingerprint,\
+  Presence, AddressHistory, FLAG_BITS_LOWER, bits_to_flags
+from torsearch.cache import latest_consensus, LRUCache
+from torsearch import metrics
+from torsearch.fingerprints import is_hex, fp_key, fp_key_value, fp_bind, \
+  prefix_filter
+from torsearch.query_info import slow_query_log
+from torsearch import profiler
+from torsearch.snapshot import RunningRelays
+from torsearch.bloom import known_fingerprints
+from config import RESULT_CACHE_SIZE, STREAM_RESPONSES, STATUSES_UPPER_LIMIT,\
+  BINARY_FINGERPRINTS, RUNNING_SNAPSHOT, BLOOM_FILTER, UPDATE_PRESENCE
 
 UPPER_LIMIT = 500 # max number of results per query, for now
                   # this can go into config.py
 
-OUTPUT_TIME = True # a simple way to do (very) primitive 'live' benchmarking
-                   # if True, will output query times to log
-                   # this is for running the backend live (in dev/debug mode),
-                   # as in `python run.py >> _run.log 2>&1` etc.,
-                   # without doing the actual benchmarking via benchmark.py
-                   # useful for real life query times (we should probably make
-                   # it even more rigorous - generate 'live usage'
-                   # reports/profiles that can be easily parsed. etc.)
-                   # (note: _run.log != debug.log; we output to debug.lot by
-                   # default; Flask accompanies us with simple HTTP query
-                   # summaries to stdout.
+SEARCH_MODES = ('prefix', 'substring', 'fuzzy') # nickname search modes
+TRGM_MIN_LEN = 3 # shorter terms can't use the trigram index; they fall back
+                 # to prefix search
+
+STREAM_CHUNK = 100 # rows fetched from the DB cursor / written to the client
+                   # at a time, when streaming responses
+
+# do_search() results, keyed on the normalized query arguments (see
+# normalize_args()). results are only valid for a given latest consensus, so
+# we clear the cache whenever that changes.
+result_cache = LRUCache(RESULT_CACHE_SIZE)
+latest_consensus.add_listener(lambda consensus: result_cache.clear())
+metrics.register(metrics.Gauge('torsearch_result_cache_entries',
+  'Result sets in the result cache.', lambda: len(result_cache)))
+for stat in ('hits', 'misses', 'evictions'):
+  metrics.register(metrics.Gauge('torsearch_result_cache_%s_total' % stat,
+    'Result cache %s.' % stat, lambda stat=stat: getattr(result_cache, stat),
+    type='counter'))
+
+# the relays of the latest consensus, for running=true searches (see
+# search_snapshot()); rebuilt whenever that changes.
+running_relays = RunningRelays()
+if RUNNING_SNAPSHOT:
+  latest_consensus.add_listener(running_relays.rebuild)
+metrics.register(metrics.Gauge('torsearch_running_snapshot_relays',
+  'Relays in the running relays snapshot.',
+  lambda: len(running_relays.snapshot or ())))
+
+# all the fingerprints we know of, so that lookups of others need no query
+# (see unknown_lookup()); caught up after every import, in order or not.
+if BLOOM_FILTER:
+  latest_consensus.add_listener(known_fingerprints.refresh, every_refresh=True)
+metrics.register(metrics.Gauge('torsearch_unknown_lookups_total',
+  'Lookups answered without a query, as their fingerprint is unknown.',
+  lambda: known_fingerprints.misses, type='counter'))
 
 def sql_search_nickname(nickname):
   '''executes a raw SQL query returning a result set matching a particular
@@ -122,20 +158,197 @@ def search_nickname_details(nickname):
   q = q.limit(100)
   return q
 
+def get_limit(args=None, upper_limit=UPPER_LIMIT):
+  if not args:
+    args = request.args
+  return min(upper_limit, max(int(args['limit']), 0) if 'limit' in args\
+    else upper_limit)
+
 def offset_limit(query, upper_limit=UPPER_LIMIT, args=None):
   '''apply offset and limit params, if present.
   '''
 
   if not args:
     args = request.args
-  limit = min(upper_limit, max(int(args['limit']), 0) if 'limit' in args\
-    else upper_limit)
+  limit = get_limit(args, upper_limit)
   offset = int(args['offset']) if 'offset' in args else 0
   if offset > 0:
     query = query.offset(offset)
   query = query.limit(limit)
   return query
 
+def valid_fingerprint(fingerprint):
+  '''a full (40 hex character) fingerprint.
+  '''
+
+  return len(fingerprint) == Fingerprint.FP_LEN and is_hex(fingerprint)
+
+def encode_cursor(validafter, fingerprint):
+  '''an opaque token for resuming a result set after the row with the given
+  (validafter, fingerprint) - see get_cursor().
+  '''
+
+  return base64.urlsafe_b64encode(validafter.strftime('%Y%m%d%H%M%S') + ':' +
+    str(fingerprint)).rstrip('=')
+
+def decode_cursor(token):
+  '''returns (validafter, fingerprint), or None if the token is malformed.
+  '''
+
+  try:
+    token = str(token)
+    decoded = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    validafter, fingerprint = decoded.split(':', 1)
+    validafter = datetime.datetime.strptime(validafter, '%Y%m%d%H%M%S')
+  except (TypeError, ValueError, UnicodeError):
+    return None
+  if not valid_fingerprint(fingerprint):
+    return None
+  return validafter, fingerprint
+
+def get_cursor(args=None):
+  '''the (validafter, fingerprint) of the last row seen, if a 'cursor'
+  param is present.
+
+  results are ordered by (validafter, fingerprint) descending, so resuming
+  from a cursor is a matter of an index range scan on that key - as opposed
+  to OFFSET, which has to produce and throw away all the preceding rows.
+  '''
+
+  if not args:
+    args = request.args
+  if not args.get('cursor'):
+    return None
+  return decode_cursor(args['cursor'])
+
+def bad_cursor(args=None):
+  '''whether a 'cursor' param was given but could not be understood (or
+  can't be used: fuzzy search results are not in cursor order.)
+  '''
+
+  if not args:
+    args = request.args
+  return bool(args.get('cursor')) and (get_cursor(args) is None or
+    args.get('search_mode') == 'fuzzy')
+
+trgm_installed = None # (see trgm_available())
+
+def trgm_available():
+  '''whether fuzzy search can be done: it needs pg_trgm's % operator and
+  similarity() (see misc/create_nickname_trgm_idx.sql.) checked once per
+  process.
+  '''
+
+  global trgm_installed
+  if trgm_installed is None:
+    trgm_installed = db.session.execute("SELECT 1 FROM pg_extension "
+      "WHERE extname = 'pg_trgm'").first() is not None
+    if not trgm_installed:
+      debug_logger.warning('pg_trgm is not installed: fuzzy nickname '
+        'searches will be refused')
+  return trgm_installed
+
+def bad_search_mode(args=None):
+  if not args:
+    args = request.args
+  mode = args.get('search_mode', 'prefix')
+  return mode not in SEARCH_MODES or (mode == 'fuzzy' and
+    not trgm_available())
+
+def search_mode(term, args=None):
+  '''the nickname search mode to use for term.
+  '''
+
+  if not args:
+    args = request.args
+  mode = args.get('search_mode', 'prefix')
+  if mode not in SEARCH_MODES or len(term) < TRGM_MIN_LEN:
+    return 'prefix'
+  return mode
+
+def get_flag_bits(args=None):
+  '''the FLAG_BITS of the flags in the (comma-separated) 'flag' param, or
+  None if there is an unknown flag among them.
+  '''
+
+  if not args:
+    args = request.args
+  bits = []
+  for flag in args.get('flag', '').split(','):
+    flag = flag.strip().lower()
+    if not flag:
+      continue
+    if flag not in FLAG_BITS_LOWER:
+      return None
+    bits.append(FLAG_BITS_LOWER[flag])
+  return sorted(set(bits))
+
+def bad_flags(args=None):
+  return get_flag_bits(args) is None
+
+def filter_flags(query, column, args=None):
+  '''keep rows which have all the flags asked for.
+
+  one (flags & bit) <> 0 test per flag, which is what the partial indexes
+  on fingerprint (fingerprint_exit_idx etc.) are defined with.
+  '''
+
+  where = 'where' if isinstance(query, Select) else 'filter'
+  for bit in get_flag_bits(args) or []:
+    query = getattr(query, where)(column.op('&')(bit) != 0)
+  return query
+
+def like_escape(term):
+  return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_nickname(q, term, mode):
+  '''restrict q to relays whose nickname matches term.
+
+  prefix is served by fingerprint_lower_idx; substring and fuzzy by the
+  fingerprint_lower_trgm_idx trigram (GIN) index. fuzzy matches are nicknames
+  similar enough to term (see pg_trgm's similarity_threshold), and are
+  ordered by similarity (see search_order().)
+  '''
+
+  nickname = func.lower(Fingerprint.nickname)
+  if mode == 'substring':
+    return q.where(nickname.like('%' + like_escape(term.lower()) + '%'))
+  if mode == 'fuzzy':
+    # pg_trgm's % operator; doubled, as operator text is not escaped for
+    # psycopg2's pyformat paramstyle
+    return q.where(nickname.op('%%')(term.lower()))
+  return q.where(nickname.like(term.lower() + '%'))
+
+def search_order(term=None, mode='prefix'):
+  '''ORDER BY clauses for do_search() with a search term. (on the fingerprint
+  table alone - validafter is last_va there - so that
+  fingerprint_last_va_fingerprint_idx can serve the order and the cursor.)
+  '''
+
+  order = [Fingerprint.last_va.desc(), Fingerprint.fingerprint.desc()]
+  if mode == 'fuzzy':
+    order.insert(0, func.similarity(func.lower(Fingerprint.nickname),
+      term.lower()).desc())
+  return order
+
+def next_cursor(entries, args=None, upper_limit=UPPER_LIMIT):
+  '''the cursor for the page after entries, if entries is a full page.
+  '''
+
+  return cursor_after(entries[-1] if entries else None, len(entries), args,
+    upper_limit)
+
+def cursor_after(last, count, args=None, upper_limit=UPPER_LIMIT):
+  '''the cursor for the page after a page of count rows ending with last, if
+  that was a full page.
+  '''
+
+  if last is None or count < get_limit(args, upper_limit):
+    return None
+  if (args or request.args).get('search_mode') == 'fuzzy':
+    return None # not in cursor order
+  return encode_cursor(last.validafter, last.fingerprint)
+
 def get_from_to(args=None):
   '''apply date-range (from..to) params, if present.
   '''
@@ -166,15 +379,153 @@ def from_to(query, args=None):
   '''
 
   c_from, c_to = get_from_to(args=args)
+  # (works for both Query and lower-level Select objects)
+  where = 'where' if isinstance(query, Select) else 'filter'
 
   if c_from and c_from <= (c_to if c_to else c_from):
-    query = query.filter(StatusEntry.validafter >= c_from)
+    query = getattr(query, where)(StatusEntry.validafter >= c_from)
   if c_to and c_to >= (c_from if c_from else c_to):
     #query = query.filter(StatusEntry.validafter <= c_to)
-    query = query.filter(StatusEntry.validafter < c_to)
+    query = getattr(query, where)(StatusEntry.validafter < c_to)
 
   return query
 
+def ip_to_str(ip):
+  return '.'.join(str((ip >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+def address_ranges(term):
+  '''turn an IPv4 address search term into a list of (lowest, highest)
+  address pairs covering all the addresses it matches, or None if the term
+  can't be an address.
+
+  '1.2.3.0/24' is a CIDR; anything else is a prefix of the dotted address,
+  just like a LIKE 'term%' on the address string would be: '1.2.' matches
+  1.2.*.*, and '1.2.3' matches 1.2.3.* and 1.2.30-39.*.
+  '''
+
+  addr, slash, bits = term.partition('/')
+  octets = addr.split('.')
+  if len(octets) > 4:
+    return None
+  if slash: # CIDR; like PostgreSQL, allow leaving out trailing zero octets
+    if not bits.isdigit() or int(bits) > 32 or \
+        not all(o.isdigit() and int(o) <= 255 for o in octets):
+      return None
+    ip = 0
+    for o in octets + ['0'] * (4 - len(octets)):
+      ip = (ip << 8) | int(o)
+    host_mask = (1 << (32 - int(bits))) - 1
+    return [(ip_to_str(ip & ~host_mask), ip_to_str(ip | host_mask))]
+
+  whole, last = octets[:-1], octets[-1]
+  if not all(o.isdigit() and int(o) <= 255 for o in whole):
+    return None
+  if last == '': # ends with a dot: any value
+    values = [(0, 255)]
+  elif not last.isdigit() or int(last) > 255:
+    return None
+  elif last.startswith('0'): # addresses have no leading zeros
+    values = [(0, 0)] if last == '0' else []
+  else: # last octet is a prefix itself
+    v = int(last)
+    values = [(v, v)] + [(v * m, min(v * m + m - 1, 255))
+      for m in (10, 100) if v * m <= 255]
+  prefix = 0
+  for o in whole:
+    prefix = (prefix << 8) | int(o)
+  shift = 8 * (3 - len(whole))
+  prefix <<= 8 + shift
+  return [(ip_to_str(prefix | (lo << shift)),
+    ip_to_str(prefix | (hi << shift) | ((1 << shift) - 1)))
+    for lo, hi in values]
+
+def search_address(q, term, c_from=None, c_to=None):
+  '''restrict q to relays which have ever used an address matching term.
+
+  goes through the address history (index range scans on inet), rather than
+  Fingerprint.address, which only has the latest address of each relay.
+  '''
+
+  ranges = address_ranges(term)
+  if not ranges:
+    return q.where(false())
+  used = select([fp_key(AddressHistory.fingerprint)]).where(or_(*[
+      AddressHistory.address.between(lo, hi) for lo, hi in ranges]))
+  if c_from: # used within the date range
+    used = used.where(AddressHistory.last_va >= c_from)
+  if c_to:
+    used = used.where(AddressHistory.first_va < c_to)
+  return q.where(Fingerprint.fp12.in_(used))
+
+def query_class(args=None):
+  '''the kind of query the arguments make, as do_search() tells them apart:
+  lookup, fingerprint, address, nickname, running or no-term. (for metrics.)
+  '''
+
+  if not args:
+    args = request.args
+  if args.get('lookup'):
+    return 'lookup'
+  term = args.get('search')
+  if term:
+    if len(term) > 19 or term.startswith('$'):
+      return 'fingerprint'
+    if '.' in term:
+      return 'address'
+    return 'nickname'
+  if args.get('running'):
+    return 'running'
+  return 'no-term'
+
+metrics.init_app(app, query_class)
+profiler.init_app(app, query_class)
+
+def observe_query(query, seconds):
+  '''hand (the time taken by) a query over to the slow query log.
+  '''
+
+  request_metrics = metrics.current()
+  slow_query_log.observe(query, seconds,
+    request_metrics.labels if request_metrics else (None, None))
+
+def unknown_lookup(args=None):
+  '''whether the lookup param is a valid fingerprint which we definitely
+  don't know of (see bloom.py.) such lookups have no results.
+  '''
+
+  if not args:
+    args = request.args
+  lookup = args.get('lookup')
+  return bool(lookup) and valid_fingerprint(lookup) and \
+    not known_fingerprints.might_exist(lookup)
+
+def normalize_args(args=None):
+  '''reduce the query arguments that do_search() looks at to a canonical,
+  hashable tuple: queries which are bound to return the same results map to
+  the same tuple.
+  '''
+
+  if not args:
+    args = request.args
+  lookup = args['lookup'] if \
+    ('lookup' in args and valid_fingerprint(args['lookup'])) else None
+  term = None
+  mode = 'prefix'
+  if not lookup and 'search' in args and args['search']:
+    term = args['search']
+    if not (len(term) > 19 or term.startswith('$') or '.' in term):
+      term = term.lower() # nickname searches are case-insensitive
+      mode = search_mode(term, args)
+  running = args['running'] if 'running' in args and args['running'] else None
+  if running is not None:
+    running = False if running.lower() in ('0', 'false') else True
+  c_from, c_to = get_from_to(args)
+  limit = get_limit(args)
+  offset = max(int(args['offset']), 0) if 'offset' in args else 0
+  flags = sum(get_flag_bits(args) or [])
+  return (lookup, term, mode, flags, running, c_from, c_to, get_cursor(args),
+    offset, limit)
+
 def do_search(last_validafter, args=None):
   '''this is our current, generalized database querying method.
   '''
@@ -182,7 +533,7 @@ def do_search(last_validafter, args=None):
   if not args:
     args = request.args
   lookup = args['lookup'] if \
-    ('lookup' in args and len(args['lookup']) == Fingerprint.FP_LEN) else None
+    ('lookup' in args and valid_fingerprint(args['lookup'])) else None
   term = args['search'] if 'search' in args and args['search'] else None
   if lookup:
     term = lookup
@@ -207,16 +558,20 @@ def do_search(last_validafter, args=None):
           q = q.filter(Fingerprint.first_va >= c_from)
         if c_to:
           q = q.filter(Fingerprint.last_va < c_to)
-        q = q.order_by(Fingerprint.last_va.desc())
     if not running['do_query']:
       c_from, c_to = get_from_to(args)
       if c_from:
         q = q.filter(Fingerprint.first_va >= c_from)
       if c_to:
         q = q.filter(Fingerprint.last_va < c_to)
-      q = q.order_by(Fingerprint.last_va.desc()) # we do an inner ORDER BY, so
-                                                 # we can internally LIMIT =>
-                                                 # our JOIN will be easier
+    q = filter_flags(q, Fingerprint.flags, args)
+    cursor = get_cursor(args)
+    if cursor: # resume after the last (last_va, fingerprint) seen
+      q = q.filter(tuple_(Fingerprint.last_va, Fingerprint.fingerprint) <
+        tuple_(cursor[0], fp_bind(cursor[1])))
+    # we do an inner ORDER BY, so we can internally LIMIT => our JOIN will be
+    # easier. (fingerprint makes the order total, which cursors rely on.)
+    q = q.order_by(Fingerprint.last_va.desc(), Fingerprint.fingerprint.desc())
     # if there's an OFFSET, we have to put it here.
     # + do an inner LIMIT at this point, before the JOIN -
     # we'll only need to JOIN <= UPPER_LIMIT rows
@@ -224,21 +579,26 @@ def do_search(last_validafter, args=None):
     q = offset_limit(q, args=args)
     q = q.from_self(Fingerprint.fingerprint, Fingerprint.first_va,
       Fingerprint.last_va, StatusEntry.or_port, StatusEntry.address,\
-      StatusEntry.validafter, StatusEntry.dir_port, StatusEntry.nickname)\
-      .join(StatusEntry, Fingerprint.sid == StatusEntry.id)
+      StatusEntry.validafter, StatusEntry.dir_port, StatusEntry.nickname,
+      StatusEntry.flags)\
+      .join(StatusEntry, and_(Fingerprint.sid == StatusEntry.id,
+        StatusEntry.validafter == Fingerprint.last_va)) # (sid is the status
+                                                        # entry of last_va:
+                                                        # lets a partitioned
+                                                        # statusentry prune)
     q = from_to(q, args)
 
-    if not (running['do_query'] and running['condition']):
-      q = q.order_by(StatusEntry.validafter.desc()) # the JOIN itself will
-                                                    # leave the rows disordered
-                                                    # again
+    q = q.order_by(StatusEntry.validafter.desc(),
+      Fingerprint.fingerprint.desc()) # the JOIN itself will leave the rows
+                                      # disordered again
 
   else:
 
+    mode = 'prefix'
     q = select([Fingerprint.nickname, Fingerprint.fingerprint,
       Fingerprint.first_va, Fingerprint.last_va, StatusEntry.address,
       StatusEntry.or_port, StatusEntry.dir_port, StatusEntry.published,
-      StatusEntry.validafter])
+      StatusEntry.validafter, StatusEntry.flags])
 
     if running['do_query']:
       if running['condition']:
@@ -248,190 +608,630 @@ def do_search(last_validafter, args=None):
     if len(term) > 19 or term.startswith('$'): # fingerprint
       term = term[1:] if term.startswith('$') else term
       if lookup: # exact match
-        q = q.where(Fingerprint.fingerprint == term)
+        q = q.where(and_(Fingerprint.fp12 == fp_key_value(term),
+          Fingerprint.fingerprint == term)) # (a primary key lookup)
       else: # search
-        q = q.where(Fingerprint.fingerprint.like(term + '%'))
-        #q = q.where(func.substr(Fingerprint.fingerprint, 0,
-        #  Fingerprint.FP_SUBSTR_LEN) == term[:Fingerprint.FP_SUBSTR_LEN-1])
+        # (in binary mode, fp12 is the whole fingerprint: its index serves
+        # prefix ranges)
+        q = q.where(prefix_filter(Fingerprint.fp12 if BINARY_FINGERPRINTS
+          else Fingerprint.fingerprint, term))
     elif '.' in term: # FIXME: primitive heuristics
-      # TODO: probably have a distinct 'address' table with a unique address
-      # column
-
-      #q = q.where(StatusEntry.address.like(term + '%')) # the WHERE filtering
-                                                         # would happen after
-                                                         # the WHERE clause
-      #q = q.where(StatusEntry.address.like(term)) # this actually executes
-                                                   # rather decently -
-                                                   # TODO: benchmark this
-
-      q = q.where(Fingerprint.address.like(term + '%')) # this gets the job
-                                                        # done, but we lose
-                                                        # a subset of
-                                                        # addresses!
+      q = search_address(q, term, *get_from_to(args))
     else:
-      q = q.where(func.lower(Fingerprint.nickname).like(term.lower() + '%'))
+      mode = search_mode(term, args)
+      q = search_nickname(q, term, mode)
+    q = filter_flags(q, Fingerprint.flags, args)
     c_from, c_to = get_from_to(args)
     if c_from:
       q = q.where(Fingerprint.first_va >= c_from)
     if c_to:
       q = q.where(Fingerprint.last_va < c_to)
     q = q.where(Fingerprint.sid == StatusEntry.id) # implicit inner join
+    q = q.where(StatusEntry.validafter == Fingerprint.last_va) # ditto re:
+                                                               # partitions
     if c_from:
       q = q.where(StatusEntry.validafter >= c_from)
     if c_to:
       q = q.where(StatusEntry.validafter < c_to)
-    if not (running['do_query'] and running['condition']):
-      q = q.order_by(StatusEntry.validafter.desc())
+    cursor = get_cursor(args)
+    if cursor: # resume after the last (last_va, fingerprint) seen
+      q = q.where(tuple_(Fingerprint.last_va, Fingerprint.fingerprint) <
+        tuple_(cursor[0], fp_bind(cursor[1])))
+    q = q.order_by(*search_order(term, mode))
     # we didn't OFFSET/LIMIT before the JOIN, do it now
     q = offset_limit(q, args=args)
 
   return q
 
-#@profile # uncomment to get info on how much time is spent and where it's
-          # being spent
-def get_results(query_type='details', args=None):
-  last_consensus = Consensus.query.order_by(Consensus.valid_after.desc())\
-    .first()
+def search_snapshot(last_validafter, args=None):
+  '''do_search() for running=true searches, answered from the running relays
+  snapshot (see snapshot.py) - or None if the query can't be (the snapshot
+  isn't there, or there's a date range, fuzzy search or LIKE wildcards.)
+  the rows are the same (descriptor columns included), in the same order.
+  '''
+
+  if not args:
+    args = request.args
+  running = args.get('running')
+  if not running or running.lower() in ('0', 'false'):
+    return None
+  snapshot = running_relays.get(last_validafter)
+  if snapshot is None or args.get('from') or args.get('to'):
+    return None
+
+  lookup = args['lookup'] if \
+    ('lookup' in args and valid_fingerprint(args['lookup'])) else None
+  term = args['search'] if 'search' in args and args['search'] else None
+  if lookup:
+    # (an exact match: hex case only doesn't matter in binary mode)
+    found = snapshot.lookup(lookup.upper() if BINARY_FINGERPRINTS else lookup)
+  elif not term:
+    found = snapshot.everything()
+  elif len(term) > 19 or term.startswith('$'): # fingerprint
+    term = term[1:] if term.startswith('$') else term
+    if not is_hex(term):
+      return None
+    found = snapshot.fingerprint_prefix(term.upper())
+  elif '.' in term:
+    ranges = address_ranges(term)
+    found = snapshot.address_ranges(ranges) if ranges else []
+  else:
+    mode = search_mode(term, args)
+    if mode == 'fuzzy':
+      return None
+    if mode == 'substring':
+      found = snapshot.nickname_substring(term)
+    elif '%' in term or '_' in term or '\\' in term:
+      return None # (wildcards in a prefix LIKE)
+    else:
+      found = snapshot.nickname_prefix(term)
+
+  rows = snapshot.rows
+  bits = get_flag_bits(args) or []
+  cursor = get_cursor(args)
+  entries = []
+  # all the rows have the same validafter: (validafter, fingerprint)
+  # descending is fingerprint descending, i.e. row numbers descending
+  for i in sorted(found, reverse=True):
+    row = rows[i]
+    if any(not (row.flags or 0) & bit for bit in bits):
+      continue
+    if cursor and not (row.validafter, row.fingerprint) < cursor:
+      continue
+    entries.append(row)
+  offset = max(int(args['offset']), 0) if 'offset' in args else 0
+  return entries[offset:offset + get_limit(args)]
+
+# the server descriptor fields of details documents
+DESCRIPTOR_COLUMNS = (Descriptor.platform, Descriptor.average_bandwidth,
+  Descriptor.burst_bandwidth, Descriptor.observed_bandwidth,
+  Descriptor.exit_policy)
+
+def with_descriptor(q):
+  '''add DESCRIPTOR_COLUMNS to a do_search() query: an outer join from the
+  status entries (at most one per result row) on their descriptor key, which
+  is the unique index of the descriptor table. relays whose descriptors we
+  don't have get NULLs.
+  '''
+
+  if isinstance(q, Select):
+    q = q.select_from(StatusEntry.__table__.outerjoin(Descriptor.__table__,
+      Descriptor.descriptor == StatusEntry.descriptor))
+    for column in DESCRIPTOR_COLUMNS:
+      q = q.column(column)
+    return q
+  return q.outerjoin(Descriptor, Descriptor.descriptor ==
+    StatusEntry.descriptor).add_columns(*DESCRIPTOR_COLUMNS)
+
+def cached(cache_key, rows):
+  '''passes rows through, putting them into result_cache once all of them
+  have been seen (i.e. the whole response has been written out.)
+  '''
+
+  seen = []
+  for row in rows:
+    seen.append(row)
+    yield row
+  result_cache.put(cache_key, seen)
+
+def get_results(query_type='details', args=None, stream=False):
+  '''returns (latest consensus, entries). entries is a list, unless stream is
+  True, in which case it may be an iterator over a server-side DB cursor.
+  '''
+
+  last_consensus = latest_consensus.get()
+  if unknown_lookup(args):
+    return last_consensus, []
+
+  # (details documents also have descriptor fields, see with_descriptor().)
+  details = query_type == 'details'
+  cache_key = (last_consensus.valid_after, details) + normalize_args(args)
+  entries = result_cache.get(cache_key)
+  if entries is not None:
+    metrics.add_rows(len(entries))
+    return last_consensus, entries
+
+  entries = search_snapshot(last_consensus.valid_after, args)
+  if entries is not None: # (no database query needed)
+    metrics.add_rows(len(entries))
+    return last_consensus, entries
 
   query = do_search(last_consensus.valid_after, args=args)
+  if details:
+    query = with_descriptor(query)
 
-  # do an EXPLAIN, report any Seq Scans to log:
-  #run_explain(query, output_statement=True, output_explain=True)
+  # (slow and sampled queries get logged and EXPLAINed, see query_info)
+  if stream:
+    with metrics.db_time() as stopwatch:
+      if isinstance(query, Select):
+        entries = db.session.execute(
+          query.execution_options(stream_results=True))
+      else:
+        entries = query.yield_per(STREAM_CHUNK)
+    return last_consensus, cached(cache_key, metrics.timed_rows(entries,
+      done=lambda seconds: observe_query(query, stopwatch.seconds + seconds)))
 
-  if OUTPUT_TIME:
-    t1 = time.time()
-  if isinstance(query, Select):
-    entries = db.session.execute(query)
-  else:
-    entries = query.all() # higher-level Query object
-  if OUTPUT_TIME:
-    t2 = time.time()
-    debug_logger.info(str(datetime.datetime.now()) + \
-      ' - query finished, took: %s', t2 - t1)
-    #print datetime.datetime.now(), '- query finished, took:', t2 - t1
+  with metrics.db_time() as stopwatch:
+    if isinstance(query, Select):
+      entries = db.session.execute(query)
+    else:
+      entries = query.all() # higher-level Query object
+    entries = list(entries)
+  metrics.add_rows(len(entries))
+  observe_query(query, stopwatch.seconds)
 
+  result_cache.put(cache_key, entries)
   return last_consensus, entries
 
+def timestamp(dt):
+  return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+def summary_relay(e, last_consensus):
+  relay = {
+    'f': e.fingerprint,
+    'a': [e.address],
+    'r': e.last_va == last_consensus.valid_after
+  }
+  if e.nickname != 'Unnamed':
+    relay['n'] = e.nickname
+  return relay
+
+def details_relay(e, last_consensus):
+  relay = {
+    'fingerprint': e.fingerprint,
+    #'or_addresses': [e.address + ':' + str(e.or_port)],
+    'exit_addresses': [e.address],
+    'running': e.last_va == last_consensus.valid_after,
+    'last_seen': timestamp(e.last_va),
+    'first_seen': timestamp(e.first_va),
+    'flags': bits_to_flags(e.flags or 0)
+  }
+  #if e.dir_port:
+  #  relay['dir_addresses'] = [e.address + ':' + str(e.dir_port)]
+  if e.nickname != 'Unnamed':
+    relay['nickname'] = e.nickname
+  # from the server descriptor, if we have it
+  if e.platform:
+    relay['platform'] = e.platform
+  if e.average_bandwidth is not None: # (zeros are stored as NULLs)
+    relay['bandwidth_rate'] = e.average_bandwidth
+    relay['bandwidth_burst'] = e.burst_bandwidth or 0
+    relay['observed_bandwidth'] = e.observed_bandwidth or 0
+    relay['advertised_bandwidth'] = min(relay['bandwidth_rate'],
+      relay['bandwidth_burst'], relay['observed_bandwidth'])
+  if e.exit_policy:
+    relay['exit_policy_summary'] = exit_policy_summary(e.exit_policy)
+  return relay
+
+def exit_policy_summary(summary):
+  '''Stem's exit policy summary ('accept 80, 443' / 'reject 1-65535') in
+  the Onionoo form ({'accept': ['80', '443']}.)
+  '''
+
+  action, _, ports = summary.partition(' ')
+  return {action: ports.split(', ')}
+
+def status_entry(e):
+  entry = {
+    'exit_addresses': [e.address],
+    'valid-after': timestamp(e.validafter),
+    'flags': bits_to_flags(e.flags or 0)
+  }
+  if e.nickname != 'Unnamed':
+    entry['nickname'] = e.nickname
+  return entry
+
+def status_range(r):
+  return {
+    'valid_after_from': timestamp(r.valid_after_from),
+    'valid_after_to': timestamp(r.valid_after_to),
+    'last_addresses': [r.address],
+    'last_nickname': r.nickname
+  }
+
+class RowTally(object):
+  '''iterates over rows, keeping count of them and remembering the last one
+  (for when rows are streamed, and we can't just len() them afterwards.)
+  '''
+
+  def __init__(self, rows):
+    self.rows = rows
+    self.count = 0
+    self.last = None
+
+  def __iter__(self):
+    for row in self.rows:
+      self.count += 1
+      self.last = row
+      yield row
+
+  def next_cursor(self, args=None, upper_limit=UPPER_LIMIT):
+    return cursor_after(self.last, self.count, args, upper_limit)
+
+def json_stream(head, key, items, tail):
+  '''yields a JSON object piece by piece: the fields in head, then key with
+  the list of items, then the fields returned by tail(count of items), which
+  is only called once all the items have been written out.
+  '''
+
+  yield json.dumps(head)[:-1] + (', ' if head else '') + json.dumps(key) + \
+    ': ['
+  count = 0
+  chunk = []
+  for item in items:
+    chunk.append(json.dumps(item))
+    count += 1
+    if len(chunk) >= STREAM_CHUNK:
+      yield (', ' if count > len(chunk) else '') + ', '.join(chunk)
+      chunk = []
+  if chunk:
+    yield (', ' if count > len(chunk) else '') + ', '.join(chunk)
+  yield ']' + ''.join(', %s: %s' % (json.dumps(k), json.dumps(v))
+    for k, v in tail(count).iteritems()) + '}'
+
+def respond(head, key, items, tail):
+  '''make a JSON document response out of head, key: items, tail(count) (see
+  json_stream()), streaming it if STREAM_RESPONSES is on.
+  '''
+
+  if STREAM_RESPONSES:
+    return Response(stream_with_context(json_stream(head, key, items, tail)),
+      mimetype='application/json')
+  data = dict(head)
+  data[key] = list(items)
+  data.update(tail(len(data[key])))
+  resp = jsonify(data)
+  resp.status_code = 200
+  return resp
+
+def page_tail(tally, upper_limit=UPPER_LIMIT):
+  '''count (and next, if there's a next page) fields for a document.
+  '''
+
+  def tail(count):
+    fields = {'count': count}
+    cursor = tally.next_cursor(upper_limit=upper_limit)
+    if cursor:
+      fields['next'] = cursor
+    return fields
+  return tail
+
 @app.route('/')
 def index():
   #return 'Placeholder index page.'
   return 'Placeholder index page.<br />'\
-  'Try /summary, /details, /statuses.<br />'\
+  'Try /summary, /details, /statuses, /presence.<br />'\
   '<a href='\
   '"https://github.com/wfn/torsearch/blob/master/docs/onionoo_api.md">'\
   'API documentation/summary.</a>'
 
 @app.route('/summary')
 def summary():
-  last_consensus, entries = get_results('summary')
-  data = {'relays_published': last_consensus.valid_after\
-    .strftime('%Y-%m-%d %H:%M:%S'), 'relays': []}
-  for e in entries:
-    data['relays'].append({
-      'f': e.fingerprint,
-      'a': [e.address],
-      'r': e.last_va == last_consensus.valid_after
-    })
-    if e.nickname != 'Unnamed':
-      data['relays'][-1]['n'] = e.nickname
-
-  data['count'] = len(data['relays'])
-  resp = jsonify(data)
-  resp.status_code = 200
-  return resp
+  if bad_cursor() or bad_search_mode() or bad_flags():
+    return abort(400)
+  last_consensus, entries = get_results('summary', stream=STREAM_RESPONSES)
+  entries = RowTally(entries)
+  return respond({'relays_published': timestamp(last_consensus.valid_after)},
+    'relays', (summary_relay(e, last_consensus) for e in entries),
+    page_tail(entries))
 
 @app.route('/details')
 def details():
-  last_consensus, entries = get_results('details')
-  data = {'relays_published': last_consensus.valid_after\
-    .strftime('%Y-%m-%d %H:%M:%S'), 'relays': []}
-  for e in entries:
-    data['relays'].append({
-      'fingerprint': e.fingerprint,
-      #'or_addresses': [e.address + ':' + str(e.or_port)],
-      'exit_addresses': [e.address],
-      'running': e.last_va == last_consensus.valid_after,
-      'last_seen': e.last_va.strftime('%Y-%m-%d %H:%M:%S'),
-      'first_seen': e.first_va.strftime('%Y-%m-%d %H:%M:%S')
-    })
-    #if e.dir_port:
-    #  data['relays'][-1]['dir_addresses'] = [e.address + ':' + str(e.dir_port)]
-    if e.nickname != 'Unnamed':
-      data['relays'][-1]['nickname'] = e.nickname
-
-  data['count'] = len(data['relays'])
-  resp = jsonify(data)
-  resp.status_code = 200
-  return resp
+  if bad_cursor() or bad_search_mode() or bad_flags():
+    return abort(400)
+  last_consensus, entries = get_results('details', stream=STREAM_RESPONSES)
+  entries = RowTally(entries)
+  return respond({'relays_published': timestamp(last_consensus.valid_after)},
+    'relays', (details_relay(e, last_consensus) for e in entries),
+    page_tail(entries))
+
+def statuses_upper_limit(stream=STREAM_RESPONSES):
+  # a large response is only safe to make if we don't hold all of it in
+  # memory at once
+  return STATUSES_UPPER_LIMIT if stream else UPPER_LIMIT
+
+def statuses_query(args=None, stream=False):
+  '''the status entries query of get_statuses(), or None if the lookup is
+  invalid.
+  '''
 
-def get_statuses(args=None):
   if not args:
     args = request.args
-  last_consensus = Consensus.query.order_by(Consensus.valid_after.desc())\
-    .first()
   lookup = args['lookup'] if 'lookup' in args else None
-  if not lookup or len(lookup) != Fingerprint.FP_LEN:
-    return None, None
+  if not lookup or not valid_fingerprint(lookup):
+    return None
 
   q = StatusEntry.query.filter\
-    (func.substr(StatusEntry.fingerprint, 0, Fingerprint.FP_SUBSTR_LEN)\
-      == lookup[:Fingerprint.FP_SUBSTR_LEN-1])
+    (fp_key(StatusEntry.fingerprint) == fp_key_value(lookup))
   q = q.order_by(StatusEntry.validafter.desc())
 
-  q = from_to(q)
-  entries = offset_limit(q, args=args)
+  q = from_to(q, args)
+  q = filter_flags(q, StatusEntry.flags, args)
+  cursor = get_cursor(args)
+  if cursor: # single fingerprint: validafter alone is the key
+    q = q.filter(StatusEntry.validafter < cursor[0])
+  return offset_limit(q, upper_limit=statuses_upper_limit(stream), args=args)
+
+def get_statuses(args=None, stream=False):
+  '''returns (latest consensus, entries), or (None, None) if the lookup is
+  invalid. entries is a list, unless stream is True, in which case it may be
+  an iterator over a server-side DB cursor.
+  '''
 
-  if OUTPUT_TIME:
-    t1 = time.time()
-  entries = entries.all()
-  if OUTPUT_TIME:
-    t2 = time.time()
-    debug_logger.info(str(datetime.datetime.now()) + \
-      ' - statusentry query finished, took: %s', t2 - t1)
+  if not args:
+    args = request.args
+  last_consensus = latest_consensus.get()
+  query = statuses_query(args, stream)
+  if query is None:
+    return None, None
+  if unknown_lookup(args):
+    return last_consensus, []
 
+  if stream:
+    return last_consensus, metrics.timed_rows(query.yield_per(STREAM_CHUNK),
+      done=lambda seconds: observe_query(query, seconds))
+
+  with metrics.db_time() as stopwatch:
+    entries = query.all()
+  metrics.add_rows(len(entries))
+  observe_query(query, stopwatch.seconds)
   return last_consensus, entries
 
+StatusRange = namedtuple('StatusRange', ['valid_after_from',
+  'valid_after_to', 'status_count', 'nickname', 'address'])
+
+def get_status_ranges(args=None):
+  '''returns (latest consensus, ranges), or (None, None) if the lookup is
+  invalid. ranges are runs of status entries which are no more than an hour
+  apart (gaps-and-islands) over the whole history of the relay (within
+  from..to), most recent first. offset, limit and cursor apply to ranges.
+
+  they are the presence intervals (see presence_ranges()), unless there is a
+  flag filter: ranges of having some flags are computed from the status
+  entries (see entry_ranges().)
+  '''
+
+  if not args:
+    args = request.args
+  last_consensus = latest_consensus.get()
+  lookup = args['lookup'] if 'lookup' in args else None
+  if not lookup or not valid_fingerprint(lookup):
+    return None, None
+  if unknown_lookup(args):
+    return last_consensus, []
+  if UPDATE_PRESENCE and not get_flag_bits(args):
+    return last_consensus, presence_ranges(lookup, args)
+  return last_consensus, entry_ranges(lookup, args)
+
+def status_range_bounds(args):
+  # (like from_to(): a from..to the wrong way round is ignored)
+  c_from, c_to = get_from_to(args)
+  if c_from and c_to and c_from > c_to:
+    return None, None
+  return c_from, c_to
+
+def presence_ranges(lookup, args):
+  '''a page of ranges from the presence table: one index scan for the page,
+  however long the relay's history. the (oldest and newest) intervals which
+  from..to cut into are narrowed down to their status entries within
+  from..to, with a lookup each. status_count counts hourly consensuses.
+  '''
+
+  c_from, c_to = status_range_bounds(args)
+  q = Presence.query.filter(Presence.fingerprint == lookup)
+  if c_from:
+    q = q.filter(Presence.end_va >= c_from)
+  if c_to:
+    q = q.filter(Presence.start_va < c_to)
+  cursor = get_cursor(args)
+  if cursor: # ranges older than the last one seen
+    q = q.filter(Presence.end_va < cursor[0])
+  q = offset_limit(q.order_by(Presence.start_va.desc()), args=args)
+  with metrics.db_time() as stopwatch:
+    intervals = q.all()
+  metrics.add_rows(len(intervals))
+  observe_query(q, stopwatch.seconds)
+
+  entries = select([StatusEntry.validafter, StatusEntry.nickname,
+    StatusEntry.address]).where(fp_key(StatusEntry.fingerprint) ==
+      fp_key_value(lookup))
+  ranges = []
+  for i in intervals:
+    start, end, nickname, address = i.start_va, i.end_va, i.nickname, \
+      i.address
+    if c_from and start < c_from: # the first entry from c_from on
+      start = db.session.execute(entries.where(and_(
+        StatusEntry.validafter >= c_from, StatusEntry.validafter <= end))
+        .order_by(StatusEntry.validafter).limit(1)).scalar()
+    if c_to and end >= c_to: # the last entry before c_to
+      last = db.session.execute(entries.where(and_(
+        StatusEntry.validafter < c_to, StatusEntry.validafter >= i.start_va))
+        .order_by(StatusEntry.validafter.desc()).limit(1)).first()
+      end, nickname, address = last if last else (None, None, None)
+    if start is None or end is None or end < start:
+      continue # (from..to falls between two of its entries)
+    count = int((end - start).total_seconds() //
+      Presence.CONSENSUS_INTERVAL.total_seconds()) + 1
+    ranges.append(StatusRange(start, end, count, nickname, address))
+  return ranges
+
+def entry_ranges(lookup, args):
+  '''a page of ranges computed from the status entries (with a window over
+  all of the relay's entries within from..to), for ranges of having the
+  flags in the flag param.
+  '''
+
+  fp_substr = fp_key(StatusEntry.fingerprint)
+
+  # each entry, together with the validafter of the entry before it
+  q = select([StatusEntry.validafter, func.lag(StatusEntry.validafter)\
+    .over(order_by=StatusEntry.validafter).label('prev')])\
+    .where(fp_substr == fp_key_value(lookup))
+  q = from_to(q, args)
+  q = filter_flags(q, StatusEntry.flags, args) # ranges of having the flags
+  entries = q.alias('entries')
+  # a running count of gaps numbers the islands
+  gap = or_(entries.c.prev == None,
+    entries.c.validafter - entries.c.prev > datetime.timedelta(hours=1))
+  islands = select([entries.c.validafter,
+    func.sum(case([(gap, 1)], else_=0))\
+      .over(order_by=entries.c.validafter).label('island')])\
+    .alias('islands')
+  valid_after_to = func.max(islands.c.validafter)
+  q = select([func.min(islands.c.validafter).label('valid_after_from'),
+    valid_after_to.label('valid_after_to'),
+    func.count().label('status_count')]).group_by(islands.c.island)
+  cursor = get_cursor(args)
+  if cursor: # ranges older than the last one seen
+    q = q.having(valid_after_to < cursor[0])
+  q = q.order_by(valid_after_to.desc())
+  q = offset_limit(q, args=args)
+  ranges = q.alias('ranges')
+
+  # only now, for the ranges in this page, get their last nicknames and
+  # addresses (index lookups on (fingerprint, validafter))
+  q = select([ranges.c.valid_after_from, ranges.c.valid_after_to,
+    ranges.c.status_count, StatusEntry.nickname, StatusEntry.address])\
+    .where(and_(fp_substr == fp_key_value(lookup),
+      StatusEntry.validafter == ranges.c.valid_after_to))\
+    .order_by(ranges.c.valid_after_to.desc())
+
+  with metrics.db_time() as stopwatch:
+    ranges = db.session.execute(q).fetchall()
+  metrics.add_rows(len(ranges))
+  observe_query(q, stopwatch.seconds)
+  return ranges
+
 @app.route('/statuses')
 def statuses():
-  last_consensus, entries = get_statuses()
+  if bad_cursor() or bad_flags():
+    return abort(400)
+  condensed = request.args.get('condensed', 'false') == 'true'
+  if condensed:
+    last_consensus, entries = get_status_ranges()
+  else:
+    last_consensus, entries = get_statuses(stream=STREAM_RESPONSES)
   if entries is None: # explicit check
     return abort(400)
 
-  data = {'relays_published':
-            last_consensus.valid_after.strftime('%Y-%m-%d %H:%M:%S'),
+  head = {'relays_published': timestamp(last_consensus.valid_after),
           'fingerprint': request.args['lookup']} # safe (otherwise would have
                                                  # abort()'ed)
 
-  if request.args.get('condensed', 'false') != 'true':
-    data['entries'] = []
-    for e in entries:
-      data['entries'].append({
-        'exit_addresses': [e.address],
-        'valid-after': e.validafter.strftime('%Y-%m-%d %H:%M:%S'),
-      })
-      if e.nickname != 'Unnamed':
-        data['entries'][-1]['nickname'] = e.nickname
-  else:
-    data['ranges'] = []
-    last = None
-    for e in entries:
-      if not last or last - e.validafter > datetime.timedelta(hours=1):
-        if data['ranges']:
-          data['ranges'][-1]['valid_after_from'] = \
-            last.strftime('%Y-%m-%d %H:%M:%S')
-        data['ranges'].append({'valid_after_to': \
-          e.validafter.strftime('%Y-%m-%d %H:%M:%S'),
-          'last_addresses': [e.address], 'last_nickname': e.nickname})
-      last = e.validafter
-    if data['ranges']:
-      data['ranges'][-1]['valid_after_from'] = \
-        last.strftime('%Y-%m-%d %H:%M:%S')
-    data['total_status_count'] = len(entries)
-
-  data['count'] = len(data['entries'] if 'entries' in data else data['ranges'])
-  resp = jsonify(data)
-  resp.status_code = 200
-  return resp
+  if not condensed:
+    entries = RowTally(entries)
+    return respond(head, 'entries', (status_entry(e) for e in entries),
+      page_tail(entries, statuses_upper_limit()))
+
+  def tail(count):
+    fields = {'count': count,
+      'total_status_count': sum(r.status_count for r in entries)}
+    if entries and count >= get_limit():
+      fields['next'] = encode_cursor(entries[-1].valid_after_from,
+        head['fingerprint'])
+    return fields
+  return respond(head, 'ranges', (status_range(r) for r in entries), tail)
+
+def uptime_fraction(intervals, start, end):
+  '''the fraction of [start, end) covered by intervals, each consensus in an
+  interval counting for CONSENSUS_INTERVAL (from its valid-after on.)
+  '''
+
+  if not start or not end or end <= start:
+    return None
+  covered = datetime.timedelta(0)
+  for i in intervals:
+    overlap = min(end, i.end_va + Presence.CONSENSUS_INTERVAL) - \
+      max(start, i.start_va)
+    if overlap > datetime.timedelta(0):
+      covered += overlap
+  return covered.total_seconds() / (end - start).total_seconds()
+
+def get_presence(args=None):
+  '''returns (latest consensus, intervals, start, end), or None if the lookup
+  is invalid. intervals overlap [start, end), which defaults to [first time
+  the relay was seen, end of the latest consensus.)
+  '''
+
+  if not args:
+    args = request.args
+  last_consensus = latest_consensus.get()
+  lookup = args['lookup'] if 'lookup' in args else None
+  if not lookup or not valid_fingerprint(lookup):
+    return None
+
+  c_from, c_to = get_from_to(args)
+  intervals = [] if unknown_lookup(args) else \
+    get_presence_intervals(lookup, c_from, c_to)
+
+  start = c_from or (intervals[-1].start_va if intervals else None)
+  end = c_to or last_consensus.valid_after + Presence.CONSENSUS_INTERVAL
+  return last_consensus, intervals, start, end
+
+def get_presence_intervals(lookup, c_from, c_to):
+  q = Presence.query.filter(Presence.fingerprint == lookup)
+  if c_from:
+    q = q.filter(Presence.end_va > c_from - Presence.CONSENSUS_INTERVAL)
+  if c_to:
+    q = q.filter(Presence.start_va < c_to)
+  q = q.order_by(Presence.start_va.desc())
+  with metrics.db_time() as stopwatch:
+    intervals = q.all()
+  metrics.add_rows(len(intervals))
+  observe_query(q, stopwatch.seconds)
+  return intervals
+
+def presence_interval(i):
+  return {
+    'valid_after_from': timestamp(i.start_va),
+    'valid_after_to': timestamp(i.end_va),
+    'last_addresses': [i.address],
+    'last_nickname': i.nickname
+  }
+
+@app.route('/presence')
+def presence():
+  result = get_presence()
+  if result is None:
+    return abort(400)
+  last_consensus, intervals, start, end = result
+  if start and end <= start:
+    return abort(400)
+
+  head = {'relays_published': timestamp(last_consensus.valid_after),
+          'fingerprint': request.args['lookup'],
+          'from': timestamp(start) if start else None,
+          'to': timestamp(end),
+          'uptime': uptime_fraction(intervals, start, end)}
+  return respond(head, 'intervals', (presence_interval(i) for i in intervals),
+    lambda count: {'count': count})
+
+@app.route('/metrics')
+def metrics_view():
+  '''request latency (etc.) metrics of this process, for Prometheus.
+  '''
+
+  return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
   pass
@@ -1,30 +1,117 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+'''On-demand profiling of single API requests.
+
+A request is profiled (with cProfile) if it comes with the admin token
+(PROFILE_TOKEN) in an X-Torsearch-Profile header or a profile= parameter, or
+if it's picked by the 1 in PROFILE_SAMPLE random sampling. Each profile is
+dumped into its own pstats file under PROFILE_DIR, named
+
+  <endpoint>.<query class>.<time>.<pid>.<n>.pstats
+
+(the file name is also sent back in the X-Torsearch-Profile response header.)
+Profiles of many requests can be merged into a single report with
+tools/merge_profiles.py.
+
+Only the thread serving the request is profiled. For streamed responses,
+the profile covers the request up until the response is closed.
+'''
+
+import os
+import time
+import random
+import hmac
+import itertools
+import threading
 import cProfile as profiler
-import gc, pstats, time
-
-def profile(fn):
-  def wrapper(*args, **kw):
-    elapsed, stat_loader, result = _profile("profiler_output.log",
-      fn, *args, **kw)
-    stats = stat_loader()
-    stats.sort_stats('cumulative')
-    stats.print_stats()
-    #stats.print_callers()
-    return result
-  return wrapper
-
-def _profile(filename, fn, *args, **kw):
-  load_stats = lambda: pstats.Stats(filename)
-  gc.collect()
-
-  began = time.time()
-  profiler.runctx('result = fn(*args, **kw)', globals(), locals(),
-                  filename=filename)
-  ended = time.time()
-
-  return ended - began, load_stats, locals()['result']
+from flask import g, request
+from config import basedir, PROFILE_TOKEN, PROFILE_SAMPLE, PROFILE_DIR
+
+PROFILE_HEADER = 'X-Torsearch-Profile'
+PROFILE_SUFFIX = '.pstats'
+
+_counter = itertools.count()
+_counter_lock = threading.Lock()
+
+def profile_dir():
+  return os.path.join(basedir, PROFILE_DIR)
+
+def profile_filename(endpoint, query_class):
+  '''a unique pstats file name for a request.
+  '''
+
+  with _counter_lock:
+    n = next(_counter)
+  return '%s.%s.%s.%d.%d%s' % (endpoint, query_class,
+    time.strftime('%Y%m%dT%H%M%S'), os.getpid(), n, PROFILE_SUFFIX)
+
+def parse_filename(filename):
+  '''(endpoint, query class) of a profile file name, or None.
+  '''
+
+  parts = os.path.basename(filename).split('.')
+  if len(parts) != 6 or '.' + parts[-1] != PROFILE_SUFFIX:
+    return None
+  return parts[0], parts[1]
+
+def requested(token=PROFILE_TOKEN, sample=PROFILE_SAMPLE):
+  '''whether the current request should be profiled.
+  '''
+
+  given = request.headers.get(PROFILE_HEADER) or request.args.get('profile')
+  if token and given and hmac.compare_digest(str(given), str(token)):
+    return True
+  return bool(sample) and random.randrange(sample) == 0
+
+class RequestProfile(object):
+  def __init__(self, endpoint, query_class):
+    self.filename = profile_filename(endpoint, query_class)
+    self.profile = profiler.Profile()
+    self.done = False
+    self.profile.enable()
+
+  def finish(self):
+    if self.done:
+      return
+    self.done = True
+    self.profile.disable()
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        pass # (another worker beat us to it)
+    self.profile.dump_stats(os.path.join(directory, self.filename))
+
+def init_app(app, query_class, skip_endpoints=('metrics', 'static')):
+  '''profile requests to app on demand (see requested().) query_class(args)
+  classifies a request by its arguments, for the file name.
+  '''
+
+  @app.before_request
+  def start_request_profile():
+    if request.endpoint and request.endpoint not in skip_endpoints \
+        and requested():
+      g.request_profile = RequestProfile(request.endpoint,
+        query_class(request.args))
+
+  @app.after_request
+  def finish_request_profile(response):
+    request_profile = getattr(g, 'request_profile', None)
+    if request_profile:
+      response.headers[PROFILE_HEADER] = request_profile.filename
+      # (streamed responses are still to be generated at this point)
+      response.call_on_close(request_profile.finish)
+      g.request_profile = None
+    return response
+
+  @app.teardown_request
+  def abort_request_profile(exception):
+    # (after_request isn't called on unhandled exceptions)
+    request_profile = getattr(g, 'request_profile', None)
+    if request_profile:
+      request_profile.finish()
 
 if __name__ == '__main__':
   pass
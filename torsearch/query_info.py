@@ -1,6 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import json
+import time
+import random
+import datetime
+import threading
+import Queue
+import logging
+from logging.handlers import RotatingFileHandler
 from pprint import pformat
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.sql.expression import Executable, ClauseElement,\
@@ -8,6 +17,12 @@ from sqlalchemy.sql.expression import Executable, ClauseElement,\
 from flask_sqlalchemy import BaseQuery
 from torsearch import db
 from torsearch import debug_logger
+from config import basedir, SLOW_QUERY_THRESHOLD, SLOW_QUERY_SAMPLE, \
+  SLOW_QUERY_MAX_PER_MINUTE, SLOW_QUERY_LOG
+
+SLOW_QUERY_LOG_BYTES = 10 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 5
+EXPLAIN_TIMEOUT = 30000 # ms; for re-running (EXPLAIN ANALYZE) slow queries
 
 class Explain(Executable, ClauseElement):
   def __init__(self, statement, analyze=False, buffers=False):
@@ -56,5 +71,137 @@ def run_explain(query, analyze=False, buffers=False, output_statement=False,
     debug_log('EXPLAIN results:')
     debug_log(pformat(info))
 
+  return info
+
+class TokenBucket(object):
+  '''allows for rate events per per seconds, in bursts of up to rate.
+  '''
+
+  def __init__(self, rate, per=60.0):
+    self.capacity = float(rate)
+    self.tokens = float(rate)
+    self.fill_rate = rate / float(per)
+    self.last = time.time()
+    self._lock = threading.Lock()
+
+  def take(self):
+    with self._lock:
+      now = time.time()
+      self.tokens = min(self.capacity,
+        self.tokens + (now - self.last) * self.fill_rate)
+      self.last = now
+      if self.tokens >= 1:
+        self.tokens -= 1
+        return True
+      return False
+
+def json_value(value):
+  if isinstance(value, datetime.datetime):
+    return value.isoformat(' ')
+  if isinstance(value, (basestring, int, long, float, bool)) or value is None:
+    return value
+  return str(value)
+
+class SlowQueryLog(object):
+  '''records queries which took over threshold seconds (and a random 1 in
+  sample of the rest) together with their EXPLAIN (ANALYZE, BUFFERS) plans,
+  as JSON lines in a rotating log file.
+
+  the EXPLAINs run in a background thread, on a connection of its own. as
+  EXPLAIN ANALYZE runs the query once more, at most max_per_minute queries
+  are captured (a token bucket); the rest are only counted (as 'dropped' in
+  the next record), so that a slow period doesn't get any slower because of
+  us.
+  '''
+
+  def __init__(self, threshold=SLOW_QUERY_THRESHOLD, sample=SLOW_QUERY_SAMPLE,
+      max_per_minute=SLOW_QUERY_MAX_PER_MINUTE, filename=SLOW_QUERY_LOG):
+    self.threshold = threshold
+    self.sample = sample
+    self.bucket = TokenBucket(max_per_minute)
+    self.max_queued = max(int(max_per_minute), 1)
+    self.dropped = 0
+    self.filename = filename
+    self._queue = None
+    self._pid = None # threads don't survive forks
+    self._lock = threading.Lock()
+    self.logger = logging.getLogger('torsearch.slow_queries')
+    self.logger.propagate = False
+
+  def observe(self, query, seconds, labels=(None, None)):
+    '''called with (each) query and the time it took. returns whether the
+    query is going to be logged.
+    '''
+
+    if seconds >= self.threshold:
+      reason = 'slow'
+    elif self.sample and random.randrange(self.sample) == 0:
+      reason = 'sampled'
+    else:
+      return False
+    if not self.bucket.take():
+      self.dropped += 1
+      return False
+
+    statement = query if isinstance(query, Select) else query.statement
+    compiled = statement.compile(dialect=db.engine.dialect)
+    record = {'time': datetime.datetime.utcnow().isoformat(' '),
+      'seconds': round(seconds, 6), 'reason': reason,
+      'endpoint': labels[0], 'query_class': labels[1],
+      'sql': str(compiled),
+      'params': dict((name, json_value(value))
+        for name, value in compiled.params.iteritems()),
+      'dropped': self.dropped}
+    try:
+      self._worker_queue().put_nowait((record, statement))
+    except Queue.Full:
+      self.dropped += 1
+      return False
+    self.dropped = 0
+    return True
+
+  def _worker_queue(self):
+    with self._lock:
+      if self._pid != os.getpid():
+        if not self.logger.handlers:
+          handler = RotatingFileHandler(os.path.join(basedir, self.filename),
+            maxBytes=SLOW_QUERY_LOG_BYTES, backupCount=SLOW_QUERY_LOG_BACKUPS)
+          handler.setFormatter(logging.Formatter('%(message)s'))
+          self.logger.addHandler(handler)
+          self.logger.setLevel(logging.INFO)
+        self._queue = Queue.Queue(maxsize=self.max_queued)
+        worker = threading.Thread(target=self._work, args=(self._queue,),
+          name='slow-query-explain')
+        worker.daemon = True
+        worker.start()
+        self._pid = os.getpid()
+      return self._queue
+
+  def _work(self, queue):
+    conn = None
+    while True:
+      record, statement = queue.get()
+      try:
+        if conn is None:
+          conn = db.engine.connect()
+        record['explain'] = self.explain(conn, statement)
+      except Exception as e:
+        record['explain_error'] = str(e)
+        if conn is not None:
+          conn.invalidate() # start afresh next time
+          conn = None
+      self.logger.info(json.dumps(record, sort_keys=True))
+
+  def explain(self, conn, statement):
+    trans = conn.begin()
+    try:
+      conn.execute('SET LOCAL statement_timeout = %d' % EXPLAIN_TIMEOUT)
+      return [row[0] for row in
+        conn.execute(Explain(statement, analyze=True, buffers=True))]
+    finally:
+      trans.rollback() # (it's all SELECTs anyway)
+
+slow_query_log = SlowQueryLog()
+
 if __name__ == '__main__':
   pass
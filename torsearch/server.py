@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Serving the API with a pre-forking WSGI server (see wsgi.py and
+gunicorn.conf.py.)
+
+The app is loaded once, in the master process, and then forked into
+SERVER_WORKERS worker processes. The master loads the latest consensus
+before forking (see prepare()), so that the workers inherit what is built
+from it - the running relays snapshot and the fingerprint filter - instead of
+each building them while booting. Each worker drops the database connections
+it would otherwise share with its siblings (see after_fork()), and is warmed
+up before taking requests: the hot queries are built, compiled and run once
+(see warm_up()), so that the first requests don't pay for mapper
+configuration, statement compilation and cold connections.
+
+Neither of those may keep a worker from starting (gunicorn gives up on the
+whole server if one can't boot): if the database is down, they are logged
+and the worker starts cold.
+'''
+
+import multiprocessing
+import time
+from sqlalchemy.orm import configure_mappers
+from sqlalchemy.sql.expression import Select
+from torsearch import db, debug_logger
+from torsearch import onionoo_api
+from torsearch.cache import latest_consensus
+from config import SERVER_WORKERS
+
+# one query per query class (see onionoo_api.query_class())
+WARM_UP_ARGS = (
+  {'limit': '1'},
+  {'running': 'true', 'limit': '1'},
+  {'search': 'moria1', 'limit': '1'},
+  {'search': '$9695DFC3', 'limit': '1'},
+  {'search': '86.59.21.38', 'limit': '1'},
+  {'lookup': '9695DFC35FFEB861329B9F1AB04C46397020CE31'})
+WARM_UP_STATUSES_ARGS = {'lookup': '9695DFC35FFEB861329B9F1AB04C46397020CE31',
+  'limit': '1'}
+
+def workers():
+  return SERVER_WORKERS or multiprocessing.cpu_count() * 2 + 1
+
+def prepare():
+  '''in the master process, before forking the workers.
+  '''
+
+  t1 = time.time()
+  try:
+    configure_mappers()
+    # (refresh(), not get(): the master mustn't LISTEN, as it never polls)
+    consensus = latest_consensus.refresh()
+  except Exception as e:
+    debug_logger.error('Could not load the latest consensus before forking: '
+      '%s', str(e))
+    return
+  finally:
+    db.session.remove()
+    db.engine.dispose() # (the workers make their own connections)
+  debug_logger.info('Prepared in %.2fs (latest consensus: %s)',
+    time.time() - t1, consensus.valid_after if consensus else None)
+
+def after_fork():
+  '''forked processes must not share the parent's pooled connections.
+  '''
+
+  db.session.remove()
+  db.engine.dispose()
+
+def warm_up():
+  '''get a freshly started (worker) process ready to serve requests.
+  '''
+
+  t1 = time.time()
+  try:
+    configure_mappers()
+    consensus = latest_consensus.get()
+    if consensus is None:
+      return # nothing to search yet
+    for args in WARM_UP_ARGS:
+      for query in (onionoo_api.do_search(consensus.valid_after, args=args),
+          onionoo_api.with_descriptor(
+            onionoo_api.do_search(consensus.valid_after, args=args))):
+        if isinstance(query, Select):
+          db.session.execute(query).fetchall()
+        else:
+          query.all()
+    onionoo_api.statuses_query(WARM_UP_STATUSES_ARGS).all()
+  except Exception as e:
+    debug_logger.error('Could not warm up: %s', str(e))
+    return
+  finally:
+    db.session.remove()
+  debug_logger.info('Warmed up in %.2fs (latest consensus: %s)',
+    time.time() - t1, consensus.valid_after)
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''An in-memory snapshot of the relays in the latest consensus.
+
+running=true searches only ever return the relays of the latest consensus
+(a few thousand of them), yet in the database they are a filter on
+fingerprint.last_va plus a join with statusentry (and descriptor.) Each
+process instead keeps those relays in memory, as result rows just like
+do_search()'s (with the descriptor columns, see onionoo_api.with_descriptor()),
+sorted by fingerprint, along with sorted indexes for prefix searches on
+fingerprints, lower-case nicknames and addresses (all the addresses each relay
+has ever been seen with, as the address history search goes by those.)
+
+The snapshot is rebuilt whenever the latest consensus changes (see
+cache.LatestConsensusCache.add_listener()); onionoo_api.search_snapshot()
+answers what queries it can from it.
+'''
+
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from sqlalchemy import select, and_
+from torsearch import db, debug_logger
+from torsearch.models import Fingerprint, StatusEntry, Descriptor, \
+  AddressHistory
+from torsearch.fingerprints import fp_key
+
+SNAPSHOT_COLUMNS = (Fingerprint.nickname, Fingerprint.fingerprint,
+  Fingerprint.first_va, Fingerprint.last_va, StatusEntry.address,
+  StatusEntry.or_port, StatusEntry.dir_port, StatusEntry.published,
+  StatusEntry.validafter, StatusEntry.flags, Descriptor.platform,
+  Descriptor.average_bandwidth, Descriptor.burst_bandwidth,
+  Descriptor.observed_bandwidth, Descriptor.exit_policy)
+
+RunningRelay = namedtuple('RunningRelay',
+  [column.key for column in SNAPSHOT_COLUMNS])
+
+def ip_to_int(address):
+  '''an IPv4 address as an integer, or None if it isn't one.
+  '''
+
+  octets = address.split('.')
+  if len(octets) != 4 or not all(o.isdigit() and int(o) <= 255
+      for o in octets):
+    return None
+  ip = 0
+  for o in octets:
+    ip = (ip << 8) | int(o)
+  return ip
+
+def prefix_range(keys, prefix):
+  '''the (start, end) slice of the sorted (key, i) pairs whose keys start
+  with prefix.
+  '''
+
+  start = bisect_left(keys, (prefix,))
+  end = start
+  while end < len(keys) and keys[end][0].startswith(prefix):
+    end += 1
+  return start, end
+
+class Snapshot(object):
+  '''the relays of one consensus, and their indexes. rows are sorted by
+  fingerprint; the indexes are sorted lists of (key, row number) pairs.
+  '''
+
+  def __init__(self, valid_after, rows, addresses=()):
+    self.valid_after = valid_after
+    self.rows = sorted(rows, key=lambda row: row.fingerprint)
+    self.fingerprints = [row.fingerprint for row in self.rows]
+    self.by_fingerprint = dict((fp, i) for i, fp in
+      enumerate(self.fingerprints))
+    self.nicknames = sorted((row.nickname.lower(), i)
+      for i, row in enumerate(self.rows) if row.nickname)
+    self.addresses = sorted(set((ip, self.by_fingerprint[fp])
+      for ip, fp in addresses if fp in self.by_fingerprint))
+
+  def __len__(self):
+    return len(self.rows)
+
+  def everything(self):
+    return range(len(self.rows))
+
+  def lookup(self, fingerprint):
+    i = self.by_fingerprint.get(fingerprint)
+    return [] if i is None else [i]
+
+  def fingerprint_prefix(self, prefix):
+    start = bisect_left(self.fingerprints, prefix)
+    end = start
+    while end < len(self.fingerprints) and \
+        self.fingerprints[end].startswith(prefix):
+      end += 1
+    return range(start, end)
+
+  def nickname_prefix(self, prefix):
+    start, end = prefix_range(self.nicknames, prefix.lower())
+    return [i for nickname, i in self.nicknames[start:end]]
+
+  def nickname_substring(self, term):
+    term = term.lower()
+    return [i for nickname, i in self.nicknames if term in nickname]
+
+  def address_ranges(self, ranges):
+    '''relays which have ever used an address within one of the (lowest,
+    highest) address ranges (see onionoo_api.address_ranges().)
+    '''
+
+    found = set()
+    for lo, hi in ranges:
+      start = bisect_left(self.addresses, (ip_to_int(lo),))
+      end = bisect_right(self.addresses, (ip_to_int(hi) + 1,))
+      found.update(i for ip, i in self.addresses[start:end])
+    return found
+
+class RunningRelays(object):
+  '''holds the Snapshot of the latest consensus (if it has been built.)
+  '''
+
+  def __init__(self):
+    self.snapshot = None
+    self._lock = threading.Lock()
+
+  def get(self, valid_after):
+    '''the snapshot of the consensus valid after valid_after, or None.
+    '''
+
+    snapshot = self.snapshot
+    if snapshot is None or snapshot.valid_after != valid_after:
+      return None
+    return snapshot
+
+  def rebuild(self, latest_consensus):
+    '''latest_consensus listener (see cache.LatestConsensusCache.)
+    '''
+
+    if latest_consensus is None:
+      self.snapshot = None
+      return
+    with self._lock:
+      if self.get(latest_consensus.valid_after):
+        return
+      t1 = time.time()
+      try:
+        snapshot = build_snapshot(latest_consensus.valid_after)
+      except Exception as e:
+        # searches go to the database until the next consensus
+        debug_logger.error('Could not build the running relays snapshot: %s',
+          str(e))
+        db.session.rollback()
+        self.snapshot = None
+        return
+      self.snapshot = snapshot
+    debug_logger.info('Running relays snapshot of %s: %d relays, %d '
+      'addresses, built in %.2fs', snapshot.valid_after, len(snapshot),
+      len(snapshot.addresses), time.time() - t1)
+
+def build_snapshot(valid_after):
+  relays = select(SNAPSHOT_COLUMNS).select_from(
+    Fingerprint.__table__.join(StatusEntry.__table__,
+      and_(Fingerprint.sid == StatusEntry.id,
+        StatusEntry.validafter == Fingerprint.last_va))
+    .outerjoin(Descriptor.__table__,
+      Descriptor.descriptor == StatusEntry.descriptor))\
+    .where(Fingerprint.last_va == valid_after)
+  rows = [RunningRelay(*row) for row in db.session.execute(relays)]
+
+  history = select([AddressHistory.address, AddressHistory.fingerprint])\
+    .where(fp_key(AddressHistory.fingerprint).in_(
+      select([Fingerprint.fp12]).where(Fingerprint.last_va == valid_after)))
+  addresses = []
+  for address, fingerprint in db.session.execute(history):
+    ip = ip_to_int(address)
+    if ip is not None: # (IPv4 only, like address searches)
+      addresses.append((ip, fingerprint))
+  return Snapshot(valid_after, rows, addresses)
+
+if __name__ == '__main__':
+  pass
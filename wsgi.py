@@ -0,0 +1,8 @@
+'''WSGI entry point, for production use. with gunicorn:
+
+  gunicorn -c gunicorn.conf.py wsgi
+
+(run.py starts Flask's development server instead.)
+'''
+
+from torsearch import app as application